@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Benchmarks opening the catalog viewer of the IBM Geospatial APIs dialog.
+
+Compares the previous eager rendering, which created a QStandardItem for every dataset and
+layer before the dialog appeared, with the lazy CatalogTreeModel, which only creates rows for
+datasets until one is expanded. Runs inside the QGIS Python environment or any Python with
+PyQt5 installed:
+
+    python benchmarks/catalog_dialog_benchmark.py --datasets 2000 --layers 25
+"""
+import argparse
+import os
+import sys
+import time
+import types
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+try:
+    from qgis.PyQt import QtCore, QtGui, QtWidgets
+except ImportError:
+    # Outside of QGIS expose PyQt5 as qgis.PyQt so the plugin modules can be imported
+    from PyQt5 import QtCore, QtGui, QtWidgets
+    qgis = types.ModuleType('qgis')
+    qgis.PyQt = types.ModuleType('qgis.PyQt')
+    qgis.PyQt.QtCore, qgis.PyQt.QtGui, qgis.PyQt.QtWidgets = QtCore, QtGui, QtWidgets
+    sys.modules.update({'qgis': qgis, 'qgis.PyQt': qgis.PyQt})
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ei_geospatial.catalog_model import CatalogTreeModel  # noqa: E402
+
+
+def synthetic_catalog(datasets, layers):
+    """Returns a dataset name -> layer records dictionary as produced by IBMPairsDialog.dict_cat."""
+    data = {}
+    for d in range(datasets):
+        data['Dataset {:05d}'.format(d)] = [
+            ['Long description of dataset {}'.format(d), str(d * layers + l), 'Layer {} of dataset {}'.format(l, d),
+             '4km', 'K', 'Long description of layer {} of dataset {}'.format(l, d)]
+            for l in range(layers)]
+    return data
+
+
+def eager(tree, data):
+    """The rendering used before the lazy model: every item is created up front."""
+    model = QtGui.QStandardItemModel(tree)
+    model.setHorizontalHeaderLabels(['Dataset', 'Layer id', 'Layer name', 'Resolution', 'Units'])
+    tree.setModel(model)
+    root = tree.rootIndex()
+    for row, (text, values) in enumerate(data.items()):
+        category = QtGui.QStandardItem(text)
+        category.setEditable(False)
+        category.setToolTip(values[0][0])
+        model.appendRow(category)
+        tree.setFirstColumnSpanned(row, root, True)
+        for value in values:
+            items = [QtGui.QStandardItem(), QtGui.QStandardItem(str(value[1])), QtGui.QStandardItem(value[2]),
+                     QtGui.QStandardItem(value[3]), QtGui.QStandardItem(value[4])]
+            items[2].setToolTip(value[5])
+            for item in items:
+                item.setEditable(False)
+            category.appendRow(items)
+    return model
+
+
+def lazy(tree, data):
+    """The rendering of the lazy CatalogTreeModel."""
+    model = CatalogTreeModel(parent=tree)
+    tree.setModel(model)
+    model.set_data(data)
+    root = tree.rootIndex()
+    for row in range(model.rowCount()):
+        tree.setFirstColumnSpanned(row, root, True)
+    return model
+
+
+def measure(render, data, repeat):
+    timings = []
+    for _ in range(repeat):
+        tree = QtWidgets.QTreeView()
+        tree.setUniformRowHeights(True)
+        start = time.perf_counter()
+        render(tree, data)
+        tree.show()
+        QtWidgets.QApplication.processEvents()
+        timings.append(time.perf_counter() - start)
+        tree.close()
+        tree.deleteLater()
+        QtWidgets.QApplication.processEvents()
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--datasets', type=int, default=2000)
+    parser.add_argument('--layers', type=int, default=25, help='layers per dataset')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+    data = synthetic_catalog(args.datasets, args.layers)
+
+    before = measure(eager, data, args.repeat)
+    after = measure(lazy, data, args.repeat)
+    print('catalog: {} datasets, {} layers'.format(args.datasets, args.datasets * args.layers))
+    print('eager QStandardItemModel: {:8.1f} ms'.format(before * 1000))
+    print('lazy CatalogTreeModel:    {:8.1f} ms'.format(after * 1000))
+    print('speedup:                  {:8.1f}x'.format(before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Benchmarks loading the catalog when the IBM Geospatial APIs dialog opens.
+
+Compares parsing data_sets.json and data_layers.json, merging them and building the records and
+search index, which happens when the json changed, with reading the pre-joined snapshot, which
+happens on every other open. Needs pandas only:
+
+    python benchmarks/catalog_snapshot_benchmark.py --datasets 2000 --layers 25
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from ei_geospatial.catalog_snapshot import SNAPSHOT_FILE, load_catalog  # noqa: E402
+from dict_cat_benchmark import synthetic_catalog  # noqa: E402
+
+
+def measure(folder, rebuild, repeat):
+    dsets_path = os.path.join(folder, 'data_sets.json')
+    layer_path = os.path.join(folder, 'data_layers.json')
+    timings = []
+    for _ in range(repeat):
+        if rebuild and os.path.exists(os.path.join(folder, SNAPSHOT_FILE)):
+            os.remove(os.path.join(folder, SNAPSHOT_FILE))
+        start = time.perf_counter()
+        data, index = load_catalog(dsets_path, layer_path)
+        timings.append(time.perf_counter() - start)
+    return min(timings), data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--datasets', type=int, default=2000)
+    parser.add_argument('--layers', type=int, default=25, help='layers per dataset')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    cat_dset, cat_layers = synthetic_catalog(args.datasets, args.layers)
+    with tempfile.TemporaryDirectory() as folder:
+        # Written like LoginDialog.catalog does
+        with open(os.path.join(folder, 'data_sets.json'), 'w') as f:
+            json.dump(cat_dset, f, indent=2)
+        with open(os.path.join(folder, 'data_layers.json'), 'w') as f:
+            json.dump(cat_layers, f, indent=2)
+
+        before, data = measure(folder, True, args.repeat)
+        after, _ = measure(folder, False, args.repeat)
+        size = os.path.getsize(os.path.join(folder, SNAPSHOT_FILE))
+        json_size = sum(os.path.getsize(os.path.join(folder, name)) for name in ('data_sets.json', 'data_layers.json'))
+
+    print('catalog: {} datasets, {} layers'.format(len(data), sum(len(v) for v in data.values())))
+    print('json, merge and index: {:8.1f} ms ({:.1f} MB json)'.format(before * 1000, json_size / 1048576.0))
+    print('snapshot:              {:8.1f} ms ({:.1f} MB)'.format(after * 1000, size / 1048576.0))
+    print('speedup:               {:8.1f}x'.format(before / after))
+
+
+if __name__ == '__main__':
+    main()
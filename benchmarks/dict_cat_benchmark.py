@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Benchmarks turning the merged catalog into the records of the catalog viewer.
+
+Compares the previous IBMPairsDialog.dict_cat, which walked the merged data sets and data layers
+row by row with iterrows, with the column based catalog_data.catalog_records, and checks both
+produce the same records. Needs pandas only:
+
+    python benchmarks/dict_cat_benchmark.py --datasets 2000 --layers 25
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ei_geospatial'))
+from catalog_data import LEVELS, catalog_records, merge_catalog  # noqa: E402
+
+
+def synthetic_catalog(datasets, layers):
+    """Returns data_sets.json and data_layers.json contents with the gaps found in the real catalog."""
+    data_sets = []
+    data_layers = []
+    for d in range(datasets):
+        data_sets.append({
+            'id': str(d),
+            'name': 'Dataset {:05d}'.format(d),
+            'data_source_name': None if d % 7 == 0 else 'Source {:05d}'.format(d),
+            'description_long': None if d % 11 == 0 else 'Long description of dataset {}'.format(d),
+            'level': 20,
+        })
+        if d % 13 == 0:
+            continue  # Data sets without layers
+        for l in range(layers):
+            i = d * layers + l
+            data_layers.append({
+                'id': str(100000 + i),
+                'dataset_id': str(d),
+                'name': 'Layer {} of dataset {}'.format(l, d),
+                'data_source_name': None,
+                'description_long': None if i % 5 == 0 else u'Layer {} – temperature at 2 m'.format(i),
+                'level': None if i % 17 == 0 else 1 + i % 29,
+                'units': None if i % 3 == 0 else 'K',
+            })
+    return {'data_sets': data_sets}, {'data_layers': data_layers}
+
+
+def iterrows(cat):
+    """The dict_cat used before catalog_records."""
+    data = {}
+    for row in cat.iterrows():
+        layerid = row[1]["id_layer"]
+        if type(layerid) is float and math.isnan(float(layerid)):
+            continue
+        dsetname = row[1]["data_source_name_dset"]
+        if type(dsetname) is float and math.isnan(float(dsetname)):
+            dsetname = row[1]["name_dset"]
+        dsetlong = row[1]["description_long_dset"]
+        if type(dsetlong) is float and math.isnan(float(dsetlong)):
+            dsetlong = ""
+        layer_name = row[1]["name_layer"]
+        layer_desc = row[1]["description_long_layer"]
+        if type(layer_desc) is float and math.isnan(float(layer_desc)):
+            layer_desc = ""
+        layer_desc = layer_desc.encode("ascii", "ignore").decode()
+        level = row[1]["level_layer"]
+        if type(level) is float and math.isnan(level):
+            level = "None"
+        else:
+            level = LEVELS[level]
+        unit = row[1]["units"]
+        if type(unit) is float and math.isnan(unit):
+            unit = 'unknown'
+        record = [str(dsetname), str(dsetlong), str(layerid), str(layer_name), level, unit, str(layer_desc)]
+        data.setdefault(record[0], []).append(record[1:])
+    return data
+
+
+def measure(function, cat, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(cat)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--datasets', type=int, default=2000)
+    parser.add_argument('--layers', type=int, default=25, help='layers per dataset')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    cat = merge_catalog(*synthetic_catalog(args.datasets, args.layers))
+
+    before, expected = measure(iterrows, cat, args.repeat)
+    after, actual = measure(catalog_records, cat, args.repeat)
+    if list(expected.items()) != list(actual.items()):
+        sys.exit('catalog_records does not match the iterrows records')
+    print('catalog: {} datasets, {} layers'.format(len(actual), sum(len(v) for v in actual.values())))
+    print('iterrows dict_cat:   {:8.1f} ms'.format(before * 1000))
+    print('catalog_records:     {:8.1f} ms'.format(after * 1000))
+    print('speedup:             {:8.1f}x'.format(before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Local result cache keyed on the normalized query json.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+INDEX_FILE = 'cache_index.json'
+OUTPUT_INFO = 'output.info'
+
+# Query keys that do not change the result of a query
+IGNORED_KEYS = ['name', 'notifications']
+# Number of decimals coordinates are rounded to, roughly 0.1 m
+COORDINATE_DECIMALS = 6
+TIMESTAMP_FORMATS = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%dT%H:%M:%S',
+                     '%Y-%m-%dT%H:%MZ', '%Y-%m-%d']
+
+
+def normalize_timestamp(value):
+    """Returns a timestamp string in UTC as YYYY-MM-DDThh:mm:ssZ, or the value unchanged if it cannot be parsed."""
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            timestamp = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return value
+
+
+def canonical_query(raster_query):
+    """
+    Returns a normalized copy of a query json, so equivalent queries compare equal.
+
+    Layers are sorted by id, coordinates are rounded and timestamps are converted to a single
+    format; keys that do not change the result, such as the query name, are dropped.
+
+    Args:
+        raster_query (dict): The query json.
+
+    Returns:
+        dict: The normalized query.
+    """
+    def normalize(value, key=None):
+        if isinstance(value, dict):
+            return {k: normalize(v, k) for k, v in value.items() if k not in IGNORED_KEYS}
+        if isinstance(value, list):
+            items = [normalize(v, key) for v in value]
+            if key == 'layers':
+                items.sort(key=lambda layer: str(layer.get('id', '')) if isinstance(layer, dict) else str(layer))
+            return items
+        if key == 'coordinates':
+            try:
+                return round(float(value), COORDINATE_DECIMALS)
+            except (TypeError, ValueError):
+                return value
+        if key in ('snapshot', 'start', 'end') and isinstance(value, str):
+            return normalize_timestamp(value)
+        if key == 'id':
+            return str(value)
+        return value
+
+    return normalize(raster_query)
+
+
+def query_hash(raster_query):
+    """
+    Returns the cache key of a query: the SHA-256 of its canonical json.
+
+    Args:
+        raster_query (dict): The query json.
+
+    Returns:
+        str: The hex digest.
+    """
+    canonical = json.dumps(canonical_query(raster_query), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    """
+    Content addressed store of downloaded query results.
+
+    Every entry is a folder named after the query hash that holds the result GeoTIFFs and their
+    output.info. Files are hard linked from the download folder where possible and copied otherwise.
+    The index records the size and last use of every entry; the least recently used entries are
+    evicted once the cache grows beyond ``max_bytes``.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.index = self.load_index()
+
+    def index_path(self):
+        return os.path.join(self.folder, INDEX_FILE)
+
+    def load_index(self):
+        try:
+            with open(self.index_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_index(self):
+        os.makedirs(self.folder, exist_ok=True)
+        tmp = self.index_path() + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path())
+
+    def lookup(self, key):
+        """
+        Returns the cached result files of a query hash.
+
+        Args:
+            key (str): The query hash.
+
+        Returns:
+            list: The paths of the cached files, None on a miss.
+        """
+        with self.lock:
+            entry = self.index.get(key)
+            files = None
+            if entry is not None:
+                files = [os.path.join(self.folder, key, name) for name in entry['files']]
+                if not all(os.path.isfile(f) for f in files):
+                    # Removed from disk by the user, drop the stale entry
+                    self.index.pop(key)
+                    files = None
+            if files is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry['last_used'] = time.time()
+            self.save_index()
+            return files
+
+    def store(self, key, files, query_id=None):
+        """
+        Adds the result files of a query to the cache and evicts old entries if it is too large.
+
+        Args:
+            key (str): The query hash.
+            files (list): The result files, their output.info is taken from the same folder.
+            query_id (str): The id of the query that produced the result.
+
+        Returns:
+            list: The paths of the cached files.
+        """
+        target = os.path.join(self.folder, key)
+        os.makedirs(target, exist_ok=True)
+
+        names = []
+        size = 0
+        sources = list(files)
+        if files:
+            output_info = Path(files[0]).parent / OUTPUT_INFO
+            if output_info.is_file():
+                sources.append(str(output_info))
+        for source in sources:
+            name = os.path.basename(source)
+            destination = os.path.join(target, name)
+            if not os.path.exists(destination):
+                try:
+                    os.link(source, destination)
+                except OSError:
+                    shutil.copy2(source, destination)
+            size += os.path.getsize(destination)
+            if name != OUTPUT_INFO:
+                names.append(name)
+
+        with self.lock:
+            self.index[key] = {'files': names, 'size': size, 'query_id': query_id,
+                               'created': time.time(), 'last_used': time.time()}
+            self.evict(keep=key)
+            self.save_index()
+
+        return [os.path.join(target, name) for name in names]
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries until the cache fits into max_bytes, call with the lock held."""
+        total = sum(entry['size'] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.index.pop(key)['size']
+            shutil.rmtree(os.path.join(self.folder, key), ignore_errors=True)
+
+    def report(self):
+        """
+        Returns the hit/miss counters of this session and the size of the cache.
+
+        Returns:
+            dict: hits, misses, hit ratio, number of entries and size in bytes.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                'entries': len(self.index),
+                'bytes': sum(entry['size'] for entry in self.index.values()),
+            }
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+***************************************************************************
+Name			 	 : IBM Geospatial APIs QGIS Plugin
+Description          : Prepares the catalog data sets and data layers for the
+                       catalog viewer of the IBM Geospatial APIs dialog.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import numpy as np
+import pandas as pd
+
+# Positions within a layer record as produced by catalog_records
+DSET_LONG, LAYER_ID, LAYER_NAME, LEVEL, UNIT, LAYER_DESC = range(6)
+
+# Resolution of each data layer level
+LEVELS = {29:"12cm",28:"23cm",27:"45cm",26:"1m",25:"2m",24:"4m",23:"8m",22:"15m",21:"29m",20:"57m",19:"114m",18:"228m",17:"456m",16:"912m",15:"2km",14:"4km",
+          13:"8km",12:"15km",11:"30km",10:"59km",9:"117km",8:"234km",7:"467km",6:"934km",5:"1867km",4:"3733km",3:"7466km",2:"14932km",1:"29864km"}
+
+
+def merge_catalog(cat_dset, cat_layers):
+    """
+    Joins the data sets and data layers of the catalog.
+
+    Args:
+        cat_dset (dict): The parsed data_sets.json.
+        cat_layers (dict): The parsed data_layers.json.
+
+    Returns:
+        pandas.DataFrame: One row per data layer (and per data set without layers), sorted by data set and layer id.
+    """
+    dsetl = pd.DataFrame(cat_dset["data_sets"])
+    layersl = pd.DataFrame(cat_layers["data_layers"])
+    cat = pd.merge(dsetl, layersl, how="left", left_on='id', right_on='dataset_id', suffixes=('_dset', '_layer'))
+    return cat.sort_values(by=['id_dset', 'id_layer'])
+
+
+def catalog_records(cat):
+    """
+    Turns the merged catalog into the records shown in the catalog viewer.
+
+    All clean up is done with column operations: missing data set names fall back to the data set
+    name, missing descriptions become empty strings, levels are mapped to resolutions and layer
+    descriptions are reduced to ASCII. The rows are then grouped by data set name, keeping the
+    order of the merged catalog.
+
+    Args:
+        cat (pandas.DataFrame): The merged catalog as returned by merge_catalog.
+
+    Returns:
+        dict: Data set name -> list of [data set description, layer id, layer name, resolution,
+        units, layer description] records.
+    """
+    cat = cat[cat["id_layer"].notna()]  # Data sets without layers (bad join)
+
+    frame = pd.DataFrame({
+        "dset": cat["data_source_name_dset"].fillna(cat["name_dset"]).astype(str),
+        "dsetlong": cat["description_long_dset"].fillna("").astype(str),
+        "layerid": cat["id_layer"].astype(str),
+        "layer_name": cat["name_layer"].astype(str),
+        "level": cat["level_layer"].map(LEVELS).fillna("None"),
+        "unit": cat["units"].fillna("unknown"),
+        # Special case to jeterson unicode in description field
+        "layer_desc": cat["description_long_layer"].fillna("").astype(str).str.encode("ascii", "ignore").str.decode("ascii"),
+    })
+
+    if frame.empty:
+        return {}
+
+    # Group by data set name in order of first appearance: a stable sort on the factorized
+    # names keeps the rows of each data set in catalog order
+    codes, names = pd.factorize(frame["dset"], sort=False)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.cumsum(np.bincount(codes, minlength=len(names)))[:-1]
+    values = frame.drop(columns="dset").to_numpy()[order].tolist()
+    starts = np.concatenate(([0], bounds)).tolist()
+    ends = bounds.tolist() + [len(values)]
+    return {name: values[start:end] for name, start, end in zip(names, starts, ends)}
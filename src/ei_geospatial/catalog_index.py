@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+***************************************************************************
+Name			 	 : IBM Geospatial APIs QGIS Plugin
+Description          : Inverted token index for the catalog search of the IBM
+                       Geospatial APIs dialog.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import array
+import bisect
+import re
+
+from .catalog_data import DSET_LONG, LAYER_ID, LAYER_NAME, UNIT, LAYER_DESC
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+# Number of recent term lookups kept, typing a word looks up every prefix of it
+TERM_CACHE_SIZE = 64
+
+
+def tokenize(text):
+    """Returns the lowercase alphanumeric tokens of a text."""
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+class CatalogIndex(object):
+    """
+    Inverted index from tokens to the catalog layers they occur in.
+
+    Every layer is a document made of its id, name, description and units and the name and
+    description of its dataset. A query matches the layers that contain, for every term of the
+    query, a token starting with that term, so "sentinel ndvi" finds layers that mention both and
+    "temp" finds "temperature".
+
+    The postings are stored flat: ``docs[offsets[i]:offsets[i + 1]]`` are the documents of
+    ``vocabulary[i]``. As the vocabulary is sorted, all tokens starting with a prefix are
+    neighbours, so the documents of a prefix are a single slice found with two binary searches.
+    The index is persisted as part of the catalog snapshot, see catalog_snapshot.
+    """
+
+    def __init__(self, layer_ids=None, vocabulary=None, offsets=None, docs=None):
+        self.layer_ids = layer_ids or []
+        self.vocabulary = vocabulary or []
+        self.offsets = offsets if offsets is not None else array.array('I', [0])
+        self.docs = docs if docs is not None else array.array('I')
+        self.term_cache = {}
+
+    @classmethod
+    def build(cls, data):
+        """
+        Indexes the catalog records.
+
+        Args:
+            data (dict): Dataset name -> list of layer records, as returned by catalog_data.catalog_records.
+
+        Returns:
+            CatalogIndex: The index.
+        """
+        layer_ids = []
+        postings = {}
+        for dataset, records in data.items():
+            dataset_tokens = set(tokenize(dataset))
+            if records:
+                dataset_tokens.update(tokenize(records[0][DSET_LONG]))
+            for record in records:
+                doc = len(layer_ids)
+                layer_ids.append(str(record[LAYER_ID]))
+                tokens = set(dataset_tokens)
+                for field in (LAYER_ID, LAYER_NAME, UNIT, LAYER_DESC):
+                    tokens.update(tokenize(record[field]))
+                for token in tokens:
+                    postings.setdefault(token, []).append(doc)
+
+        vocabulary = sorted(postings)
+        offsets = array.array('I', [0])
+        docs = array.array('I')
+        for token in vocabulary:
+            docs.extend(postings[token])
+            offsets.append(len(docs))
+        return cls(layer_ids, vocabulary, offsets, docs)
+
+    def term(self, prefix):
+        """Returns the set of documents with a token starting with prefix."""
+        docs = self.term_cache.get(prefix)
+        if docs is not None:
+            return docs
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = bisect.bisect_left(self.vocabulary, prefix + '\uffff', lo=start)
+        docs = frozenset(self.docs[self.offsets[start]:self.offsets[end]])
+        if len(self.term_cache) >= TERM_CACHE_SIZE:
+            self.term_cache.pop(next(iter(self.term_cache)))
+        self.term_cache[prefix] = docs
+        return docs
+
+    def search(self, text):
+        """
+        Finds the layers matching all terms of a query.
+
+        Args:
+            text (str): The query, terms are separated by anything but letters and digits.
+
+        Returns:
+            frozenset: The positions of the matching layers in catalog order (see layer_ids), None if
+            the query has no terms and everything matches.
+        """
+        terms = set(tokenize(text))
+        if not terms:
+            return None
+        # Intersect starting from the smallest set so every step only walks the remaining matches
+        matches = sorted((self.term(term) for term in terms), key=len)
+        docs = matches[0]
+        for other in matches[1:]:
+            if not docs:
+                break
+            docs = docs & other
+        return docs
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+***************************************************************************
+Name			 	 : IBM Geospatial APIs QGIS Plugin
+Description          : Lazy tree model for the catalog viewer of the IBM
+                       Geospatial APIs dialog.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.PyQt import QtCore
+
+from .catalog_data import DSET_LONG, LAYER_ID, LAYER_NAME, LEVEL, UNIT, LAYER_DESC
+
+HEADERS = ['Dataset', 'Layer id', 'Layer name', 'Resolution', 'Units']
+
+
+class CatalogTreeModel(QtCore.QAbstractItemModel):
+    """
+    A two level dataset -> layer tree over the records produced by catalog_data.catalog_records.
+
+    No item objects are created: the model reads straight from a compact index of dataset names
+    and layer record tuples. Layer rows of a dataset are only announced to the view when the
+    dataset is expanded (canFetchMore/fetchMore), so opening the dialog only costs one row per
+    dataset.
+
+    Top level indexes carry internal id 0, layer indexes carry the row of their dataset + 1.
+    """
+
+    def __init__(self, data=None, parent=None):
+        super(CatalogTreeModel, self).__init__(parent)
+        self.datasets = []
+        self.layers = []
+        self.fetched = []
+        self.offsets = []
+        self.dataset_of = []
+        self.set_data(data or {})
+
+    def set_data(self, data):
+        """
+        Replaces the catalog shown by the model.
+
+        Args:
+            data (dict): Dataset name -> list of layer records, as IBMPairsDialog.data.
+        """
+        self.beginResetModel()
+        self.datasets = list(data.keys())
+        self.layers = [tuple(tuple(record) for record in data[name]) for name in self.datasets]
+        self.fetched = [0] * len(self.datasets)
+        # Catalog order position of the first layer of every dataset and the dataset row of every position,
+        # the positions are the ones used by the catalog index
+        self.offsets = []
+        self.dataset_of = []
+        for row, layers in enumerate(self.layers):
+            self.offsets.append(len(self.dataset_of))
+            self.dataset_of.extend([row] * len(layers))
+        self.endResetModel()
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QtCore.QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column, 0)
+        return self.createIndex(row, column, parent.row() + 1)
+
+    def parent(self, index):
+        if not index.isValid() or index.internalId() == 0:
+            return QtCore.QModelIndex()
+        return self.createIndex(index.internalId() - 1, 0, 0)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if not parent.isValid():
+            return len(self.datasets)
+        if parent.internalId() == 0 and parent.column() == 0:
+            return self.fetched[parent.row()]
+        return 0
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(HEADERS)
+
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        if not parent.isValid():
+            return len(self.datasets) > 0
+        if parent.internalId() == 0 and parent.column() == 0:
+            return len(self.layers[parent.row()]) > 0
+        return False
+
+    def canFetchMore(self, parent):
+        if not parent.isValid() or parent.internalId() != 0:
+            return False
+        return self.fetched[parent.row()] < len(self.layers[parent.row()])
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        row = parent.row()
+        self.beginInsertRows(parent, self.fetched[row], len(self.layers[row]) - 1)
+        self.fetched[row] = len(self.layers[row])
+        self.endInsertRows()
+
+    def flags(self, index):
+        if not index.isValid():
+            return QtCore.Qt.NoItemFlags
+        return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return HEADERS[section]
+        return None
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role not in (QtCore.Qt.DisplayRole, QtCore.Qt.ToolTipRole):
+            return None
+
+        if index.internalId() == 0:
+            if index.column() != 0:
+                return None
+            if role == QtCore.Qt.DisplayRole:
+                return self.datasets[index.row()]
+            layers = self.layers[index.row()]
+            return layers[0][DSET_LONG] if layers else None
+
+        record = self.layers[index.internalId() - 1][index.row()]
+        column = index.column()
+        if role == QtCore.Qt.ToolTipRole:
+            return record[LAYER_DESC] if column == 2 else None
+        if column == 1:
+            return str(record[LAYER_ID])
+        if column == 2:
+            return record[LAYER_NAME]
+        if column == 3:
+            return record[LEVEL]
+        if column == 4:
+            return record[UNIT]
+        return None
+
+    def layer_id(self, index):
+        """Returns the layer id of a layer row, None for dataset rows."""
+        if not index.isValid() or index.internalId() == 0:
+            return None
+        return str(self.layers[index.internalId() - 1][index.row()][LAYER_ID])
+
+
+class CatalogFilterModel(QtCore.QSortFilterProxyModel):
+    """
+    Shows the layers of a CatalogTreeModel whose catalog position is in a set of search matches,
+    and the datasets that contain at least one of them.
+
+    The source model is built once; changing the matches only re-evaluates the dataset rows and
+    the layer rows that were already fetched, and rows that stay visible keep their expansion
+    and selection.
+    """
+
+    def __init__(self, parent=None):
+        super(CatalogFilterModel, self).__init__(parent)
+        self.matches = None
+        self.matching_datasets = None
+
+    def set_matches(self, matches):
+        """
+        Filters the catalog.
+
+        Args:
+            matches (frozenset): Catalog positions of the layers to show, None to show everything.
+        """
+        self.matches = matches
+        if matches is None:
+            self.matching_datasets = None
+        else:
+            dataset_of = self.sourceModel().dataset_of
+            self.matching_datasets = {dataset_of[position] for position in matches}
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        if self.matches is None:
+            return True
+        if not source_parent.isValid():
+            return source_row in self.matching_datasets
+        return self.sourceModel().offsets[source_parent.row()] + source_row in self.matches
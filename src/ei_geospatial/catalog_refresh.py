@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+***************************************************************************
+Name			 	 : IBM Geospatial APIs QGIS Plugin
+Description          : Background refresh of the catalog files used by the
+                       catalog viewer of the IBM Geospatial APIs dialog.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import json
+import os
+import time
+
+import ibmpairs.catalog as catalog
+import ibmpairs.client as client
+import ibmpairs.constants as constants
+from qgis.core import QgsMessageLog, Qgis
+
+from .catalog_snapshot import load_catalog
+from .session import request
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+DATA_SETS_FILE = 'data_sets.json'
+DATA_LAYERS_FILE = 'data_layers.json'
+# Fetch time and validators of every catalog file
+STATE_FILE = 'catalog_state.json'
+# Above this share of changed data sets all data layers are fetched in one request instead of per data set
+DELTA_LIMIT = 0.25
+
+
+def load_state(folder):
+    try:
+        with open(os.path.join(folder, STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(folder, state):
+    path = os.path.join(folder, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def write_json(path, content):
+    """Replaces a catalog file in one step, so the dialog never reads a half written file."""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(content, f)
+    os.replace(path + '.tmp', path)
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_stale(path, entry, max_age):
+    """
+    Returns whether a catalog file has to be fetched again.
+
+    Args:
+        path (str): The catalog file.
+        entry (dict): Its entry in the refresh state, the file modification time is used if there is none.
+        max_age (float): Seconds after which a file is refreshed.
+
+    Returns:
+        bool: True if the file is missing or older than max_age.
+    """
+    if not os.path.isfile(path):
+        return True
+    fetched_at = (entry or {}).get('fetched_at') or os.path.getmtime(path)
+    return time.time() - fetched_at > max_age
+
+
+def fetch_data_sets(entry, cli=None, verify=constants.GLOBAL_SSL_VERIFY):
+    """
+    Fetches the data sets, conditional on the validators of the previous fetch.
+
+    Args:
+        entry (dict): The refresh state of data_sets.json, its ETag and Last-Modified are sent along.
+        cli (ibmpairs.client.Client): The client to use, defaults to the global client.
+        verify (bool): SSL verification.
+
+    Returns:
+        tuple: The data sets as written by ibmpairs ({"data_sets": [...]}) or None if the server
+        reports them as not modified, and the updated state entry.
+    """
+    cli = cli or client.GLOBAL_PAIRS_CLIENT
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    response = request(cli, 'GET', cli.get_host() + constants.CATALOG_DATA_SETS_API_FULL, headers=headers,
+                       verify=verify, timeout=120)
+    entry = dict(entry, fetched_at=time.time())
+    if response.status_code == 304:
+        return None, entry
+    if response.status_code != 200:
+        raise Exception('Fetching the data sets failed with HTTP status {}'.format(response.status_code))
+    entry['etag'] = response.headers.get('ETag')
+    entry['last_modified'] = response.headers.get('Last-Modified')
+    return catalog.DataSets.from_dict(response.json()).to_dict(), entry
+
+
+def changed_data_sets(old, new):
+    """
+    Compares two versions of the data sets by their update time, or by their content if either
+    version has no update time.
+
+    Returns:
+        tuple: The ids of new or updated data sets and the ids of removed data sets.
+    """
+    before = {str(d.get('id')): d for d in (old or {}).get('data_sets', [])}
+    after = {str(d.get('id')): d for d in new.get('data_sets', [])}
+    changed = []
+    for i, data_set in after.items():
+        previous = before.get(i)
+        if previous is None:
+            changed.append(i)
+        elif previous.get('updated_at') is None or data_set.get('updated_at') is None:
+            if previous != data_set:
+                changed.append(i)
+        elif previous['updated_at'] != data_set['updated_at']:
+            changed.append(i)
+    removed = [i for i in before if i not in after]
+    return changed, removed
+
+
+def refresh_catalog(task, folder, max_age, force=False):
+    """
+    Brings the catalog files up to date, runs in a background thread.
+
+    Each file has its own freshness in the refresh state. The data sets are fetched with a
+    conditional request; data layers are then only fetched for the data sets that are new or
+    whose update time changed, and dropped for removed data sets. The full data layer list is
+    fetched if there is none yet, too many data sets changed, or the data layers are stale while
+    the server reports the data sets as not modified, as there is no delta to bring them up to
+    date then. Files are only rewritten if their content changed, and the catalog snapshot is
+    rebuilt here so the dialog can swap in the new catalog without parsing the json on the main
+    thread.
+
+    Args:
+        task (QgsTask): The task running the refresh.
+        folder (str): The folder holding the catalog files.
+        max_age (float): Seconds after which a file is refreshed.
+        force (bool): Refresh regardless of the age of the files.
+
+    Returns:
+        dict: Whether the catalog changed and what was fetched.
+    """
+    dsets_path = os.path.join(folder, DATA_SETS_FILE)
+    layer_path = os.path.join(folder, DATA_LAYERS_FILE)
+    state = load_state(folder)
+    sets_entry = state.get(DATA_SETS_FILE, {})
+    layers_entry = state.get(DATA_LAYERS_FILE, {})
+    result = {'changed': False, 'data_sets_fetched': False, 'data_layer_requests': 0, 'full_layers': False}
+
+    sets_stale = force or is_stale(dsets_path, sets_entry, max_age)
+    layers_stale = force or is_stale(layer_path, layers_entry, max_age)
+    if not sets_stale and not layers_stale:
+        return result
+
+    old_sets = read_json(dsets_path)
+    old_layers = read_json(layer_path)
+    if not os.path.isfile(dsets_path):
+        sets_entry = {}  # Validators of a file that is gone are of no use
+
+    new_sets, sets_entry = fetch_data_sets(sets_entry)
+    result['data_sets_fetched'] = new_sets is not None
+    if new_sets is None:
+        new_sets = old_sets
+    elif new_sets != old_sets:
+        write_json(dsets_path, new_sets)
+        result['changed'] = True
+    state[DATA_SETS_FILE] = sets_entry
+    task.setProgress(20)
+
+    changed, removed = changed_data_sets(old_sets, new_sets)
+    total = max(len(new_sets.get('data_sets', [])), 1)
+    if old_layers is None or len(changed) > DELTA_LIMIT * total or (layers_stale and not result['data_sets_fetched']):
+        layers = catalog.get_data_layers().to_dict()
+        result['full_layers'] = True
+        result['data_layer_requests'] = 1
+    else:
+        skip = set(changed) | set(removed)
+        kept = [layer for layer in old_layers.get('data_layers', []) if str(layer.get('dataset_id')) not in skip]
+        for n, data_set_id in enumerate(changed):
+            if task.isCanceled():
+                return None
+            for layer in catalog.get_data_layers(data_set_id=data_set_id).to_dict().get('data_layers', []):
+                if layer.get('dataset_id') is None:
+                    layer['dataset_id'] = data_set_id
+                kept.append(layer)
+            result['data_layer_requests'] += 1
+            task.setProgress(20 + 70.0 * (n + 1) / len(changed))
+        layers = dict(old_layers, data_layers=kept)
+
+    if layers != old_layers:
+        write_json(layer_path, layers)
+        result['changed'] = True
+    state[DATA_LAYERS_FILE] = dict(layers_entry, fetched_at=time.time())
+    save_state(folder, state)
+
+    if result['changed']:
+        # Rebuilds the snapshot for the new files
+        load_catalog(dsets_path, layer_path)
+    task.setProgress(100)
+    return result
+
+
+def log_refresh(exception, result=None):
+    """Logs the outcome of a refresh_catalog task."""
+    if exception is not None:
+        QgsMessageLog.logMessage('Catalog refresh failed, the cached catalog is used: {}'.format(exception), MESSAGE_CATEGORY, Qgis.Warning)
+    elif result is None:
+        QgsMessageLog.logMessage('Catalog refresh cancelled', MESSAGE_CATEGORY, Qgis.Info)
+    elif not result['data_sets_fetched'] and not result['data_layer_requests']:
+        QgsMessageLog.logMessage('Catalog is up to date', MESSAGE_CATEGORY, Qgis.Info)
+    else:
+        QgsMessageLog.logMessage('Catalog refreshed ({}, {} data layer request(s){})'.format(
+            'changed' if result['changed'] else 'unchanged', result['data_layer_requests'],
+            ', full' if result['full_layers'] else ''), MESSAGE_CATEGORY, Qgis.Info)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+***************************************************************************
+Name			 	 : IBM Geospatial APIs QGIS Plugin
+Description          : Pre-joined snapshot of the catalog so the IBM Geospatial
+                       APIs dialog opens without parsing and merging the json.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import array
+import json
+import os
+import sys
+
+from .catalog_data import catalog_records, merge_catalog
+from .catalog_index import CatalogIndex
+
+# Bumped whenever the records, the index or the file layout change
+SNAPSHOT_VERSION = 2
+SNAPSHOT_FILE = 'catalog_snapshot.bin'
+
+
+def source_signature(paths):
+    """Returns the size and modification time of the catalog files a snapshot is built from."""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+        except OSError:
+            signature.append([os.path.basename(path), None, None])
+    return signature
+
+
+def load_snapshot(path, signature):
+    """
+    Reads a snapshot written by save_snapshot.
+
+    The file is a line of json with the records, the vocabulary and the layer ids, followed by the
+    raw offsets and docs arrays of the index. Nothing in it is executed when it is read, unlike a
+    pickle, so a snapshot in a shared or writable folder can at most yield a wrong catalog.
+
+    Args:
+        path (str): The snapshot file.
+        signature (list): The source_signature of the catalog files the snapshot must match.
+
+    Returns:
+        tuple: The catalog records and the CatalogIndex, None if the snapshot is missing, outdated or unreadable.
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline().decode('utf-8'))
+            if (not isinstance(header, dict) or header.get('version') != SNAPSHOT_VERSION or header.get('source') != signature
+                    or header.get('byteorder') != sys.byteorder):
+                return None
+            offsets = array.array('I')
+            docs = array.array('I')
+            if header.get('itemsize') != offsets.itemsize:
+                return None
+            offsets.frombytes(f.read(header['offsets'] * offsets.itemsize))
+            docs.frombytes(f.read(header['docs'] * docs.itemsize))
+    except Exception:
+        return None
+    if len(offsets) != header['offsets'] or len(docs) != header['docs']:
+        return None  # Truncated
+    return header['data'], CatalogIndex(header['layer_ids'], header['vocabulary'], offsets, docs)
+
+
+def save_snapshot(path, signature, data, index):
+    """
+    Writes the catalog records and their index next to the catalog files.
+
+    Args:
+        path (str): The snapshot file.
+        signature (list): The source_signature of the catalog files the records were read from.
+        data (dict): Dataset name -> list of layer records, as returned by catalog_records.
+        index (CatalogIndex): The index of the records.
+    """
+    header = {'version': SNAPSHOT_VERSION, 'source': signature, 'byteorder': sys.byteorder,
+              'itemsize': index.docs.itemsize, 'offsets': len(index.offsets), 'docs': len(index.docs),
+              'data': data, 'layer_ids': index.layer_ids, 'vocabulary': index.vocabulary}
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        # ensure_ascii keeps the header on one line whatever the descriptions contain
+        f.write(json.dumps(header, separators=(',', ':')).encode('utf-8'))
+        f.write(b'\n')
+        index.offsets.tofile(f)
+        index.docs.tofile(f)
+    os.replace(tmp, path)
+
+
+def load_catalog(dsets_path, layer_path, snapshot_path=None):
+    """
+    Returns the catalog records and their search index.
+
+    The snapshot next to the catalog files is used while the size and modification time of both
+    files match the ones it was built from; otherwise the json is parsed, merged and indexed again
+    and the snapshot is rewritten.
+
+    Args:
+        dsets_path (str): The data_sets.json written at login.
+        layer_path (str): The data_layers.json written at login.
+        snapshot_path (str): The snapshot file, defaults to catalog_snapshot.bin in the folder of the data sets.
+
+    Returns:
+        tuple: Dataset name -> list of layer records, and the CatalogIndex. Both are empty until
+        the catalog files have been fetched for the first time.
+    """
+    if not os.path.isfile(dsets_path) or not os.path.isfile(layer_path):
+        return {}, CatalogIndex()
+
+    snapshot_path = snapshot_path or os.path.join(os.path.dirname(dsets_path), SNAPSHOT_FILE)
+    signature = source_signature([dsets_path, layer_path])
+    snapshot = load_snapshot(snapshot_path, signature)
+    if snapshot is not None:
+        return snapshot
+
+    with open(dsets_path, "r") as f:
+        cat_dset = json.load(f)
+    with open(layer_path, "r") as f:
+        cat_layers = json.load(f)
+    data = catalog_records(merge_catalog(cat_dset, cat_layers))
+    index = CatalogIndex.build(data)
+    try:
+        save_snapshot(snapshot_path, signature, data, index)
+    except OSError:
+        pass  # A read-only plugin folder only costs rebuilding the snapshot on the next start
+    return data, index
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Command line runner of the query engine, for nightly
+                       bulk pulls without the QGIS user interface.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Runs every query json in a folder through the query engine and writes the styled results, a .qml
+style next to every result file and a QGIS project with a layer group per query:
+
+    python -m ei_geospatial.cli QUERY_FOLDER --output RESULT_FOLDER [--project FILE]
+
+Run it with the Python of a QGIS installation and the plugins folder on the PYTHONPATH. The
+credentials are read from the EIS_API_KEY, EIS_TENANT_ID and EIS_ORG_ID environment variables.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+from qgis.PyQt.QtCore import QEventLoop, QTimer
+from qgis.core import QgsApplication, QgsProject, Qgis
+
+from .engine import QueryEngine
+from .layer_style import save_style_sidecar
+from .session import environment_client
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+# Milliseconds between two checks whether all queries are done
+CHECK_INTERVAL_MS = 1000
+LEVELS = {Qgis.Info: 'INFO', Qgis.Warning: 'WARNING', Qgis.Critical: 'CRITICAL'}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ei_geospatial.cli',
+                                     description='Runs the Geospatial APIs queries of a folder of query json files.')
+    parser.add_argument('queries', help='Folder of query json files, each holds a query or a list of queries.')
+    parser.add_argument('--output', help='Folder the results are downloaded to, a subfolder per query file. '
+                                         'Defaults to a results folder in the query folder.')
+    parser.add_argument('--project', help='QGIS project written once all queries are done. Defaults to results.qgz in the output folder.')
+    parser.add_argument('--max-concurrent', type=int, help='Queries running at once, defaults to the plugin setting.')
+    parser.add_argument('--submit-interval', type=float, default=0.0, help='Minimum seconds between two submissions.')
+    parser.add_argument('--timeout', type=float, default=24.0, help='Hours after which the run is given up.')
+    parser.add_argument('--resume', action='store_true', help='Also download the unfinished queries of the job journal.')
+    parser.add_argument('--state-folder', default=os.path.dirname(__file__),
+                        help='Folder of the caches and the job journal, defaults to the plugin folder shared with QGIS.')
+    return parser.parse_args(argv)
+
+
+def read_queries(folder):
+    """
+    Reads the query files of a folder.
+
+    Args:
+        folder (str): The folder of the query json files.
+
+    Returns:
+        list: (name, queries) tuples in file name order, the name is the file name without extension.
+    """
+    query_files = []
+    for path in sorted(glob.glob(os.path.join(folder, '*.json'))):
+        try:
+            with open(path) as f:
+                content = json.load(f)
+        except (OSError, ValueError) as e:
+            log('{} is skipped, it could not be read: {}'.format(path, e), Qgis.Warning)
+            continue
+        query_files.append((os.path.splitext(os.path.basename(path))[0], content if isinstance(content, list) else [content]))
+    return query_files
+
+
+def log(message, level=Qgis.Info):
+    print('{} {}: {}'.format(time.strftime('%H:%M:%S'), LEVELS.get(level, level), message), flush=True)
+
+
+def print_message(message, tag, level):
+    """Prints the plugin's messages of the QGIS message log."""
+    if tag == MESSAGE_CATEGORY:
+        log(message, level)
+
+
+def run(args):
+    """
+    Runs the queries of a folder until they are all imported or the timeout is reached.
+
+    Returns:
+        int: The exit code, 0 if every query succeeded, 1 if some failed and 2 if nothing could be run.
+    """
+    query_files = read_queries(args.queries)
+    if not query_files:
+        log('No query files found in {}'.format(args.queries), Qgis.Critical)
+        return 2
+    cli = environment_client()
+    if cli is None:
+        log('Set EIS_API_KEY, EIS_TENANT_ID and EIS_ORG_ID to log in', Qgis.Critical)
+        return 2
+
+    output = args.output or os.path.join(args.queries, 'results')
+    project_path = args.project or os.path.join(output, 'results.qgz')
+    project = QgsProject()
+    engine = QueryEngine(args.state_folder, project=project, max_concurrent=args.max_concurrent,
+                         submit_interval=args.submit_interval)
+    report = {'queries': 0, 'failed': 0, 'imports_failed': 0, 'layers': 0, 'styles': 0}
+    # Split queries with a failed chunk or mosaic, counted once however many of their chunks failed
+    failed_groups = set()
+
+    def imported(name, layers):
+        report['layers'] += len(layers)
+        report['styles'] += sum(1 for loaded in layers if save_style_sidecar(loaded.layer) is not None)
+
+    def failed(record):
+        if record.group is None:
+            report['failed'] += 1
+        else:
+            failed_groups.add(record.group.key)
+
+    def import_failed(name, error):
+        report['imports_failed'] += 1
+
+    engine.imported.connect(imported)
+    engine.import_failed.connect(import_failed)
+    engine.pipeline.failed.connect(failed)
+    engine.pipeline.mosaic_failed.connect(lambda group: failed_groups.add(group.key))
+    if args.resume:
+        engine.pipeline.resume()
+    for name, queries in query_files:
+        report['queries'] += len(queries)
+        engine.run_queries(queries, os.path.join(output, name))
+
+    # Tasks report back through the event loop, it runs until the engine is idle
+    loop = QEventLoop()
+    deadline = time.monotonic() + args.timeout * 3600
+    timer = QTimer()
+    timer.timeout.connect(lambda: loop.quit() if not engine.busy() or time.monotonic() > deadline else None)
+    timer.start(CHECK_INTERVAL_MS)
+    loop.exec_()
+    timer.stop()
+
+    timed_out = engine.busy()
+    report['failed'] += len(failed_groups)
+    if timed_out:
+        log('Timed out after {} hours, the unfinished queries stay in the job journal'.format(args.timeout), Qgis.Critical)
+    engine.close()
+    cli.close()
+
+    os.makedirs(os.path.dirname(os.path.abspath(project_path)), exist_ok=True)
+    if not project.write(project_path):
+        log('The project {} could not be written: {}'.format(project_path, project.error()), Qgis.Critical)
+        return 1
+    log('{} queries, {} failed, {} imports failed; {} layers with {} styles written to {}'.format(
+        report['queries'], report['failed'], report['imports_failed'], report['layers'], report['styles'], project_path))
+    return 1 if report['failed'] or report['imports_failed'] or timed_out else 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Inside QGIS or qgis_process the running application is used
+    app = QgsApplication.instance()
+    standalone = app is None
+    if standalone:
+        app = QgsApplication([], False)
+        app.initQgis()
+    QgsApplication.messageLog().messageReceived.connect(print_message)
+    try:
+        return run(args)
+    finally:
+        QgsApplication.messageLog().messageReceived.disconnect(print_message)
+        if standalone:
+            app.exitQgis()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
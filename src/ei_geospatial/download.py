@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Streaming, resumable download of query results.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import base64
+import hashlib
+import os
+import re
+import time
+import zipfile
+
+import requests
+import ibmpairs.client as client
+import ibmpairs.constants as constants
+from qgis.core import QgsMessageLog, Qgis
+
+from .session import request
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+CHUNK_SIZE = 1024 * 1024
+# Number of times a dropped download is resumed before giving up
+MAX_ATTEMPTS = 5
+# Seconds between two progress messages in the log
+PROGRESS_INTERVAL = 5.0
+# Seconds to wait for the server to send data before the connection is considered dropped
+READ_TIMEOUT = 300
+
+
+class DownloadCanceled(Exception):
+    """Raised when the task running a download is cancelled; the partial file is kept for resuming."""
+
+
+def total_size(response, offset):
+    """Returns the full size of the file being downloaded from a (partial) response, None if unknown."""
+    content_range = response.headers.get('Content-Range')
+    if content_range:
+        match = re.match(r'bytes \d+-\d+/(\d+)', content_range)
+        if match:
+            return int(match.group(1))
+    if response.headers.get('Content-Length') is not None:
+        return offset + int(response.headers['Content-Length'])
+    return None
+
+
+def expected_md5(response):
+    """Returns the MD5 hex digest announced by the server through Content-MD5 or a plain MD5 ETag, if any."""
+    content_md5 = response.headers.get('Content-MD5')
+    if content_md5:
+        try:
+            return base64.b64decode(content_md5).hex()
+        except ValueError:
+            return None
+    etag = (response.headers.get('ETag') or '').strip('"')
+    if re.match(r'^[0-9a-fA-F]{32}$', etag):
+        return etag.lower()
+    return None
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def stream_download(ibmpairs_query, task=None, cli=None, verify=constants.GLOBAL_SSL_VERIFY):
+    """
+    Downloads and unzips the result of a succeeded query in chunks.
+
+    The zip is streamed into a ``.part`` file next to its final location. If the connection
+    drops, the download is resumed from the last byte written with an HTTP Range request, also
+    across tasks as the ``.part`` file is kept. The size is checked against the size announced by
+    the server, the MD5 against Content-MD5 or ETag if the server sends one, and the CRC of every
+    member of the zip is tested before it is extracted into the same folder ibmpairs would use, so
+    ``query.list_files()`` works as after ``query.download()``.
+
+    Args:
+        ibmpairs_query (ibmpairs.query.Query): A query with status 20.
+        task (QgsTask): The task running the download, used for progress and cancellation.
+        cli (ibmpairs.client.Client): The client to use, defaults to the query's or the global client.
+        verify (bool): SSL verification.
+
+    Returns:
+        str: The folder the result was extracted to.
+
+    Raises:
+        DownloadCanceled: If the task was cancelled.
+        Exception: If the download failed or the file is corrupt.
+    """
+    cli = cli or ibmpairs_query.client or client.GLOBAL_PAIRS_CLIENT
+    url = cli.get_host() + constants.QUERY_JOBS_API + str(ibmpairs_query.id) + constants.QUERY_JOBS_DOWNLOAD_API
+
+    folder = os.path.join(ibmpairs_query.download_folder or constants.QUERY_DOWNLOAD_DEFAULT_FOLDER, '')
+    os.makedirs(folder, exist_ok=True)
+    target = folder + str(ibmpairs_query.id)
+    zip_path = target + '.zip'
+    part_path = zip_path + '.part'
+
+    attempt = 0
+    while True:
+        attempt += 1
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        try:
+            # A token that expired while the query was running is refreshed by the client's session
+            with request(cli, 'GET', url, headers=headers, verify=verify, stream=True, timeout=(30, READ_TIMEOUT)) as response:
+                if response.status_code == 416:
+                    # The part file already holds the whole file
+                    size, md5 = offset, None
+                    break
+                if response.status_code not in (200, 206):
+                    raise Exception('{} download failed with HTTP status {}'.format(ibmpairs_query.id, response.status_code))
+                if response.status_code == 200:
+                    # The server ignored the Range header, start over
+                    offset = 0
+
+                size = total_size(response, offset)
+                md5 = expected_md5(response) if offset == 0 else None
+                written = offset
+                started = time.monotonic()
+                last_report = started
+
+                with open(part_path, 'ab' if offset else 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        if task is not None and task.isCanceled():
+                            raise DownloadCanceled('{} download cancelled at {} bytes'.format(ibmpairs_query.id, written))
+                        f.write(chunk)
+                        written += len(chunk)
+                        now = time.monotonic()
+                        if task is not None and size:
+                            task.setProgress(100.0 * written / size)
+                        if now - last_report >= PROGRESS_INTERVAL:
+                            last_report = now
+                            rate = (written - offset) / max(now - started, 1e-6)
+                            QgsMessageLog.logMessage('{} downloaded {:.1f} of {} MB ({:.2f} MB/s)'.format(
+                                ibmpairs_query.id, written / 1048576.0, '{:.1f}'.format(size / 1048576.0) if size else '?',
+                                rate / 1048576.0), MESSAGE_CATEGORY, Qgis.Info)
+            break
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt >= MAX_ATTEMPTS:
+                raise Exception('{} download failed after {} attempts: {}'.format(ibmpairs_query.id, attempt, e))
+            QgsMessageLog.logMessage('{} download interrupted, resuming ({}/{}): {}'.format(ibmpairs_query.id, attempt, MAX_ATTEMPTS, e), MESSAGE_CATEGORY, Qgis.Warning)
+            time.sleep(min(2 ** attempt, 30))
+
+    # Verify before replacing any previous download
+    actual = os.path.getsize(part_path)
+    if size is not None and actual != size:
+        os.remove(part_path)
+        raise Exception('{} download is {} bytes, expected {}'.format(ibmpairs_query.id, actual, size))
+    if md5 is not None and file_md5(part_path) != md5:
+        os.remove(part_path)
+        raise Exception('{} download checksum does not match'.format(ibmpairs_query.id))
+    if not zipfile.is_zipfile(part_path):
+        os.remove(part_path)
+        raise Exception('{} download is not a zip file'.format(ibmpairs_query.id))
+    with zipfile.ZipFile(part_path) as z:
+        corrupt = z.testzip()
+    if corrupt is not None:
+        os.remove(part_path)
+        raise Exception('{} download is corrupt, CRC check failed for {}'.format(ibmpairs_query.id, corrupt))
+
+    os.replace(part_path, zip_path)
+    with zipfile.ZipFile(zip_path) as z:
+        z.extractall(target)
+
+    ibmpairs_query.download_folder = folder
+    ibmpairs_query.download_file_name = str(ibmpairs_query.id)
+    ibmpairs_query.download_status = 'SUCCEEDED'
+    if task is not None:
+        task.setProgress(100.0)
+
+    return target
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : GUI-free query engine: submit, poll, download, import
+                       and style query results without dialogs or iface.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import datetime
+import os
+import time
+from functools import partial
+from pathlib import Path
+
+from qgis.PyQt.QtCore import QObject, pyqtSignal
+from qgis.core import QgsApplication, QgsMessageLog, QgsTask, Qgis
+
+from . import settings
+from .cache import ResultCache, query_hash
+from .job_index import JobIndex
+from .journal import JobJournal
+from .layer_import import add_layer_group, load_layers
+from .layer_metadata import LayerMetadataCache
+from .layer_style import LayerStyler
+from .pipeline import COMPLETED, FAILED, QueryPipeline, QueryRecord
+from .polling import MAX_STATUS_ERRORS, RUNNING_STATUS_CODES, SUCCEEDED_STATUS_CODE, backoff_delay
+from .raster_stats import RasterStatsStore
+from .splitting import mosaic_files, split_query
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+# Seconds between two checks for cancellation while a blocking run waits for the backend
+CANCEL_CHECK_INTERVAL = 0.5
+# Layer tree group property holding the ids of the features covered by the result of a fanned out query
+FEATURE_IDS_PROPERTY = 'ei_geospatial/feature_ids'
+
+
+def result_cache(folder):
+    """Returns the local result cache configured in the settings, None if it is disabled."""
+    if not settings.value(settings.CACHE_ENABLED_KEY, settings.DEFAULT_CACHE_ENABLED):
+        return None
+    cache_folder = settings.value(settings.CACHE_FOLDER_KEY, '') or os.path.join(folder, 'cache')
+    max_bytes = settings.value(settings.CACHE_MAX_SIZE_MB_KEY, settings.DEFAULT_CACHE_MAX_SIZE_MB) * 1024 * 1024
+    return ResultCache(cache_folder, max_bytes)
+
+
+def job_index(folder):
+    """Returns the job index configured in the settings, None if it is disabled."""
+    if not settings.value(settings.JOB_INDEX_ENABLED_KEY, settings.DEFAULT_JOB_INDEX_ENABLED):
+        return None
+    index_folder = settings.value(settings.JOB_INDEX_FOLDER_KEY, '') or os.path.join(folder, 'job_index')
+    max_age = settings.value(settings.JOB_INDEX_MAX_AGE_HOURS_KEY, settings.DEFAULT_JOB_INDEX_MAX_AGE_HOURS) * 3600
+    return JobIndex(index_folder, max_age)
+
+
+class NoFeedback(object):
+    """Stands in for the task or feedback of a blocking run without one."""
+
+    def isCanceled(self):
+        return False
+
+    def setProgress(self, progress):
+        pass
+
+
+class QueryEngine(QObject):
+    """
+    The query pipeline of the plugin together with everything it needs to import the results.
+
+    The engine owns the result cache, job index and journal, the layer metadata and statistics
+    stores and the styler, and imports every downloaded result in a background task under a layer
+    group of a project. It uses no dialogs and no iface, so the plugin, the command line runner
+    and the Processing algorithms all run queries through it.
+    """
+
+    # The group name and the LoadedLayers of an imported result
+    imported = pyqtSignal(str, object)
+    # The group name and the error of a result whose import failed
+    import_failed = pyqtSignal(str, str)
+
+    def __init__(self, folder, project=None, auto_import=True, max_concurrent=None, submit_interval=0.0):
+        """
+        Args:
+            folder (str): The folder the caches, stores and journal are kept in.
+            project (QgsProject): The project results are imported into, the current project if None.
+            auto_import (bool): Import every downloaded result, the plugin imports them itself.
+            max_concurrent (int): Queries running at once, the setting if None.
+            submit_interval (float): Minimum seconds between two submissions.
+        """
+        super(QueryEngine, self).__init__()
+        self.folder = folder
+        self.project = project
+        # Color tables of the data layers, used to style imported results
+        ttl = settings.value(settings.LAYER_METADATA_TTL_DAYS_KEY, settings.DEFAULT_LAYER_METADATA_TTL_DAYS) * 86400
+        self.layer_metadata = LayerMetadataCache(os.path.join(folder, 'layer_metadata.json'), ttl,
+                                                 layers_path=os.path.join(folder, 'data_layers.json'))
+        # Band ranges of the imported rasters, so importing a result again does not read the rasters
+        self.raster_stats = RasterStatsStore(os.path.join(folder, 'raster_stats.json'))
+        self.styler = LayerStyler(self.raster_stats, self.layer_metadata)
+        # Submitted queries, reattached if the engine stopped while they were running
+        self.journal = JobJournal(os.path.join(folder, 'jobs.sqlite'))
+        self.pipeline = QueryPipeline(max_concurrent=max_concurrent, cache=result_cache(folder),
+                                      metadata=self.layer_metadata, journal=self.journal, job_index=job_index(folder),
+                                      submit_interval=submit_interval)
+        # Layer group names and feature ids of fanned out queries by download folder, see run_fanout
+        self.result_groups = {}
+        # Failed results are never imported, their entries would be left behind; failed chunks of a split
+        # query still get a mosaic from the other chunks
+        self.pipeline.failed.connect(lambda record: self.result_groups.pop(record.download_folder, None)
+                                     if record.group is None else None)
+        self.pipeline.mosaic_failed.connect(lambda group: self.result_groups.pop(os.path.dirname(group.folder), None))
+        if auto_import:
+            self.pipeline.downloaded.connect(lambda record: self.import_files(
+                record.files, *self.result_group(record.download_folder, record.label())))
+            self.pipeline.mosaicked.connect(lambda group: self.import_files(
+                group.files, *self.result_group(os.path.dirname(group.folder), group.key)))
+        # Running layer import tasks, keyed by the name of their layer group
+        self.import_tasks = {}
+
+    def run_queries(self, raster_queries, download_folder):
+        """
+        Queues queries, large ones are split into chunks that are mosaicked once they have all finished.
+
+        Args:
+            raster_queries (list): The query dictionaries.
+            download_folder (str): The folder the results are downloaded to.
+
+        Returns:
+            list: The QueryRecords and QueryGroups of the queries.
+        """
+        tile_size = settings.value(settings.SPLIT_TILE_SIZE_KEY, settings.DEFAULT_SPLIT_TILE_SIZE)
+        interval_days = settings.value(settings.SPLIT_INTERVAL_DAYS_KEY, settings.DEFAULT_SPLIT_INTERVAL_DAYS)
+        retries = settings.value(settings.SPLIT_RETRIES_KEY, settings.DEFAULT_SPLIT_RETRIES)
+
+        queued = []
+        single_queries = []
+        for q in raster_queries:
+            chunks = split_query(q, tile_size, interval_days)
+            if len(chunks) > 1:
+                queued.append(self.pipeline.enqueue_split(chunks, download_folder, retries))
+            else:
+                single_queries.append(q)
+
+        if single_queries:
+            queued.extend(self.pipeline.enqueue(single_queries, download_folder))
+        return queued
+
+    def run_fanout(self, queries, download_folder, name):
+        """
+        Queues the queries of a fan-out over features, see fanout.fan_out.
+
+        Each query is downloaded to a subfolder named after its label and imported under a layer
+        group named after the label, which records the ids of the features the result covers.
+
+        Args:
+            queries (list): (label, query, box) tuples.
+            download_folder (str): The folder the subfolders are created in.
+            name (str): The prefix of the layer group names, e.g. the name of the vector layer.
+
+        Returns:
+            list: The QueryRecords and QueryGroups of the queries.
+        """
+        queued = []
+        for label, query_json, box in queries:
+            folder = os.path.join(download_folder, label)
+            self.result_groups[folder] = ('{} {}'.format(name, label), box.feature_ids if box is not None else None)
+            queued.extend(self.run_queries([query_json], folder))
+        return queued
+
+    def result_group(self, download_folder, default_name):
+        """Returns the layer group name and feature ids of the result in a download folder, see run_fanout."""
+        return self.result_groups.pop(download_folder, (default_name, None))
+
+    def run_query(self, query_json, download_folder, feedback=None):
+        """
+        Runs a query to completion in the calling thread, for callers without an event loop such as
+        Processing algorithms, which may run several of them in parallel threads.
+
+        The query goes the same way as through the pipeline: the result cache is checked first, an
+        identical job in the job index is joined, the job is journaled, polled with the poller's
+        backoff and downloaded and optimized by the pipeline's download task. Large queries are
+        split into chunks that run one after another and are mosaicked.
+
+        Args:
+            query_json (dict): The query.
+            download_folder (str): The folder the result is downloaded to.
+            feedback (QgsFeedback): Progress and cancellation.
+
+        Returns:
+            list: The result files, empty if the query was cancelled.
+
+        Raises:
+            Exception: If the query failed.
+        """
+        tile_size = settings.value(settings.SPLIT_TILE_SIZE_KEY, settings.DEFAULT_SPLIT_TILE_SIZE)
+        interval_days = settings.value(settings.SPLIT_INTERVAL_DAYS_KEY, settings.DEFAULT_SPLIT_INTERVAL_DAYS)
+        chunks = split_query(query_json, tile_size, interval_days)
+        if len(chunks) == 1:
+            return self.run_chunk(query_json, download_folder, feedback)
+
+        files = []
+        for chunk in chunks:
+            files.extend(self.run_chunk(chunk, download_folder, feedback))
+            if feedback is not None and feedback.isCanceled():
+                return []
+        name = 'split_{}'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f'))
+        return mosaic_files(files, os.path.join(download_folder, name))
+
+    def run_chunk(self, query_json, download_folder, feedback=None):
+        """Runs a single query that is not split, see run_query."""
+        pipeline = self.pipeline
+        record = QueryRecord(0, query_json, download_folder)
+        record.cache_key = query_hash(query_json)
+        if pipeline.cache is not None:
+            files = pipeline.cache.lookup(record.cache_key)
+            if files is not None:
+                QgsMessageLog.logMessage('{} result loaded from the cache'.format(record.cache_key), MESSAGE_CATEGORY, Qgis.Info)
+                return files
+
+        canceled = feedback.isCanceled if feedback is not None else (lambda: False)
+        record.query = pipeline.submit_task(feedback or NoFeedback(), record)
+        if record.query is None:
+            return []
+        if record.query.id is None:
+            raise Exception('the query was not submitted')
+        if self.journal is not None:
+            self.journal.submitted(record.query_id, query_json, download_folder, record.cache_key)
+        QgsMessageLog.logMessage('{} {}'.format(record.query_id, 'joined an indexed job' if record.joined else 'Query Submitted'), MESSAGE_CATEGORY, Qgis.Info)
+
+        try:
+            self.wait_for(record.query, canceled)
+            if canceled():
+                return []
+            if pipeline.download_task(feedback or NoFeedback(), record) is None:
+                return []
+        except Exception as e:
+            if self.journal is not None:
+                self.journal.update(record.query_id, FAILED, str(e))
+            if record.joined is not None:
+                pipeline.job_index.forget(record.cache_key, record.query_id)
+            raise
+        if self.journal is not None:
+            self.journal.update(record.query_id, COMPLETED)
+        return record.files
+
+    def wait_for(self, ibmpairs_query, canceled):
+        """Polls the status of a query with the poller's backoff until it succeeded, raises if it failed."""
+        attempt = 0
+        errors = 0
+        last_status = None
+        while not canceled():
+            try:
+                ibmpairs_query.status(poll=False)
+                status_code = ibmpairs_query.status_response.status_code
+                errors = 0
+            except Exception as e:
+                errors += 1
+                if errors >= MAX_STATUS_ERRORS:
+                    raise
+                QgsMessageLog.logMessage('{} status check failed ({}/{}): {}'.format(ibmpairs_query.id, errors, MAX_STATUS_ERRORS, e), MESSAGE_CATEGORY, Qgis.Warning)
+                status_code = last_status
+            if status_code == SUCCEEDED_STATUS_CODE:
+                return
+            if status_code is not None and status_code not in RUNNING_STATUS_CODES:
+                raise Exception('{} failed with status code {}'.format(ibmpairs_query.id, status_code))
+            attempt = attempt + 1 if status_code == last_status else 0
+            last_status = status_code
+            deadline = time.monotonic() + backoff_delay(status_code, attempt)
+            while time.monotonic() < deadline and not canceled():
+                time.sleep(CANCEL_CHECK_INTERVAL)
+
+    def import_files(self, files, name=None, feature_ids=None):
+        """
+        Creates and styles the layers of a result in a background task and adds them in one step
+        under a layer group named after the query.
+
+        Args:
+            files (list): The file paths of the raster files to be imported.
+            name (str): The name of the layer group, the query id or split query name.
+            feature_ids (list): The ids of the features a fanned out query covers, stored on the group.
+        """
+        if not files:
+            return
+        name = name or Path(files[0]).parent.name
+        vrt_mode = settings.value(settings.VRT_MODE_KEY, settings.DEFAULT_VRT_MODE)
+        task = QgsTask.fromFunction('ei geospatial apis: importing {}'.format(name), load_layers,
+                                    on_finished=partial(self.layers_loaded, name, time.perf_counter(), feature_ids),
+                                    files=files, metadata=self.layer_metadata, vrt_mode=vrt_mode, styler=self.styler)
+        self.import_tasks[name] = task
+        QgsApplication.taskManager().addTask(task)
+
+    def layers_loaded(self, name, started, feature_ids, exception, result=None):
+        """
+        Adds the layers prepared by a load_layers task to the project under one group.
+
+        This is the only part of an import that runs on the main thread; its duration is logged and
+        compared with the main thread budget from the settings.
+
+        Args:
+            name (str): The name of the layer group.
+            started (float): When the import was started, for the timing report.
+            feature_ids (list): The ids of the features the result covers, if it is from a fan-out.
+        """
+        self.import_tasks.pop(name, None)
+        if exception is not None:
+            QgsMessageLog.logMessage('{} import failed: {}'.format(name, exception), MESSAGE_CATEGORY, Qgis.Critical)
+            self.import_failed.emit(name, str(exception))
+            return
+        if result is None:
+            QgsMessageLog.logMessage('{} import cancelled'.format(name), MESSAGE_CATEGORY, Qgis.Warning)
+            return
+
+        main_started = time.perf_counter()
+        group = add_layer_group(name, [loaded.layer for loaded in result['layers']], self.project)
+        if feature_ids is not None:
+            group.setCustomProperty(FEATURE_IDS_PROPERTY, ','.join(str(fid) for fid in feature_ids))
+        self.imported.emit(name, result['layers'])
+        finished = time.perf_counter()
+
+        main_ms = (finished - main_started) * 1000
+        budget_ms = settings.value(settings.MAIN_THREAD_BUDGET_MS_KEY, settings.DEFAULT_MAIN_THREAD_BUDGET_MS)
+        QgsMessageLog.logMessage('{} {} layers imported in {:.2f} s: {:.2f} s in the background, {:.0f} ms on the main thread (budget {} ms)'.format(
+            name, len(result['layers']), finished - started, result['seconds'], main_ms, budget_ms), MESSAGE_CATEGORY,
+            Qgis.Warning if main_ms > budget_ms else Qgis.Info)
+
+    def busy(self):
+        """Returns whether queries are queued, running, downloading or being imported."""
+        return self.pipeline.busy() or bool(self.import_tasks)
+
+    def close(self):
+        """Cancels queued queries and running tasks; submitted queries stay in the journal."""
+        self.pipeline.cancel_all()
+        for task in self.import_tasks.values():
+            task.cancel()
+        self.layer_metadata.save()
+        self.raster_stats.save()
+        self.journal.close()
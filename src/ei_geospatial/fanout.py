@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Fan-out of a query template over the extents of vector
+                       features and over date ranges.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import copy
+import datetime
+
+from qgis.core import QgsCoordinateReferenceSystem, QgsCoordinateTransform
+
+from .splitting import TIMESTAMP_FORMAT
+
+WGS84 = 'EPSG:4326'
+# Smallest edge length of a query bbox in degrees, point features are padded to it
+MIN_BBOX_SIZE = 0.001
+DATE_FORMATS = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']
+
+
+class FeatureBox(object):
+    """The [south, west, north, east] bbox in EPSG:4326 of one or more features."""
+
+    def __init__(self, feature_ids, bbox):
+        self.feature_ids = feature_ids
+        self.bbox = bbox
+
+    def label(self):
+        """Returns a name for the queries of the box, the feature id or the lowest id and the number of others."""
+        if len(self.feature_ids) == 1:
+            return str(self.feature_ids[0])
+        return '{}+{}'.format(min(self.feature_ids), len(self.feature_ids) - 1)
+
+
+def padded_bbox(rectangle):
+    """Returns the [south, west, north, east] of a rectangle, at least MIN_BBOX_SIZE wide and high."""
+    west, east = rectangle.xMinimum(), rectangle.xMaximum()
+    south, north = rectangle.yMinimum(), rectangle.yMaximum()
+    if east - west < MIN_BBOX_SIZE:
+        center = (west + east) / 2.0
+        west, east = center - MIN_BBOX_SIZE / 2.0, center + MIN_BBOX_SIZE / 2.0
+    if north - south < MIN_BBOX_SIZE:
+        center = (south + north) / 2.0
+        south, north = center - MIN_BBOX_SIZE / 2.0, center + MIN_BBOX_SIZE / 2.0
+    return [south, west, north, east]
+
+
+def feature_boxes(features, crs, transform_context, feedback=None):
+    """
+    Returns the bboxes of features reprojected to EPSG:4326.
+
+    Args:
+        features (iterable): The QgsFeatures, e.g. layer.getFeatures() or layer.selectedFeatures().
+        crs (QgsCoordinateReferenceSystem): The CRS of the features.
+        transform_context (QgsCoordinateTransformContext): The datum transformations to use.
+        feedback (QgsFeedback): Cancellation.
+
+    Returns:
+        list: A FeatureBox per feature with a geometry.
+    """
+    transform = QgsCoordinateTransform(crs, QgsCoordinateReferenceSystem(WGS84), transform_context)
+    boxes = []
+    for feature in features:
+        if feedback is not None and feedback.isCanceled():
+            break
+        geometry = feature.geometry()
+        if geometry is None or geometry.isEmpty():
+            continue
+        extent = transform.transformBoundingBox(geometry.boundingBox())
+        boxes.append(FeatureBox([feature.id()], padded_bbox(extent)))
+    return boxes
+
+
+def gap(a, b):
+    """Returns the larger of the horizontal and vertical distance between two bboxes, 0 if they intersect."""
+    dx = max(0.0, b[1] - a[3], a[1] - b[3])
+    dy = max(0.0, b[0] - a[2], a[0] - b[2])
+    return max(dx, dy)
+
+
+def union(a, b):
+    return [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+
+
+def merge_pass(boxes, distance, max_size):
+    """One sweep from west to east that adds every box to the first nearby cluster it fits in."""
+    clusters = []
+    # Clusters that may still reach the boxes to come; boxes are sorted by west edge, so a cluster
+    # ending more than the distance west of the current box is out of reach for all later ones
+    active = []
+    for box in sorted(boxes, key=lambda b: b.bbox[1]):
+        active = [cluster for cluster in active if cluster.bbox[3] + distance >= box.bbox[1]]
+        for cluster in active:
+            if gap(cluster.bbox, box.bbox) <= distance:
+                merged = union(cluster.bbox, box.bbox)
+                if merged[2] - merged[0] <= max_size and merged[3] - merged[1] <= max_size:
+                    cluster.feature_ids.extend(box.feature_ids)
+                    cluster.bbox = merged
+                    break
+        else:
+            cluster = FeatureBox(list(box.feature_ids), list(box.bbox))
+            clusters.append(cluster)
+            active.append(cluster)
+    return clusters
+
+
+def merge_boxes(boxes, distance, max_size):
+    """
+    Merges boxes of nearby features into one box around them, so several small features share a query.
+
+    Boxes closer than the distance are merged as long as the merged box stays within max_size in
+    both directions, which keeps a chain of features from growing into one huge query. Merged boxes
+    can come close to each other, so the sweep is repeated until nothing changes.
+
+    Args:
+        boxes (list): The FeatureBoxes, see feature_boxes.
+        distance (float): The largest gap in degrees between two merged boxes.
+        max_size (float): The largest width and height in degrees of a merged box.
+
+    Returns:
+        list: The merged FeatureBoxes, each with the ids of all features it covers.
+    """
+    clusters = boxes
+    while True:
+        merged = merge_pass(clusters, distance, max_size)
+        if len(merged) == len(clusters):
+            return merged
+        clusters = merged
+
+
+def parse_timestamp(value, end=False):
+    """Returns a date or timestamp string as a query timestamp, dates cover the whole day."""
+    value = value.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            timestamp = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if end and fmt == '%Y-%m-%d':
+            timestamp += datetime.timedelta(days=1, seconds=-1)
+        return timestamp.strftime(TIMESTAMP_FORMAT)
+    raise ValueError('{} is not a date'.format(value))
+
+
+def parse_periods(text):
+    """
+    Parses date ranges, one per line as "start/end" or a single date for a whole day.
+
+    Returns:
+        list: (start, end) query timestamp tuples.
+
+    Raises:
+        ValueError: If a line is not a date or range.
+    """
+    periods = []
+    for line in text.replace(';', '\n').splitlines():
+        if not line.strip():
+            continue
+        start, _, end = line.partition('/')
+        periods.append((parse_timestamp(start), parse_timestamp(end or start, end=True)))
+    return periods
+
+
+def period_label(period):
+    """Returns a folder name for a (start, end) period, the dates if it covers whole days, else the timestamps."""
+    start, end = [timestamp.replace('-', '').replace(':', '').rstrip('Z') for timestamp in period]
+    if start.endswith('T000000') and end.endswith('T235959'):
+        start, end = start[:8], end[:8]
+    return '{}-{}'.format(start, end)
+
+
+def fan_out(template, boxes=None, periods=None):
+    """
+    Creates a query per box and period from a query template.
+
+    Args:
+        template (dict): The query json, its spatial and temporal parts are replaced.
+        boxes (list): FeatureBoxes, the template's spatial part is kept if None.
+        periods (list): (start, end) tuples, the template's intervals are kept if None.
+
+    Returns:
+        list: (label, query, box) tuples, the label names the box and period of the query and is
+        unique, repeated boxes or periods get the first free _2, _3, ... suffix.
+    """
+    queries = []
+    seen = {}
+    used = set()
+    for box in boxes or [None]:
+        for period in periods or [None]:
+            query = copy.deepcopy(template)
+            labels = []
+            if box is not None:
+                spatial = dict(query.get('spatial') or {}, type='square', coordinates=box.bbox)
+                spatial.pop('aoi', None)
+                spatial.pop('polygon', None)
+                query['spatial'] = spatial
+                labels.append(box.label())
+            if period is not None:
+                query['temporal'] = dict(query.get('temporal') or {}, intervals=[{'start': period[0], 'end': period[1]}])
+                labels.append(period_label(period))
+            label = '_'.join(labels) or 'query'
+            # The label names the download folder, results of a repeated label would overwrite each other
+            # A suffixed label can be the label of another query too, each candidate is checked against all labels
+            base = label
+            n = seen.get(base, 1)
+            while label in used:
+                n += 1
+                label = '{}_{}'.format(base, n)
+            seen[base] = n
+            used.add(label)
+            if query.get('name'):
+                query['name'] = '{}_{}'.format(query['name'], label)
+            queries.append((label, query, box))
+    return queries
@@ -30,16 +30,24 @@ from qgis.core import *
 import json
 import inspect
 import os
+import time
+from functools import partial
+import ibmpairs.client as client
 import ibmpairs.query as query
-import ibmpairs.catalog as catalog
 from qgis.PyQt.QtCore import Qt
-from qgis.PyQt.QtGui import QColor
-from osgeo import gdal
 from pathlib import Path
 
 # Import the code for the dialog windows
 from .ibmpairsdialog import IBMPairsDialog
 from .login_dialog import LoginDialog
+from . import settings
+from .engine import QueryEngine
+from .fanout import fan_out, feature_boxes, merge_boxes
+from .layer_import import LoadedLayer, prepare_files
+from .layer_style import DEFAULT_SPECTRUM
+from .processing_provider import GeospatialApisProvider
+from .session import PooledClient
+from .splitting import index_output_info
 
 MESSAGE_CATEGORY = 'ei-geospatial-apis'
 
@@ -49,6 +57,26 @@ class IBMPairsConnector(object):
         self.iface = iface  # Reference to the QGIS interface
         self.canvas = iface.mapCanvas()
         self.first_start = None  # Helper variable to check if the plugin is being started for the first time
+        # Query pipeline, caches and styling shared by all queries run from the plugin
+        self.engine = QueryEngine(os.path.dirname(__file__), auto_import=False)
+        self.engine.imported.connect(lambda name, layers: self.canvas.refresh())
+        self.layer_metadata = self.engine.layer_metadata
+        self.raster_stats = self.engine.raster_stats
+        self.styler = self.engine.styler
+        self.journal = self.engine.journal
+        self.pipeline = self.engine.pipeline
+        self.pipeline.downloaded.connect(self.download_completed)
+        self.pipeline.mosaicked.connect(self.mosaic_completed)
+        # Background refresh of the catalog files started at login
+        self.catalog_task = None
+        # Running prepare_files tasks of one by one imports by result name, kept referenced while they run
+        self.import_tasks = {}
+        self.provider = None
+
+    def initProcessing(self):
+        """Adds the query algorithms to the Processing toolbox."""
+        self.provider = GeospatialApisProvider(self.engine)
+        QgsApplication.processingRegistry().addProvider(self.provider)
 
     def initGui(self):
         """Initializes the GUI elements of the plugin."""
@@ -61,12 +89,23 @@ class IBMPairsConnector(object):
         # Add the action to the toolbar and menu
         self.iface.addToolBarIcon(self.action)
         self.iface.addPluginToMenu("IBM Environmental Intelligence: Geospatial APIs", self.action)
+        self.initProcessing()
+        unfinished = len(self.journal.unfinished())
+        if unfinished:
+            QgsMessageLog.logMessage('{} queries of a previous session are unfinished and will be reattached at login'.format(unfinished), MESSAGE_CATEGORY, Qgis.Info)
         self.first_start = True
 
     def unload(self):
         """Removes the plugin from QGIS (cleanup function)."""
         self.iface.removePluginMenu("IBM Environmental Intelligence: Geospatial APIs", self.action)
         self.iface.removeToolBarIcon(self.action)
+        if self.provider is not None:
+            QgsApplication.processingRegistry().removeProvider(self.provider)
+        for task in self.import_tasks.values():
+            task.cancel()
+        self.engine.close()
+        if isinstance(client.GLOBAL_PAIRS_CLIENT, PooledClient):
+            client.GLOBAL_PAIRS_CLIENT.close()
 
     def run(self):
         """Main method of the plugin. Gets called when the plugin is executed."""
@@ -79,7 +118,7 @@ class IBMPairsConnector(object):
             self.dlg.logo.setFixedSize(80,80)
             self.pw_hidden = True
             self.dlg.eyeball.clicked.connect(self.handlepwButton)
-            self.dlg.eyeball.setIcon(QIcon(os.path.join(os.path.dirname(__file__),'icons/hide.png')))
+            self.dlg.eyeball.setIcon(QIcon(os.path.join(os.path.dirname(__file__),'icons/hide.png')))
             self.dlg.eyeball.setIconSize(QSize(20,20))
         # Display the login dialog
         self.dlg.show()
@@ -89,63 +128,95 @@ class IBMPairsConnector(object):
             # Process the input if the dialog was closed successfully
             self.processInput()
     
-    def download_task(self, task, ibmpairs_query):
-        
-        QgsMessageLog.logMessage('{} started task query.check_status_and_download()'.format(str(ibmpairs_query.id)), MESSAGE_CATEGORY, Qgis.Info)
-        
-        incomplete = True
-        
-        while incomplete:
-            
-            if task.isCanceled():
-                stopped(task)
-                return None
-            
-            ibmpairs_query.status()
-            
-            QgsMessageLog.logMessage('{} status is {}'.format(str(ibmpairs_query.id), str(ibmpairs_query.status_response.status_code)), MESSAGE_CATEGORY, Qgis.Info)
-            
-            if ibmpairs_query.status_response.status_code == 20:
-                ibmpairs_query.download()
-                QgsMessageLog.logMessage('{} successfully completed download'.format(str(ibmpairs_query.id)), MESSAGE_CATEGORY, Qgis.Info)
-                incomplete = False
-            elif ibmpairs_query.status_response.status_code in [0, 1, 10, 11, 12]:
-                incomplete = True
-                QgsMessageLog.logMessage('{} query is still running'.format(str(ibmpairs_query.id)), MESSAGE_CATEGORY, Qgis.Info)
-            else:
-                incomplete = False
-                raise Exception('{} failed'.format(str(ibmpairs_query.id)))
-                
-        return ibmpairs_query
-    
-    def download_completed(self, exception, result=None):
-
-        if exception is None:
-            if result is None:
-                QgsMessageLog.logMessage(
-                    'Completed with no exception and no result (probably manually canceled by the user)', MESSAGE_CATEGORY, Qgis.Warning)
-            else:
-                files = result.list_files()
-                result_files = []
-                if True:
-                    for f in files:
-                        if f.endswith('.tiff') and not f.endswith('.tiff.json'):
-                            result_files.append(f)
-                print(result_files)
-                for file in result_files:
-                    self.import_file(file)
-                    
-                self.canvas.refresh()
-
-                QgsMessageLog.logMessage('Successfully refreshed QGIS canvas', MESSAGE_CATEGORY, Qgis.Info)
-        else:
-            QgsMessageLog.logMessage("Exception: {}, {}".format(exception, result), MESSAGE_CATEGORY, Qgis.Critical)
-            raise exception
+    def download_completed(self, record):
+        """
+        Imports the result files of a downloaded query, connected to the pipeline's downloaded signal.
+
+        Args:
+            record (QueryRecord): The pipeline record of the downloaded query.
+        """
+        self.import_files(record.files, *self.engine.result_group(record.download_folder, record.label()))
+
+    def mosaic_completed(self, group):
+        """
+        Imports the VRT mosaics of a split query, connected to the pipeline's mosaicked signal.
+
+        Args:
+            group (QueryGroup): The split query.
+        """
+        self.import_files(group.files, *self.engine.result_group(os.path.dirname(group.folder), group.key))
+
+    def import_files(self, files, name=None, feature_ids=None):
+        """
+        Imports raster files into the QGIS project and refreshes the canvas.
+
+        With batch import the layers are created in a background task and added in one step under
+        a layer group named after the query, otherwise they are added one by one once a background
+        task has built the VRTs and requested the missing metadata.
+
+        Args:
+            files (list): The file paths of the raster files to be imported.
+            name (str): The name of the layer group, the query id or split query name.
+            feature_ids (list): The ids of the features a fanned out query covers, stored on its layer group.
+        """
+        if not files:
+            return
+        if settings.value(settings.BATCH_IMPORT_KEY, settings.DEFAULT_BATCH_IMPORT):
+            self.engine.import_files(files, name, feature_ids)
+            return
+
+        # Building the VRTs and requesting missing metadata would block the main thread, they run in
+        # a background task and only adding and styling the layers happens once it finished
+        name = name or Path(files[0]).parent.name
+        vrt_mode = settings.value(settings.VRT_MODE_KEY, settings.DEFAULT_VRT_MODE)
+        task = QgsTask.fromFunction('ei geospatial apis: preparing the import of {}'.format(name), prepare_files,
+                                    on_finished=partial(self.files_prepared, name),
+                                    files=files, metadata=self.layer_metadata, vrt_mode=vrt_mode)
+        self.import_tasks[name] = task
+        QgsApplication.taskManager().addTask(task)
+
+    def files_prepared(self, name, exception, result=None):
+        """
+        Imports the layers of a result one by one once a prepare_files task finished.
+
+        Args:
+            name (str): The name of the result.
+            exception (Exception): The exception raised by the task, if any.
+            result (dict): The result of prepare_files, None if the task was cancelled.
+        """
+        self.import_tasks.pop(name, None)
+        if exception is not None:
+            QgsMessageLog.logMessage('Importing {} failed: {}'.format(name, exception), MESSAGE_CATEGORY, Qgis.Critical)
+            return
+        if result is None:
+            return
+        if result['requested']:
+            QgsMessageLog.logMessage('Requested the metadata of {} data layer(s) for styling'.format(result['requested']), MESSAGE_CATEGORY, Qgis.Info)
+
+        started = time.perf_counter()
+        files, entries = result['files'], result['entries']
+        loaded = []
+        for file in files:
+            layer = self.import_file(file, entries.get(file, {}), style=False)
+            if layer is not None:
+                loaded.append(LoadedLayer(file, layer, entries.get(file, {})))
+        self.styler.style_layers(loaded)
+
+        self.canvas.refresh()
+
+        QgsMessageLog.logMessage('Successfully refreshed QGIS canvas', MESSAGE_CATEGORY, Qgis.Info)
+        QgsMessageLog.logMessage('{} {} layers imported one by one in {:.2f} s on the main thread'.format(
+            name, len(files), time.perf_counter() - started), MESSAGE_CATEGORY, Qgis.Info)
 
     def processInput(self):
-        """Processes the user input from the main dialog of the plugin."""
+        """
+        Processes the user input from the main dialog of the plugin.
+
+        The input is either a single query or, for batch mode, a JSON list of queries which are
+        submitted through the pipeline's bounded pool.
+        """
         input_str = str(self.dlg.wkt.toPlainText())
-        start_index = input_str.find('{')
+        start_index = min([index for index in (input_str.find('{'), input_str.find('[')) if index != -1], default=-1)
 
         if start_index != -1:  # Ensure start_index is found
             json_text = input_str[start_index:]
@@ -158,40 +229,79 @@ class IBMPairsConnector(object):
                 QMessageBox.information(self.iface.mainWindow(), \
                 QCoreApplication.translate('IBMPairsConnector', "IBM Geospatial APIs plugin error"), \
                 QCoreApplication.translate('IBMPairsConnector', "There was an error while loading the JSON:<br /><strong>{0}</strong>").format(message))
+                return
 
         else:
             QMessageBox.information(self.iface.mainWindow(), \
             QCoreApplication.translate('IBMPairsConnector', "IBM Geospatial APIs plugin error"), \
             QCoreApplication.translate('IBMPairsConnector', "Error: JSON data not found in the input string."))
+            return
 
-        #download and save the query, if its available
+        #download and save the queries, if they are available
         DOWNLOAD_FOLDER = self.dlg.outputfolder.filePath()
-        my_query = query.Query.from_json(raster_query)
-        
-        if ((my_query.spatial is not None) and (my_query.spatial.type is not None)):
-            if my_query.spatial.type.lower() in ['point']:
-                msg = "In the alpha version of the plugin point queries are not executable; please refactor the query as a raster query."
-                QgsMessageLog.logMessage(msg, MESSAGE_CATEGORY, Qgis.Critical)
-                QCoreApplication.translate('IBMPairsConnector', msg)
-                
-                return
-        
-        my_query.set_download_folder(DOWNLOAD_FOLDER)
-        
-        my_query.submit()
-        
-        QgsMessageLog.logMessage('{} Query Submitted'.format(my_query.id), MESSAGE_CATEGORY, Qgis.Info)
-            
-        QgsMessageLog.logMessage('{} Query Checking Status and Downloading'.format(my_query.id), MESSAGE_CATEGORY, Qgis.Info)
-        
-        globals()[my_query.id] = QgsTask.fromFunction('ei geospatial apis: {}'.format(my_query.id), self.download_task, on_finished=self.download_completed, ibmpairs_query=my_query)
+        raster_queries = raster_query if isinstance(raster_query, list) else [raster_query]
 
-        QgsApplication.taskManager().addTask(globals()[my_query.id])
-        
-        QgsMessageLog.logMessage('{} QgsTask Started'.format(my_query.id), MESSAGE_CATEGORY, Qgis.Info)
+        for q in raster_queries:
+            my_query = query.Query.from_json(q)
+            if ((my_query.spatial is not None) and (my_query.spatial.type is not None)):
+                if my_query.spatial.type.lower() in ['point']:
+                    msg = "In the alpha version of the plugin point queries are not executable; please refactor the query as a raster query."
+                    QgsMessageLog.logMessage(msg, MESSAGE_CATEGORY, Qgis.Critical)
+                    QCoreApplication.translate('IBMPairsConnector', msg)
+
+                    return
+
+        if self.dlg.fanout.isChecked():
+            self.run_fanout(raster_queries, DOWNLOAD_FOLDER)
+            return
+
+        # Large queries are split into chunks that run in parallel and are mosaicked on completion
+        self.engine.run_queries(raster_queries, DOWNLOAD_FOLDER)
 
         return
 
+    def run_fanout(self, raster_queries, download_folder):
+        """
+        Runs the queries once per feature of the vector layer chosen in the main dialog.
+
+        The bbox of each feature, reprojected to EPSG:4326, replaces the spatial part of the query.
+        Nearby features can be merged into one query, which cuts the number of queries for layers
+        with many small features. The queries run concurrently through the pipeline and the result
+        of each is imported under a layer group named after the layer and the feature id.
+
+        Args:
+            raster_queries (list): The query templates.
+            download_folder (str): The folder the results are downloaded to, a subfolder per feature.
+        """
+        layer = self.dlg.fanout_layer.currentLayer()
+        if layer is None:
+            QMessageBox.information(self.iface.mainWindow(), \
+            QCoreApplication.translate('IBMPairsConnector', "IBM Geospatial APIs plugin error"), \
+            QCoreApplication.translate('IBMPairsConnector', "Choose the vector layer to run the query for."))
+            return
+        features = layer.selectedFeatures() if self.dlg.fanout_selected.isChecked() else layer.getFeatures()
+        boxes = feature_boxes(features, layer.crs(), QgsProject.instance().transformContext())
+        if not boxes:
+            QMessageBox.information(self.iface.mainWindow(), \
+            QCoreApplication.translate('IBMPairsConnector', "IBM Geospatial APIs plugin error"), \
+            QCoreApplication.translate('IBMPairsConnector', "The layer {0} has no features with a geometry to run the query for.").format(layer.name()))
+            return
+
+        if self.dlg.fanout_merge.isChecked():
+            merged = merge_boxes(boxes, settings.value(settings.FANOUT_MERGE_DISTANCE_KEY, settings.DEFAULT_FANOUT_MERGE_DISTANCE),
+                                 settings.value(settings.FANOUT_MAX_MERGED_SIZE_KEY, settings.DEFAULT_FANOUT_MAX_MERGED_SIZE))
+            QgsMessageLog.logMessage('{} features of {} merged into {} queries per query ({:.0%} fewer)'.format(
+                len(boxes), layer.name(), len(merged), 1 - len(merged) / len(boxes)), MESSAGE_CATEGORY, Qgis.Info)
+            boxes = merged
+
+        for n, raster_query in enumerate(raster_queries):
+            if len(raster_queries) == 1:
+                self.engine.run_fanout(fan_out(raster_query, boxes), download_folder, layer.name())
+                continue
+            # The feature subfolders of several templates would clash, each template gets a subfolder
+            name = str(raster_query.get('name') or n + 1)
+            self.engine.run_fanout(fan_out(raster_query, boxes), os.path.join(download_folder, name), '{} {}'.format(layer.name(), name))
+
     def login(self):
         """
         Logs the user into the backend and starts the main IBM Geospatial APIs dialog, also closes the login dialog.
@@ -202,12 +312,20 @@ class IBMPairsConnector(object):
         if not authentication:
             # Authentication failed; return without opening the main dialog
             return
-        
-        self.dlg.catalog()
+
+        # Queries of a previous session are polled and downloaded again without being resubmitted
+        if settings.value(settings.RESUME_QUERIES_KEY, settings.DEFAULT_RESUME_QUERIES):
+            self.pipeline.resume()
+
+        # The cached catalog is shown right away and swapped when the refresh finds changes
+        self.catalog_task = self.dlg.catalog(refreshed=self.catalog_refreshed, failed=self.catalog_failed)
 
         # Close the login dialog and open the main plugin dialog
         self.dlg.close()
         self.dlg = IBMPairsDialog()
+        if not self.dlg.data:
+            # First login, there is no cached catalog until the refresh has fetched it
+            self.dlg.set_catalog_state("Loading the catalog...")
         # Setup actions for dialog buttons
         self.dlg.clearButton.clicked.connect(self.clearButtonClicked)
         # Display the main dialog
@@ -217,6 +335,16 @@ class IBMPairsConnector(object):
         if result:
             self.processInput()
 
+    def catalog_refreshed(self, result):
+        """Shows the refreshed catalog in the main dialog if it is open."""
+        if isinstance(self.dlg, IBMPairsDialog):
+            self.dlg.reload_catalog()
+
+    def catalog_failed(self):
+        """Tells the main dialog that there is no catalog to show if the first refresh failed."""
+        if isinstance(self.dlg, IBMPairsDialog) and not self.dlg.data:
+            self.dlg.set_catalog_state("The catalog could not be loaded, see the message log")
+
     # Toggle Key fields to be visible
     def handlepwButton(self):
         if self.pw_hidden:
@@ -247,69 +375,44 @@ class IBMPairsConnector(object):
         """
         self.run()
 
-    def import_file(self, file):
+    def import_file(self, file, info=None, style=True):
         """
         Imports a raster file into the QGIS project.
 
         Args:
             file (str): The file path of the raster file to be imported.
+            info (dict): The output.info entry of the file as indexed by import_files, read from the
+                output.info next to the file if not given.
+            style (bool): Style the layer on its own, import_files styles all layers of a result together.
+
+        Returns:
+            QgsRasterLayer: The layer, None if the file could not be loaded.
         """
         # Create a QgsRasterLayer from the provided file path
-        layer = QgsRasterLayer(file, os.path.basename(file)[:-5])
+        layer = QgsRasterLayer(file, Path(file).stem)
         if not layer.isValid():
             QgsMessageLog.logMessage('{} layer failed to load'.format(file), MESSAGE_CATEGORY, Qgis.Error)
-            return
+            return None
 
         # Add the layer to the QGIS project
         QgsProject.instance().addMapLayer(layer)
         
         # Optionally, apply styling and rendering settings to the layer
 
-        file_no_ext = Path(file).stem
-        output_info = Path('{}/output.info'.format(Path(file).parent))
-        
-        dl_id = None
-
-        # Determine data layer id of the file
-        if output_info.is_file():
-            with open(output_info) as f:
-                try:
-                    output_info_json = json.load(f)
-                    for tiff in output_info_json['files']:
-                        if tiff['name'] == file_no_ext:
-                            dl_id = tiff['datalayerId']
-                except:
-                    QgsMessageLog.logMessage('{} the data layer id could not be found'.format(file), MESSAGE_CATEGORY, Qgis.Error)
-
-        spectrum = None
-        
-        if dl_id is not None:
-            try:
-                dl = catalog.get_data_layer(dl_id)
-                if dl.color_table != None:
-                    if dl.color_table.colors != None:
-                        spectrum = dl.color_table.colors.split(',')
-                        spectrum = ['#'+item for item in spectrum]
-            except:
-                QgsMessageLog.logMessage('{} the spectrum could not be found for the layer {}'.format(file, dl_id), MESSAGE_CATEGORY, Qgis.Warn)
-
-        if spectrum is not None:
-            QgsMessageLog.logMessage('{} the spectrum {} will be applied'.format(file, str(spectrum)), MESSAGE_CATEGORY, Qgis.Info)
-            self.applyStylingToLayer(layer = layer, spectrum = spectrum)
-        else:
-            self.applyStylingToLayer(layer)
-
-        '''
-        self.applyStylingToLayer(layer)
-        '''
+        if info is None:
+            info = index_output_info([file]).get(file, {})
+        if style:
+            self.styler.style_layer(file, layer, info)
+            self.raster_stats.save()
 
         QgsMessageLog.logMessage('{} layer loaded'.format(file), MESSAGE_CATEGORY, Qgis.Info)
+        return layer
 
     def applyStylingToLayer(self, 
                             layer, 
                             band=1,
                             #spectrum=['Cyan', 'Green', 'Yellow', 'Orange', 'Red']):
-                            spectrum=['#153A91','#84F588','#FFF787','#FF7C3B','#FF1921'],
+                            spectrum=DEFAULT_SPECTRUM,
                             opacity = 0.6):
         """
         Applies styling to the raster layer based on the specified band and color spectrum.
@@ -318,38 +421,9 @@ class IBMPairsConnector(object):
             layer (QgsRasterLayer): The raster layer to style.
             band (int): The band of the raster to use for styling.
             spectrum (list): A list of colors to use for the styling.
+            opacity (float): The opacity of the layer.
         """
-        # Obtain the data provider and GDAL dataset for the layer
-        prov = layer.dataProvider()
-        src_ds = gdal.Open(layer.source())
-        src_band = src_ds.GetRasterBand(band)
-
-        # Compute statistics if not already present
-        if src_band.GetMinimum() is None or src_band.GetMaximum() is None:
-            src_band.ComputeStatistics(0)
-        band_min, band_max = src_band.GetMinimum(), src_band.GetMaximum()
-
-        # Prepare the color ramp shader
-        band_range = band_max - band_min
-        class_range = band_range / len(spectrum)
-        fcn = QgsColorRampShader()
-        fcn.setColorRampType(QgsColorRampShader.Interpolated)
-        item_list = []
-
-        # Create color ramp items based on the spectrum
-        for n in range(len(spectrum)):
-            band_min += class_range
-            list_item = QgsColorRampShader.ColorRampItem(band_min, QColor(spectrum[n]), lbl='{0:.2f}-{1:.2f}'.format(band_min-class_range, band_min))
-            item_list.append(list_item)
-        fcn.setColorRampItemList(item_list)
-
-        # Apply the color ramp to the layer
-        shader = QgsRasterShader()
-        shader.setRasterShaderFunction(fcn)
-        renderer = QgsSingleBandPseudoColorRenderer(prov, band, shader)
-        layer.setRenderer(renderer)
-        layer.setOpacity(opacity)  # Set layer opacity
-        layer.triggerRepaint()
+        self.styler.style(layer, band, spectrum, opacity)
 
     def constraintMessage(self, message):
         """
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Index of recently submitted query jobs, shared through
+                       a directory, so identical queries join an existing job.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import getpass
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from qgis.core import QgsMessageLog, Qgis
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+
+class JobIndex(object):
+    """
+    Maps query hashes (see cache.query_hash) to the ids of the backend jobs that run them.
+
+    Every job is a small json file named after its hash in a directory that may be on a network
+    share, so several users and sessions can see each other's jobs without a server. Entries are
+    replaced in one step and never edited in place, which is all the coordination a shared folder
+    needs; two users submitting the same query at the same moment both submit, later ones join.
+    """
+
+    def __init__(self, folder, max_age):
+        """
+        Args:
+            folder (str): The index directory.
+            max_age (float): Seconds after which a job is no longer joined.
+        """
+        self.folder = folder
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.avoided = 0
+
+    def entry_path(self, key):
+        return os.path.join(self.folder, key[:2], key + '.json')
+
+    def lookup(self, key):
+        """
+        Returns the indexed job of a query hash, None if there is none or it is too old.
+
+        Args:
+            key (str): The query hash.
+
+        Returns:
+            dict: The query id, submission time, user and host of the job.
+        """
+        with self.lock:
+            self.lookups += 1
+        try:
+            with open(self.entry_path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not entry.get('query_id') or time.time() - entry.get('submitted_at', 0) > self.max_age:
+            return None
+        return entry
+
+    def publish(self, key, query_id):
+        """Indexes the job that was submitted for a query hash."""
+        entry = {'query_id': str(query_id), 'submitted_at': time.time(), 'user': getpass.getuser(),
+                 'host': socket.gethostname()}
+        path = self.entry_path(key)
+        # Unique temporary name, other users may write the same entry at the same time
+        tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            QgsMessageLog.logMessage('{} could not be added to the job index {}: {}'.format(query_id, self.folder, e), MESSAGE_CATEGORY, Qgis.Warning)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def forget(self, key, query_id):
+        """Removes the entry of a job that failed or whose result is gone, unless it was replaced already."""
+        path = self.entry_path(key)
+        try:
+            with open(path) as f:
+                if json.load(f).get('query_id') == str(query_id):
+                    os.remove(path)
+        except (OSError, ValueError):
+            pass
+
+    def joined(self):
+        """Counts a submission that was avoided by joining an indexed job."""
+        with self.lock:
+            self.avoided += 1
+
+    def report(self):
+        """Returns the number of lookups and avoided submissions of this session."""
+        with self.lock:
+            return {'lookups': self.lookups, 'avoided': self.avoided}
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : On-disk journal of the submitted queries, so running
+                       queries survive a restart of QGIS.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import json
+import sqlite3
+import threading
+import time
+
+from qgis.core import QgsMessageLog, Qgis
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+# Journal states, a query is reattached while it is running or downloading
+RUNNING = 'running'
+DOWNLOADING = 'downloading'
+COMPLETED = 'completed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+UNFINISHED_STATES = [RUNNING, DOWNLOADING]
+
+# Days finished queries are kept in the journal
+RETENTION_DAYS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    query_id TEXT PRIMARY KEY,
+    query_json TEXT NOT NULL,
+    download_folder TEXT NOT NULL,
+    state TEXT NOT NULL,
+    cache_key TEXT,
+    group_key TEXT,
+    group_folder TEXT,
+    retries INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    submitted_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    chunk INTEGER,
+    files TEXT
+)
+"""
+# Split queries with all their chunks, so a group is rebuilt completely after a restart
+GROUPS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS groups (
+    group_key TEXT PRIMARY KEY,
+    group_folder TEXT NOT NULL,
+    download_folder TEXT NOT NULL,
+    chunks TEXT NOT NULL,
+    retries INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+# Columns added to the jobs table after it was first released
+JOB_COLUMNS = [('chunk', 'INTEGER'), ('files', 'TEXT')]
+
+
+class JournalEntry(object):
+    """A query read back from the journal."""
+
+    def __init__(self, row):
+        self.query_id = row['query_id']
+        self.query_json = json.loads(row['query_json'])
+        self.download_folder = row['download_folder']
+        self.state = row['state']
+        self.cache_key = row['cache_key']
+        self.group_key = row['group_key']
+        self.group_folder = row['group_folder']
+        self.retries = row['retries']
+        self.submitted_at = row['submitted_at']
+        self.chunk = row['chunk']
+        self.files = json.loads(row['files']) if row['files'] else []
+
+
+class JournalGroup(object):
+    """A split query read back from the journal, with the latest job of each of its chunks."""
+
+    def __init__(self, row, entries):
+        self.key = row['group_key']
+        self.folder = row['group_folder']
+        self.download_folder = row['download_folder']
+        self.chunks = json.loads(row['chunks'])
+        self.retries = row['retries']
+        # Chunk index -> JournalEntry, chunks that were still queued have none
+        self.jobs = {entry.chunk: entry for entry in entries if entry.chunk is not None}
+
+
+class JobJournal(object):
+    """
+    SQLite journal of the queries submitted to the backend.
+
+    A query is written when its id is known and updated on every state change, so after a crash
+    or restart of QGIS the queries that were still running on the backend or downloading can be
+    polled and downloaded again under their id instead of being submitted again. Every write is
+    committed right away; a journal that cannot be written only disables the reattaching.
+    """
+
+    def __init__(self, path, retention_days=RETENTION_DAYS):
+        """
+        Args:
+            path (str): The SQLite file.
+            retention_days (float): Days finished queries are kept.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+        try:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.row_factory = sqlite3.Row
+            with self.connection:
+                self.connection.execute(SCHEMA)
+                self.connection.execute(GROUPS_SCHEMA)
+                columns = [row['name'] for row in self.connection.execute('PRAGMA table_info(jobs)')]
+                for name, column_type in JOB_COLUMNS:
+                    if name not in columns:
+                        self.connection.execute('ALTER TABLE jobs ADD COLUMN {} {}'.format(name, column_type))
+                cutoff = time.time() - retention_days * 86400
+                self.connection.execute('DELETE FROM jobs WHERE state NOT IN (?, ?) AND updated_at < ?',
+                                        UNFINISHED_STATES + [cutoff])
+                self.connection.execute('DELETE FROM groups WHERE state != ? AND updated_at < ?', (RUNNING, cutoff))
+        except sqlite3.Error as e:
+            QgsMessageLog.logMessage('The job journal {} could not be opened, queries will not be reattached: {}'.format(path, e), MESSAGE_CATEGORY, Qgis.Warning)
+            self.connection = None
+
+    def execute(self, sql, parameters=()):
+        """Runs and commits a statement, returns the rows it selected or None if the journal is not usable."""
+        if self.connection is None:
+            return None
+        with self.lock:
+            try:
+                with self.connection:
+                    return self.connection.execute(sql, parameters).fetchall()
+            except sqlite3.Error as e:
+                QgsMessageLog.logMessage('The job journal could not be written: {}'.format(e), MESSAGE_CATEGORY, Qgis.Warning)
+                return None
+
+    def submitted(self, query_id, query_json, download_folder, cache_key=None, group=None, retries=0, chunk=None):
+        """
+        Records a query that has been submitted.
+
+        Args:
+            query_id (str): The query id.
+            query_json (dict): The query.
+            download_folder (str): The folder the result is downloaded to.
+            cache_key (str): The result cache key of the query.
+            group (QueryGroup): The split query the query is a chunk of, if any.
+            retries (int): The resubmissions left if the query fails.
+            chunk (int): The index of the chunk within its split query.
+        """
+        now = time.time()
+        self.execute('INSERT OR REPLACE INTO jobs (query_id, query_json, download_folder, state, cache_key, group_key, '
+                     'group_folder, retries, submitted_at, updated_at, chunk) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (str(query_id), json.dumps(query_json), download_folder, RUNNING, cache_key,
+                      group.key if group is not None else None, group.folder if group is not None else None,
+                      retries, now, now, chunk))
+
+    def update(self, query_id, state, error=None, files=None):
+        """Records the new state of a query and, once it is downloaded, its result files."""
+        self.execute('UPDATE jobs SET state = ?, error = COALESCE(?, error), files = COALESCE(?, files), updated_at = ? '
+                     'WHERE query_id = ?', (state, error, json.dumps(files) if files is not None else None, time.time(), str(query_id)))
+
+    def split(self, group, chunks, download_folder, retries=0):
+        """
+        Records a split query with all its chunks before any of them is submitted.
+
+        Args:
+            group (QueryGroup): The split query.
+            chunks (list): The chunk queries in chunk order.
+            download_folder (str): The folder the chunk results are downloaded to.
+            retries (int): The resubmissions of a failed chunk.
+        """
+        now = time.time()
+        self.execute('INSERT OR REPLACE INTO groups (group_key, group_folder, download_folder, chunks, retries, state, '
+                     'created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (group.key, group.folder, download_folder, json.dumps(chunks), retries, RUNNING, now, now))
+
+    def group_finished(self, group_key, state):
+        """Records that a split query was mosaicked or given up."""
+        self.execute('UPDATE groups SET state = ?, updated_at = ? WHERE group_key = ?', (state, time.time(), group_key))
+
+    def unfinished(self):
+        """Returns the JournalEntries of the queries that were running or downloading, oldest first."""
+        rows = self.execute('SELECT * FROM jobs WHERE state IN (?, ?) ORDER BY submitted_at', UNFINISHED_STATES)
+        entries = []
+        for row in rows or []:
+            try:
+                entries.append(JournalEntry(row))
+            except ValueError:
+                self.update(row['query_id'], FAILED, 'the journal entry could not be read')
+        return entries
+
+    def unfinished_groups(self):
+        """Returns the JournalGroups of the split queries that were not mosaicked yet, oldest first."""
+        groups = []
+        for row in self.execute('SELECT * FROM groups WHERE state = ? ORDER BY created_at', (RUNNING,)) or []:
+            # Later jobs of a chunk, e.g. resubmissions, replace the earlier ones
+            jobs = self.execute('SELECT * FROM jobs WHERE group_key = ? ORDER BY submitted_at, rowid', (row['group_key'],)) or []
+            try:
+                groups.append(JournalGroup(row, [JournalEntry(job) for job in jobs]))
+            except ValueError:
+                self.group_finished(row['group_key'], FAILED)
+        return groups
+
+    def close(self):
+        if self.connection is not None:
+            with self.lock:
+                self.connection.close()
+                self.connection = None
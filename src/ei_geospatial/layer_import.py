@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Batched import of query results into the QGIS project.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import time
+from pathlib import Path
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import QgsLayerTreeLayer, QgsMessageLog, QgsProject, QgsRasterLayer, Qgis
+
+from .layer_metadata import referenced_layer_ids
+from .result_vrt import NONE, build_result_vrts
+from .splitting import index_output_info
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+
+class LoadedLayer(object):
+    """A raster layer created by load_layers together with the output.info entry of its file."""
+
+    def __init__(self, file, layer, info):
+        self.file = file
+        self.layer = layer
+        self.info = info
+
+
+def prepare_files(task, files, metadata=None, vrt_mode=NONE):
+    """
+    Does the part of an import that needs no layers, runs in a background thread.
+
+    Args:
+        task (QgsTask): The task running the import.
+        files (list): The result files.
+        metadata (LayerMetadataCache): Prefetches the color tables used to style the layers.
+        vrt_mode (str): Wraps the files of each data layer into a VRT, see result_vrt.build_result_vrts.
+
+    Returns:
+        dict: The files to import, their output.info entries and the number of data layers whose
+        metadata had to be requested, None if the task was cancelled.
+    """
+    files = build_result_vrts(files, vrt_mode)
+    # Every output.info is parsed once for the whole result instead of once per file
+    entries = index_output_info(files)
+    requested = 0
+    if metadata is not None:
+        # One parallel round of catalog requests for the data layers not cached yet instead of one per file
+        requested = metadata.prefetch(referenced_layer_ids(entries))
+    if task.isCanceled():
+        return None
+    return {'files': files, 'entries': entries, 'requested': requested}
+
+
+def load_layers(task, files, metadata=None, vrt_mode=NONE, styler=None):
+    """
+    Creates the styled raster layers of a result, runs in a background thread.
+
+    Building the VRTs, opening the files, parsing the output.info, requesting missing data layer
+    metadata, computing statistics and styling all happen here. The finished layers are handed to
+    the main thread, which only has to add them to the project.
+
+    Args:
+        task (QgsTask): The task running the import.
+        files (list): The result files.
+        metadata (LayerMetadataCache): Prefetches the color tables used to style the layers.
+        vrt_mode (str): Wraps the files of each data layer into a VRT, see result_vrt.build_result_vrts.
+        styler (LayerStyler): Styles the layers before they are handed over.
+
+    Returns:
+        dict: The LoadedLayers and the seconds spent, None if the task was cancelled.
+    """
+    started = time.perf_counter()
+    prepared = prepare_files(task, files, metadata, vrt_mode)
+    if prepared is None:
+        return None
+    files, entries = prepared['files'], prepared['entries']
+
+    layers = []
+    for n, file in enumerate(files):
+        if task.isCanceled():
+            return None
+        layer = QgsRasterLayer(file, Path(file).stem)
+        if not layer.isValid():
+            QgsMessageLog.logMessage('{} layer failed to load'.format(file), MESSAGE_CATEGORY, Qgis.Critical)
+            continue
+        layers.append(LoadedLayer(file, layer, entries.get(file, {})))
+        task.setProgress(50.0 * (n + 1) / len(files))
+
+    if styler is not None and not task.isCanceled():
+        styler.style_layers(layers)
+    if task.isCanceled():
+        return None
+
+    # Layers created in a task belong to its thread until they are moved
+    main_thread = QCoreApplication.instance().thread()
+    for loaded in layers:
+        loaded.layer.moveToThread(main_thread)
+    task.setProgress(100)
+    return {'layers': layers, 'seconds': time.perf_counter() - started}
+
+
+def add_layer_group(name, layers, project=None):
+    """
+    Adds layers to a project in one step, grouped under a new group at the top of the layer tree.
+
+    Args:
+        name (str): The name of the group.
+        layers (list): The QgsRasterLayers.
+        project (QgsProject): The project, the current project if None.
+
+    Returns:
+        QgsLayerTreeGroup: The group.
+    """
+    if project is None:
+        project = QgsProject.instance()
+    # Registering the layers without adding them to the tree emits one layersAdded for the whole batch
+    project.addMapLayers(layers, False)
+    group = project.layerTreeRoot().insertGroup(0, name)
+    group.insertChildNodes(0, [QgsLayerTreeLayer(layer) for layer in layers])
+    return group
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Cache of the data layer metadata used to style imported results.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ibmpairs.catalog as catalog
+from qgis.core import QgsMessageLog, Qgis
+
+from .catalog_refresh import DATA_LAYERS_FILE, load_state
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+# Number of data layers requested at the same time by prefetch
+PREFETCH_WORKERS = 4
+# Seconds between two checks whether the catalog was refreshed
+PREWARM_CHECK_INTERVAL = 60
+
+
+def color_table_colors(data_layer):
+    """Returns the comma separated colors of a data layer dictionary as in data_layers.json, None if it has none."""
+    color_table = data_layer.get('color_table') or {}
+    return color_table.get('colors') or None
+
+
+def referenced_layer_ids(entries):
+    """
+    Returns the data layer ids referenced by a set of result files.
+
+    Args:
+        entries (dict): File path -> output.info entry, as returned by splitting.index_output_info.
+
+    Returns:
+        set: The data layer ids.
+    """
+    return {str(entry['datalayerId']) for entry in entries.values() if entry.get('datalayerId') is not None}
+
+
+class LayerMetadataCache(object):
+    """
+    In memory and on disk cache of the data layer metadata needed to style imported rasters.
+
+    Entries map a data layer id to its color table and the time it was read. They are pre-warmed
+    from data_layers.json whenever the catalog file changed, so most lookups never reach the
+    network; missing or expired entries are requested with ``catalog.get_data_layer``. Concurrent
+    lookups of the same id wait for a single request instead of each making their own.
+    """
+
+    def __init__(self, path, ttl, layers_path=None):
+        """
+        Args:
+            path (str): The json file the entries are persisted in.
+            ttl (float): Seconds an entry is used before it is requested again.
+            layers_path (str): The data_layers.json used to pre-warm the cache.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.layers_path = layers_path
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.entries = {}
+        self.source = None
+        self.loaded = False
+        self.checked_at = None
+        self.requests = 0
+
+    def load(self):
+        """Reads the persisted entries and pre-warms them from the catalog if it changed, call with the lock held."""
+        if not self.loaded:
+            self.loaded = True
+            try:
+                with open(self.path) as f:
+                    stored = json.load(f)
+                self.entries = stored.get('entries', {})
+                self.source = stored.get('source')
+            except (OSError, ValueError):
+                pass
+        if self.checked_at is None or time.monotonic() - self.checked_at > PREWARM_CHECK_INTERVAL:
+            self.checked_at = time.monotonic()
+            self.prewarm()
+
+    def prewarm(self):
+        """Takes the color tables of all data layers from data_layers.json, call with the lock held."""
+        if self.layers_path is None or not os.path.isfile(self.layers_path):
+            return
+        # The refresh only rewrites the file if it changed, but records every time it confirmed it
+        state = load_state(os.path.dirname(self.layers_path)).get(DATA_LAYERS_FILE, {})
+        fetched_at = max(os.path.getmtime(self.layers_path), state.get('fetched_at') or 0)
+        if self.source == fetched_at:
+            return
+        try:
+            with open(self.layers_path) as f:
+                layers = json.load(f).get('data_layers', [])
+        except (OSError, ValueError):
+            return
+        for layer in layers:
+            if layer.get('id') is None:
+                continue
+            entry = self.entries.get(str(layer['id']))
+            # Entries requested after the catalog was fetched are newer
+            if entry is None or entry['fetched_at'] < fetched_at:
+                self.entries[str(layer['id'])] = {'colors': color_table_colors(layer), 'fetched_at': fetched_at}
+        self.source = fetched_at
+        self.save()
+
+    def save(self):
+        """Persists the entries, call with the lock held."""
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({'source': self.source, 'entries': self.entries}, f)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            QgsMessageLog.logMessage('The data layer metadata could not be saved: {}'.format(e), MESSAGE_CATEGORY, Qgis.Warning)
+
+    def fresh(self, layer_id):
+        """Returns the entry of a data layer if it has not expired, call with the lock held."""
+        entry = self.entries.get(layer_id)
+        if entry is not None and time.time() - entry['fetched_at'] <= self.ttl:
+            return entry
+        return None
+
+    def get(self, layer_id, save=True):
+        """
+        Returns the metadata of a data layer, requesting it from the catalog if it is not cached.
+
+        Args:
+            layer_id (str): The data layer id.
+            save (bool): Persist the cache after a request, prefetch saves once for all requests.
+
+        Returns:
+            dict: The entry with the colors of the data layer's color table (None if it has none),
+            None if the data layer could not be requested.
+        """
+        layer_id = str(layer_id)
+        with self.lock:
+            self.load()
+            entry = self.fresh(layer_id)
+            if entry is not None:
+                return entry
+            event = self.pending.get(layer_id)
+            owner = event is None
+            if owner:
+                event = self.pending[layer_id] = threading.Event()
+
+        if not owner:
+            # Another thread is requesting the same data layer
+            event.wait()
+            with self.lock:
+                return self.entries.get(layer_id)
+
+        entry = None
+        try:
+            data_layer = catalog.get_data_layer(layer_id)
+            colors = None
+            if data_layer.color_table is not None and data_layer.color_table.colors is not None:
+                colors = data_layer.color_table.colors
+            entry = {'colors': colors, 'fetched_at': time.time()}
+        except Exception as e:
+            QgsMessageLog.logMessage('The data layer {} could not be requested: {}'.format(layer_id, e), MESSAGE_CATEGORY, Qgis.Warning)
+        finally:
+            with self.lock:
+                self.requests += 1
+                if entry is not None:
+                    self.entries[layer_id] = entry
+                    if save:
+                        self.save()
+                self.pending.pop(layer_id).set()
+        return entry
+
+    def prefetch(self, layer_ids):
+        """
+        Makes sure the metadata of a set of data layers is cached, requesting the missing ones in parallel.
+
+        Args:
+            layer_ids (iterable): The data layer ids.
+
+        Returns:
+            int: The number of data layers that had to be requested.
+        """
+        with self.lock:
+            self.load()
+            missing = sorted({str(i) for i in layer_ids if i is not None and self.fresh(str(i)) is None})
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(PREFETCH_WORKERS, len(missing))) as pool:
+                list(pool.map(lambda layer_id: self.get(layer_id, save=False), missing))
+            with self.lock:
+                self.save()
+        return len(missing)
+
+    def spectrum(self, layer_id):
+        """
+        Returns the color spectrum of a data layer for styling.
+
+        Args:
+            layer_id (str): The data layer id.
+
+        Returns:
+            list: The colors as '#rrggbb' strings, None if the data layer has no color table.
+        """
+        entry = self.get(layer_id)
+        if entry is None or not entry['colors']:
+            return None
+        return ['#' + color for color in entry['colors'].split(',')]
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Color ramp styling of imported results.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+
+from qgis.PyQt.QtGui import QColor
+from qgis.core import (QgsColorRampShader, QgsMessageLog, QgsRasterShader, QgsSingleBandPseudoColorRenderer,
+                       Qgis)
+
+from . import settings
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+# Colors of layers whose data layer has no color table
+DEFAULT_SPECTRUM = ['#153A91','#84F588','#FFF787','#FF7C3B','#FF1921']
+DEFAULT_OPACITY = 0.6
+
+
+def stats_settings():
+    """Returns the stats mode and percentiles the color ramps are stretched with."""
+    mode = settings.value(settings.STATS_MODE_KEY, settings.DEFAULT_STATS_MODE)
+    percentiles = (settings.value(settings.STATS_PERCENTILE_LOW_KEY, settings.DEFAULT_STATS_PERCENTILE_LOW),
+                   settings.value(settings.STATS_PERCENTILE_HIGH_KEY, settings.DEFAULT_STATS_PERCENTILE_HIGH))
+    return mode, percentiles
+
+
+def color_ramp(band_min, band_max, spectrum):
+    """
+    Builds an interpolated color ramp of the spectrum over a value range.
+
+    Args:
+        band_min (float): The lowest value of the range.
+        band_max (float): The highest value of the range.
+        spectrum (list): A list of colors to use for the styling.
+
+    Returns:
+        QgsColorRampShader: The color ramp.
+    """
+    # Prepare the color ramp shader
+    band_range = band_max - band_min
+    class_range = band_range / len(spectrum)
+    fcn = QgsColorRampShader()
+    fcn.setColorRampType(QgsColorRampShader.Interpolated)
+    item_list = []
+
+    # Create color ramp items based on the spectrum
+    for n in range(len(spectrum)):
+        band_min += class_range
+        list_item = QgsColorRampShader.ColorRampItem(band_min, QColor(spectrum[n]), lbl='{0:.2f}-{1:.2f}'.format(band_min-class_range, band_min))
+        item_list.append(list_item)
+    fcn.setColorRampItemList(item_list)
+    return fcn
+
+
+def apply_ramp(layer, ramp, band=1, opacity=DEFAULT_OPACITY):
+    """
+    Renders a band of a raster layer with a color ramp.
+
+    Args:
+        layer (QgsRasterLayer): The raster layer to style.
+        ramp (QgsColorRampShader): The color ramp, the layer gets its own copy as the shader takes ownership.
+        band (int): The band of the raster to use for styling.
+        opacity (float): The opacity of the layer.
+    """
+    shader = QgsRasterShader()
+    shader.setRasterShaderFunction(QgsColorRampShader(ramp))
+    renderer = QgsSingleBandPseudoColorRenderer(layer.dataProvider(), band, shader)
+    layer.setRenderer(renderer)
+    layer.setOpacity(opacity)  # Set layer opacity
+    layer.triggerRepaint()
+
+
+def save_style_sidecar(layer):
+    """
+    Writes the style of a layer to a .qml file next to its source, QGIS applies it whenever the file is opened.
+
+    Args:
+        layer (QgsRasterLayer): The styled layer.
+
+    Returns:
+        str: The .qml file, None if it could not be written.
+    """
+    path = os.path.splitext(layer.source())[0] + '.qml'
+    message, ok = layer.saveNamedStyle(path)
+    if not ok:
+        QgsMessageLog.logMessage('{} the style could not be saved: {}'.format(path, message), MESSAGE_CATEGORY, Qgis.Warning)
+        return None
+    return path
+
+
+class LayerStyler(object):
+    """
+    Styles imported raster layers with the color table of their data layer.
+
+    Everything here reads rasters or the metadata cache only, so it runs in the import task on
+    layers that have not been added to the project yet.
+    """
+
+    def __init__(self, raster_stats, metadata):
+        """
+        Args:
+            raster_stats (RasterStatsStore): The band ranges of the imported rasters.
+            metadata (LayerMetadataCache): The color tables of the data layers.
+        """
+        self.raster_stats = raster_stats
+        self.metadata = metadata
+
+    def style_layers(self, layers):
+        """
+        Styles the layers of a result.
+
+        With shared styling the timestamps of each data layer get one color ramp over their common
+        value range, computed once for all of them, so the frames of a time series are comparable.
+        The same applies to the bands of a time-stack VRT. Other layers are styled on their own.
+
+        Args:
+            layers (list): The LoadedLayers of the result.
+        """
+        series = {}
+        for loaded in layers:
+            series.setdefault(loaded.info.get('datalayerId'), []).append(loaded)
+
+        shared = settings.value(settings.SHARED_STYLING_KEY, settings.DEFAULT_SHARED_STYLING)
+        for dl_id, members in series.items():
+            ramp = None
+            if shared and dl_id is not None and len(members) > 1:
+                ramp = self.series_ramp(dl_id, [loaded.layer.source() for loaded in members], members[0].file)
+            elif shared and dl_id is not None and members[0].info.get('sources'):
+                # A time stack, its bands are the timestamps
+                ramp = self.series_ramp(dl_id, members[0].info['sources'], members[0].file)
+            for loaded in members:
+                if ramp is not None:
+                    apply_ramp(loaded.layer, ramp)
+                else:
+                    self.style_layer(loaded.file, loaded.layer, loaded.info)
+        self.raster_stats.save()
+
+    def series_ramp(self, dl_id, paths, file, band=1):
+        """
+        Returns the color ramp shared by the timestamps of a data layer, None if they have no valid pixels.
+
+        Args:
+            dl_id (str): The data layer id.
+            paths (list): The raster files of the timestamps.
+            file (str): The file named in log messages.
+            band (int): The band of the rasters to use for styling.
+        """
+        mode, percentiles = stats_settings()
+        band_range = self.raster_stats.series_range(paths, band, mode, percentiles)
+        if band_range is None:
+            QgsMessageLog.logMessage('The {} files of the layer {} have no valid pixels'.format(len(paths), dl_id), MESSAGE_CATEGORY, Qgis.Warning)
+            return None
+        spectrum = self.layer_spectrum(file, dl_id) or DEFAULT_SPECTRUM
+        QgsMessageLog.logMessage('The {} files of the layer {} share the range {:.2f}-{:.2f}'.format(len(paths), dl_id, *band_range), MESSAGE_CATEGORY, Qgis.Info)
+        return color_ramp(band_range[0], band_range[1], spectrum)
+
+    def layer_spectrum(self, file, dl_id):
+        """Returns the color spectrum of a data layer, None if it has none."""
+        # Served from the layer metadata cache, prefetched by the download task
+        spectrum = self.metadata.spectrum(dl_id)
+        if spectrum is None:
+            QgsMessageLog.logMessage('{} the spectrum could not be found for the layer {}'.format(file, dl_id), MESSAGE_CATEGORY, Qgis.Warning)
+        return spectrum
+
+    def style_layer(self, file, layer, info):
+        """
+        Styles a raster layer with the color table of its data layer.
+
+        Args:
+            file (str): The file path of the raster file.
+            layer (QgsRasterLayer): The layer of the file.
+            info (dict): The output.info entry of the file.
+        """
+        # Determine data layer id of the file
+        dl_id = info.get('datalayerId')
+        if dl_id is None:
+            QgsMessageLog.logMessage('{} the data layer id could not be found'.format(file), MESSAGE_CATEGORY, Qgis.Warning)
+
+        spectrum = None
+        if dl_id is not None:
+            spectrum = self.layer_spectrum(file, dl_id)
+
+        if spectrum is not None:
+            QgsMessageLog.logMessage('{} the spectrum {} will be applied'.format(file, str(spectrum)), MESSAGE_CATEGORY, Qgis.Info)
+            self.style(layer, spectrum=spectrum)
+        else:
+            self.style(layer)
+
+    def style(self, layer, band=1, spectrum=DEFAULT_SPECTRUM, opacity=DEFAULT_OPACITY):
+        """
+        Styles a raster layer with a color ramp of the spectrum over the value range of its band.
+
+        Args:
+            layer (QgsRasterLayer): The raster layer to style.
+            band (int): The band of the raster to use for styling.
+            spectrum (list): A list of colors to use for the styling.
+            opacity (float): The opacity of the layer.
+        """
+        # Value range in the configured stats mode, computed once per file and kept in the stats store
+        mode, percentiles = stats_settings()
+        band_range = self.raster_stats.band_range(layer.source(), band, mode, percentiles)
+        if band_range is None:
+            QgsMessageLog.logMessage('{} has no valid pixels, the layer is not styled'.format(layer.source()), MESSAGE_CATEGORY, Qgis.Warning)
+            return
+        apply_ramp(layer, color_ramp(band_range[0], band_range[1], spectrum), band, opacity)
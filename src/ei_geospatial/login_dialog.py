@@ -13,7 +13,7 @@
 import os
 
 from qgis.PyQt import uic
-from qgis.core import QgsApplication, Qgis
+from qgis.core import QgsApplication, QgsTask, Qgis
 from PyQt5 import QtWidgets
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtGui import QIcon
@@ -21,11 +21,11 @@ from qgis.PyQt.QtWidgets import QApplication
 from PyQt5.QtCore import Qt, QSettings
 
 from qgis.PyQt.QtGui import QIcon
+from . import settings
+from .catalog_refresh import log_refresh, refresh_catalog
 from .ibmpairsdialog import IBMPairsDialog
+from .session import PooledClient
 import ibmpairs.client as client
-import ibmpairs.catalog as catalog
-import datetime
-import json
 import os
 
 SETTINGS_NAMESPACE="ibm_pairs"
@@ -83,8 +83,16 @@ class LoginDialog(QtWidgets.QDialog, FORM_CLASS):
         tenant = self.tenantEdit.text()
         org = self.orgEdit.text()
 
+        previous = client.GLOBAL_PAIRS_CLIENT
         auth = client.get_client(api_key=api, tenant_id=tenant, org_id=org, legacy=False)
 
+        if auth:
+            # All requests share the pooled session of one client, which replaces the global client
+            pool_size = settings.value(settings.HTTP_POOL_SIZE_KEY, settings.DEFAULT_HTTP_POOL_SIZE)
+            auth = PooledClient.from_client(auth, pool_size=max(1, pool_size))
+            if isinstance(previous, PooledClient):
+                previous.close()
+
         if not auth:
             QMessageBox.information(self.iface.mainWindow(), \
             QCoreApplication.translate('IBMPairsConnector', "IBM Geospatial APIs plugin error"), \
@@ -93,45 +101,26 @@ class LoginDialog(QtWidgets.QDialog, FORM_CLASS):
 
         return auth
     
-    def catalog(self):
+    def catalog(self, refreshed=None, failed=None):
         """
-        Retrieve catalog information in order to load in the dialog.
+        Refreshes the catalog information shown in the dialog in a background task.
+        The cached catalog stays in use until the task has fetched what changed.
+        :param refreshed: Called with the task result on the main thread if the catalog changed.
+        :param failed: Called on the main thread if the refresh failed or was cancelled.
+        :return: The task, keep a reference to it while it runs.
         """
-        
-        dsets_path = os.path.join(os.path.dirname(__file__),'data_sets.json')
-        layer_path = os.path.join(os.path.dirname(__file__),'data_layers.json')
-        if not os.path.isfile(dsets_path):
-            cat_dset = catalog.get_data_sets().to_json()
-            f = open(dsets_path, "w")
-            f.write(cat_dset)
-            f.close()
-        else:
-            today = datetime.datetime.today()
-            modified_date = datetime.datetime.fromtimestamp(os.path.getmtime(dsets_path))
-            duration = today - modified_date
-            # Refresh the catalog every 15 days
-            if duration.days > 15:
-                cat_dset = catalog.get_data_sets().to_json()
-                f = open(dsets_path, "w")
-                f.write(cat_dset)
-                f.close()
-                    
-        # Now handle layers
-        if not os.path.isfile(layer_path):
-            cat_layers = catalog.get_data_layers().to_json()
-            f = open(layer_path, "w")
-            f.write(cat_layers)
-            f.close()
-        else:
-            today = datetime.datetime.today()
-            modified_date = datetime.datetime.fromtimestamp(os.path.getmtime(dsets_path))
-            duration = today - modified_date
-            # Refresh the catalog every 15 days
-            if duration.days > 15:
-                cat_layers = catalog.get_data_layers().to_json()
-                f = open(layer_path, "w")
-                f.write(cat_layers)
-                f.close()
+        def finished(exception, result=None):
+            log_refresh(exception, result)
+            if exception is None and result and result['changed'] and refreshed is not None:
+                refreshed(result)
+            elif (exception is not None or result is None) and failed is not None:
+                failed()
+
+        max_age = settings.value(settings.CATALOG_MAX_AGE_DAYS_KEY, settings.DEFAULT_CATALOG_MAX_AGE_DAYS) * 86400
+        task = QgsTask.fromFunction('ei geospatial apis: refreshing the catalog', refresh_catalog, on_finished=finished,
+                                    folder=os.path.dirname(__file__), max_age=max_age)
+        QgsApplication.taskManager().addTask(task)
+        return task
 
     def login(self):
         """
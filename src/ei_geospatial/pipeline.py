@@ -0,0 +1,693 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Submission pipeline that runs many Geospatial APIs
+                       queries through a bounded pool of QgsTasks.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import datetime
+import itertools
+import os
+import time
+from collections import deque
+from functools import partial
+
+import ibmpairs.query as query
+from qgis.PyQt.QtCore import QObject, QTimer, pyqtSignal
+from qgis.core import QgsApplication, QgsMessageLog, QgsTask, Qgis
+
+from . import settings
+from .cache import query_hash
+from .download import DownloadCanceled, stream_download
+from .layer_metadata import referenced_layer_ids
+from .polling import RUNNING_STATUS_CODES, SUCCEEDED_STATUS_CODE, QueryPoller
+from .raster_optimize import optimize_rasters
+from .splitting import index_output_info, mosaic_files
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+# Life cycle of a query in the pipeline
+PENDING = 'pending'
+SUBMITTING = 'submitting'
+RUNNING = 'running'
+DOWNLOADING = 'downloading'
+COMPLETED = 'completed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+ACTIVE_STATES = [SUBMITTING, RUNNING, DOWNLOADING]
+FINISHED_STATES = [COMPLETED, FAILED, CANCELLED]
+
+# Number of finished records kept in the task table for reporting
+FINISHED_HISTORY = 100
+
+
+def result_files(ibmpairs_query):
+    """
+    Returns the raster result files of a downloaded query.
+
+    Args:
+        ibmpairs_query (ibmpairs.query.Query): A downloaded query.
+
+    Returns:
+        list: The paths of the .tiff files.
+    """
+    return [f for f in ibmpairs_query.list_files() if f.endswith('.tiff') and not f.endswith('.tiff.json')]
+
+
+class QueryRecord(object):
+    """A query handled by the pipeline together with its task and state."""
+
+    def __init__(self, key, query_json, download_folder, group=None, retries=0):
+        self.key = key
+        self.query_json = query_json
+        self.download_folder = download_folder
+        self.group = group
+        self.retries = retries
+        self.cache_key = None
+        self.cached = False
+        # The job index entry of the job the query joined instead of being submitted
+        self.joined = None
+        self.joinable = True
+        # Identical queries of this session that joined the job of this record and finish with it
+        self.followers = []
+        self.files = []
+        self.query = None
+        self.task = None
+        self.state = PENDING
+        self.error = None
+        self.created_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def query_id(self):
+        return self.query.id if self.query is not None else None
+
+    def label(self):
+        """Returns the query id once known, otherwise the local key."""
+        return self.query_id if self.query_id is not None else '#{}'.format(self.key)
+
+
+class QueryGroup(object):
+    """The chunks of a split query, mosaicked once every chunk has finished."""
+
+    def __init__(self, key, folder):
+        self.key = key
+        self.folder = folder
+        self.records = []
+        self.files = []
+        self.task = None
+        # False if the group was rebuilt from a journal without its chunk list, it is then not mosaicked
+        self.complete = True
+
+    def finished(self):
+        return all(record.state in FINISHED_STATES for record in self.records)
+
+
+class TaskTable(object):
+    """
+    Registry of the queries handled by the plugin.
+
+    Records are keyed by a local sequence number because a query only gets its id once it is
+    submitted. Finished records drop their task and are pruned to a bounded history, so the
+    table does not grow with the number of queries run in a session.
+    """
+
+    def __init__(self, history=FINISHED_HISTORY):
+        self.records = {}
+        self.by_query_id = {}
+        self.history = history
+        self.counter = itertools.count(1)
+        self.finished = deque()
+
+    def add(self, query_json, download_folder, group=None, retries=0):
+        record = QueryRecord(next(self.counter), query_json, download_folder, group, retries)
+        self.records[record.key] = record
+        if group is not None:
+            group.records.append(record)
+        return record
+
+    def unbind(self, record):
+        """Removes the query id index of a record that is going to be resubmitted."""
+        if record.query_id is not None:
+            self.by_query_id.pop(record.query_id, None)
+        record.query = None
+
+    def bind(self, record):
+        """Indexes a record by its query id once the query has been submitted."""
+        self.by_query_id[record.query_id] = record
+
+    def find(self, query_id):
+        return self.by_query_id.get(query_id)
+
+    def set_state(self, record, state, error=None):
+        record.state = state
+        if error is not None:
+            record.error = error
+        if state in FINISHED_STATES:
+            record.task = None
+            record.finished_at = time.monotonic()
+            self.finished.append(record)
+            self.prune()
+
+    def prune(self):
+        while len(self.finished) > self.history:
+            record = self.finished.popleft()
+            self.records.pop(record.key, None)
+            if record.query_id is not None:
+                self.by_query_id.pop(record.query_id, None)
+
+    def in_state(self, *states):
+        return [record for record in self.records.values() if record.state in states]
+
+    def counts(self):
+        """Returns the number of records per state."""
+        counts = {}
+        for record in self.records.values():
+            counts[record.state] = counts.get(record.state, 0) + 1
+        return counts
+
+
+class QueryPipeline(QObject):
+    """
+    Submits queries through a bounded pool and downloads their results as they finish.
+
+    At most ``max_concurrent`` queries are submitting, running on the backend or downloading at
+    any time, further queries wait in a queue and are submitted as earlier ones finish, at most one
+    every ``submit_interval`` seconds.
+    """
+
+    downloaded = pyqtSignal(object)
+    failed = pyqtSignal(object)
+    mosaicked = pyqtSignal(object)
+    # A split query none of whose chunks completed or whose mosaic could not be built
+    mosaic_failed = pyqtSignal(object)
+
+    def __init__(self, parent=None, max_concurrent=None, cache=None, metadata=None, journal=None, job_index=None,
+                 submit_interval=0.0):
+        super(QueryPipeline, self).__init__(parent)
+        self.table = TaskTable()
+        self.pending = deque()
+        self.max_concurrent = max_concurrent
+        self.cache = cache
+        self.metadata = metadata
+        self.journal = journal
+        self.job_index = job_index
+        self.submit_interval = submit_interval
+        self.last_submit = None
+        self.fill_scheduled = False
+        # Split queries whose chunks are being mosaicked
+        self.mosaicking = set()
+        # Split queries that are not mosaicked yet, by key
+        self.groups = {}
+        # Set while the plugin is unloaded, the journal then keeps the cancelled queries for reattaching
+        self.closing = False
+        self.poller = QueryPoller(self)
+        self.poller.ready.connect(self.start_download)
+        self.poller.failed.connect(self.query_failed)
+
+    def concurrency_limit(self):
+        if self.max_concurrent is not None:
+            return self.max_concurrent
+        return max(1, settings.value(settings.MAX_CONCURRENT_QUERIES_KEY, settings.DEFAULT_MAX_CONCURRENT_QUERIES))
+
+    def enqueue(self, query_jsons, download_folder, group=None, retries=0):
+        """
+        Queues queries for submission.
+
+        Args:
+            query_jsons (list): Query dictionaries as accepted by ibmpairs.query.Query.from_json.
+            download_folder (str): The folder the results are downloaded to.
+            group (QueryGroup): The split query the queries are chunks of, if any.
+            retries (int): How often a failed query is resubmitted on its own.
+
+        Returns:
+            list: The QueryRecords created for the queries.
+        """
+        records = [self.table.add(query_json, download_folder, group, retries) for query_json in query_jsons]
+
+        # Results found in the cache are loaded straight away, only misses are submitted
+        hits = []
+        for record in records:
+            if self.cache is not None or self.job_index is not None:
+                record.cache_key = query_hash(record.query_json)
+            if self.cache is not None:
+                files = self.cache.lookup(record.cache_key)
+                if files is not None:
+                    record.files = files
+                    record.cached = True
+                    hits.append(record)
+                    continue
+            self.pending.append(record)
+
+        QgsMessageLog.logMessage('{} queries queued, {} waiting'.format(len(records), len(self.pending)), MESSAGE_CATEGORY, Qgis.Info)
+        if self.cache is not None:
+            self.log_cache_report()
+
+        for record in hits:
+            QgsMessageLog.logMessage('{} result loaded from the cache ({})'.format(record.label(), record.cache_key), MESSAGE_CATEGORY, Qgis.Info)
+            self.finish(record, COMPLETED)
+        self.fill()
+        return records
+
+    def log_cache_report(self):
+        """Writes the result cache hit/miss counters to the QGIS message log."""
+        report = self.cache.report()
+        QgsMessageLog.logMessage('Result cache: {} hits, {} misses ({:.0%} hit ratio), {} entries, {:.1f} MB'.format(
+            report['hits'], report['misses'], report['hit_ratio'], report['entries'], report['bytes'] / 1048576.0), MESSAGE_CATEGORY, Qgis.Info)
+
+    def enqueue_split(self, chunks, download_folder, retries=0):
+        """
+        Queues the chunks of a split query; their results are mosaicked once all chunks have finished.
+
+        Args:
+            chunks (list): The chunk queries as returned by splitting.split_query.
+            download_folder (str): The folder the results are downloaded to.
+            retries (int): How often a failed chunk is resubmitted on its own.
+
+        Returns:
+            QueryGroup: The group of the chunks.
+        """
+        name = 'split_{}'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f'))
+        group = QueryGroup(name, os.path.join(download_folder, name))
+        QgsMessageLog.logMessage('{} query split into {} chunks'.format(name, len(chunks)), MESSAGE_CATEGORY, Qgis.Info)
+        self.groups[name] = group
+        if self.journal is not None:
+            self.journal.split(group, chunks, download_folder, retries)
+        self.enqueue(chunks, download_folder, group, retries)
+        return group
+
+    def fill(self):
+        """Submits queued queries until the concurrency limit is reached."""
+        active = len(self.table.in_state(*ACTIVE_STATES))
+        while self.pending and active < self.concurrency_limit():
+            if self.submit_interval and self.last_submit is not None:
+                wait = self.last_submit + self.submit_interval - time.monotonic()
+                if wait > 0:
+                    if not self.fill_scheduled:
+                        self.fill_scheduled = True
+                        QTimer.singleShot(int(wait * 1000) + 1, self.scheduled_fill)
+                    return
+            record = self.pending.popleft()
+            if record.state != PENDING:
+                continue
+            self.last_submit = time.monotonic()
+            self.table.set_state(record, SUBMITTING)
+            record.task = QgsTask.fromFunction('ei geospatial apis: submitting {}'.format(record.label()), self.submit_task,
+                                               on_finished=partial(self.submit_completed, record), record=record)
+            QgsApplication.taskManager().addTask(record.task)
+            active += 1
+
+    def scheduled_fill(self):
+        self.fill_scheduled = False
+        self.fill()
+
+    def busy(self):
+        """Returns whether queries are queued, submitting, running, downloading or being mosaicked."""
+        return bool(self.pending or self.table.in_state(*ACTIVE_STATES) or self.mosaicking)
+
+    def submit_task(self, task, record):
+        """Builds and submits a query or joins the indexed job of an identical query, runs in a background thread."""
+        if task.isCanceled():
+            return None
+        joined = self.join_job(record)
+        if joined is not None:
+            return joined
+        my_query = query.Query.from_json(record.query_json)
+        my_query.set_download_folder(record.download_folder)
+        my_query.submit()
+        if self.job_index is not None and my_query.id is not None:
+            self.job_index.publish(record.cache_key, my_query.id)
+        return my_query
+
+    def join_job(self, record):
+        """
+        Looks up the query hash in the job index and returns a query pointing at the indexed job if
+        that job is still running or has succeeded, so it is polled and downloaded instead of
+        submitting the same query again. Jobs that failed or are unknown to the backend are
+        removed from the index.
+
+        Args:
+            record (QueryRecord): The record of the query about to be submitted.
+
+        Returns:
+            ibmpairs.query.Query: The query of the joined job, None if the query has to be submitted.
+        """
+        if self.job_index is None or record.cache_key is None or not record.joinable:
+            return None
+        entry = self.job_index.lookup(record.cache_key)
+        if entry is None:
+            return None
+        my_query = query.Query.from_json(record.query_json)
+        my_query.set_download_folder(record.download_folder)
+        my_query.id = entry['query_id']
+        try:
+            my_query.status(poll=False)
+            status_code = my_query.status_response.status_code
+        except Exception as e:
+            QgsMessageLog.logMessage('{} the status of the indexed job could not be checked: {}'.format(entry['query_id'], e), MESSAGE_CATEGORY, Qgis.Warning)
+            status_code = None
+        if status_code not in RUNNING_STATUS_CODES + [SUCCEEDED_STATUS_CODE]:
+            self.job_index.forget(record.cache_key, entry['query_id'])
+            return None
+        record.joined = entry
+        self.job_index.joined()
+        return my_query
+
+    def submit_completed(self, record, exception, result=None):
+        if exception is not None:
+            self.finish(record, FAILED, str(exception))
+            return
+        if result is None:
+            self.finish(record, CANCELLED)
+            return
+        if result.id is None:
+            self.finish(record, FAILED, 'the query was not submitted')
+            return
+
+        record.query = result
+        record.task = None
+        leader = self.table.find(result.id)
+        if leader is not None and leader is not record and leader.state in (RUNNING, DOWNLOADING):
+            # An identical query of this session runs the job already, it is polled and downloaded once
+            self.table.set_state(record, RUNNING)
+            leader.followers.append(record)
+            QgsMessageLog.logMessage('{} joined the job of query #{} of this session'.format(result.id, leader.key), MESSAGE_CATEGORY, Qgis.Info)
+            return
+        self.table.bind(record)
+        self.table.set_state(record, RUNNING)
+        if self.journal is not None:
+            self.journal.submitted(result.id, record.query_json, record.download_folder, record.cache_key,
+                                   record.group, record.retries,
+                                   record.group.records.index(record) if record.group is not None else None)
+        if record.joined is not None:
+            QgsMessageLog.logMessage('{} joined the job submitted by {} on {} {:.0f} minutes ago ({} submissions avoided)'.format(
+                result.id, record.joined.get('user'), record.joined.get('host'), (time.time() - record.joined['submitted_at']) / 60.0,
+                self.job_index.report()['avoided']), MESSAGE_CATEGORY, Qgis.Info)
+        else:
+            QgsMessageLog.logMessage('{} Query Submitted'.format(result.id), MESSAGE_CATEGORY, Qgis.Info)
+        self.poller.track(result)
+
+    def resume(self):
+        """
+        Reattaches to the queries the journal lists as still running or downloading, e.g. after QGIS
+        was closed or crashed. They are polled and downloaded under their query id like queries
+        submitted in this session, nothing is submitted again.
+
+        Split queries are rebuilt with all their chunks: chunks downloaded before the restart keep
+        their files, running ones are reattached and chunks that were still queued are submitted,
+        so the mosaic covers the whole query. Groups journaled without their chunk list cannot be
+        rebuilt; their chunks are downloaded but not mosaicked.
+
+        Returns:
+            list: The QueryRecords of the reattached queries.
+        """
+        if self.journal is None:
+            return []
+        records = []
+        for journal_group in self.journal.unfinished_groups():
+            if journal_group.key not in self.groups:
+                records.extend(self.resume_group(journal_group))
+
+        groups = {}
+        for entry in self.journal.unfinished():
+            if self.table.find(entry.query_id) is not None or entry.group_key in self.groups:
+                continue
+            group = None
+            if entry.group_key is not None:
+                if entry.group_key not in groups:
+                    groups[entry.group_key] = QueryGroup(entry.group_key, entry.group_folder)
+                    groups[entry.group_key].complete = False
+                group = groups[entry.group_key]
+            record = self.table.add(entry.query_json, entry.download_folder, group, entry.retries)
+            if self.reattach(record, entry):
+                records.append(record)
+        if records:
+            QgsMessageLog.logMessage('{} queries reattached from the job journal'.format(len(records)), MESSAGE_CATEGORY, Qgis.Info)
+        self.fill()
+        return records
+
+    def reattach(self, record, entry):
+        """Polls the journaled job of a record again, returns False if the journaled query cannot be read."""
+        try:
+            ibmpairs_query = query.Query.from_json(entry.query_json)
+        except Exception as e:
+            self.journal.update(entry.query_id, FAILED, 'the query could not be read: {}'.format(e))
+            self.table.set_state(record, FAILED, str(e))
+            return False
+        ibmpairs_query.set_download_folder(entry.download_folder)
+        ibmpairs_query.id = entry.query_id
+        record.cache_key = entry.cache_key
+        record.query = ibmpairs_query
+        self.table.bind(record)
+        self.table.set_state(record, RUNNING)
+        self.poller.track(ibmpairs_query)
+        QgsMessageLog.logMessage('{} reattached to the query submitted {}'.format(
+            entry.query_id, datetime.datetime.fromtimestamp(entry.submitted_at).strftime('%Y-%m-%d %H:%M')), MESSAGE_CATEGORY, Qgis.Info)
+        return True
+
+    def resume_group(self, journal_group):
+        """
+        Rebuilds a split query from the journal with a record for every chunk.
+
+        Args:
+            journal_group (JournalGroup): The split query and the latest job of each chunk.
+
+        Returns:
+            list: The records of the reattached chunks.
+        """
+        group = QueryGroup(journal_group.key, journal_group.folder)
+        self.groups[group.key] = group
+        reattached = []
+        counts = {COMPLETED: 0, FAILED: 0, PENDING: 0}
+        for n, chunk_json in enumerate(journal_group.chunks):
+            entry = journal_group.jobs.get(n)
+            record = self.table.add(chunk_json, journal_group.download_folder, group, journal_group.retries)
+            if entry is not None and entry.state in (RUNNING, DOWNLOADING):
+                if self.reattach(record, entry):
+                    reattached.append(record)
+                continue
+            if entry is not None and entry.state == COMPLETED and entry.files and all(os.path.exists(f) for f in entry.files):
+                record.files = entry.files
+                self.table.set_state(record, COMPLETED)
+            elif entry is not None and entry.state == FAILED:
+                self.table.set_state(record, FAILED, 'failed before the restart')
+            else:
+                # Queued, cancelled or downloaded files gone: the chunk runs again, from the cache if it has it
+                record.cache_key = query_hash(chunk_json)
+                files = self.cache.lookup(record.cache_key) if self.cache is not None else None
+                if files is not None:
+                    record.files = files
+                    record.cached = True
+                    self.table.set_state(record, COMPLETED)
+                else:
+                    self.pending.append(record)
+                    counts[PENDING] += 1
+                    continue
+            counts[record.state] += 1
+        QgsMessageLog.logMessage('{} split query resumed: {} chunks done, {} failed, {} reattached, {} submitted again'.format(
+            group.key, counts[COMPLETED], counts[FAILED], len(reattached), counts[PENDING]), MESSAGE_CATEGORY, Qgis.Info)
+        if group.finished():
+            self.start_mosaic(group)
+        return reattached
+
+    def start_download(self, ibmpairs_query):
+        """Starts a download task for a query reported as succeeded by the poller."""
+        record = self.table.find(ibmpairs_query.id)
+        if record is None:
+            return
+        QgsMessageLog.logMessage('{} Query Downloading'.format(ibmpairs_query.id), MESSAGE_CATEGORY, Qgis.Info)
+        self.table.set_state(record, DOWNLOADING)
+        if self.journal is not None:
+            self.journal.update(ibmpairs_query.id, DOWNLOADING)
+        record.task = QgsTask.fromFunction('ei geospatial apis: {}'.format(ibmpairs_query.id), self.download_task,
+                                           on_finished=partial(self.download_completed, record), record=record)
+        QgsApplication.taskManager().addTask(record.task)
+
+    def download_task(self, task, record):
+        """
+        Downloads the result of a query whose status has been reported as succeeded by the poller,
+        adds overviews to the files or converts them to COG, adds them to the result cache and
+        prefetches the metadata of their data layers for styling.
+
+        Args:
+            task (QgsTask): The task the download runs in.
+            record (QueryRecord): The pipeline record of the query to download.
+        """
+        ibmpairs_query = record.query
+        QgsMessageLog.logMessage('{} started task query.download()'.format(str(ibmpairs_query.id)), MESSAGE_CATEGORY, Qgis.Info)
+
+        if task.isCanceled():
+            return None
+
+        if settings.value(settings.STREAMING_DOWNLOAD_KEY, settings.DEFAULT_STREAMING_DOWNLOAD):
+            try:
+                stream_download(ibmpairs_query, task)
+            except DownloadCanceled as e:
+                QgsMessageLog.logMessage(str(e), MESSAGE_CATEGORY, Qgis.Warning)
+                return None
+        else:
+            ibmpairs_query.download()
+        QgsMessageLog.logMessage('{} successfully completed download'.format(str(ibmpairs_query.id)), MESSAGE_CATEGORY, Qgis.Info)
+
+        record.files = result_files(ibmpairs_query)
+        self.optimize(record, task)
+        if task.isCanceled():
+            return None
+        if self.cache is not None and record.cache_key is not None:
+            try:
+                self.cache.store(record.cache_key, record.files, ibmpairs_query.id)
+            except OSError as e:
+                QgsMessageLog.logMessage('{} the result could not be cached: {}'.format(ibmpairs_query.id, e), MESSAGE_CATEGORY, Qgis.Warning)
+        if self.metadata is not None:
+            self.metadata.prefetch(referenced_layer_ids(index_output_info(record.files)))
+
+        return ibmpairs_query
+
+    def optimize(self, record, task):
+        """Runs the configured overview or COG stage over the downloaded files and logs what it cost and saved."""
+        mode = settings.value(settings.OPTIMIZE_MODE_KEY, settings.DEFAULT_OPTIMIZE_MODE)
+        report = optimize_rasters(record.files, mode,
+                                  settings.value(settings.OPTIMIZE_COMPRESSION_KEY, settings.DEFAULT_OPTIMIZE_COMPRESSION),
+                                  settings.value(settings.OPTIMIZE_TILE_SIZE_KEY, settings.DEFAULT_OPTIMIZE_TILE_SIZE), task)
+        if report['files'] or report['failed']:
+            saved = report['bytes_before'] - report['bytes_after']
+            QgsMessageLog.logMessage('{} {} of {} files optimized ({}) in {:.2f} s, {} failed, {:.1f} MB {}'.format(
+                record.label(), report['files'], len(record.files), mode, report['seconds'], report['failed'],
+                abs(saved) / 1048576.0, 'saved' if saved >= 0 else 'added'), MESSAGE_CATEGORY, Qgis.Info)
+
+    def download_completed(self, record, exception, result=None):
+        if exception is not None:
+            self.finish(record, FAILED, str(exception))
+        elif result is None:
+            QgsMessageLog.logMessage('{} completed with no exception and no result (probably manually canceled by the user)'.format(record.label()), MESSAGE_CATEGORY, Qgis.Warning)
+            self.finish(record, CANCELLED)
+        else:
+            self.poller.record_download(result.id)
+            self.finish(record, COMPLETED)
+
+    def query_failed(self, ibmpairs_query, message):
+        record = self.table.find(ibmpairs_query.id)
+        if record is not None:
+            self.finish(record, FAILED, message)
+
+    def finish(self, record, state, error=None):
+        """Moves a record to a finished state, reports it and submits the next queued query."""
+        if record.query_id is not None:
+            # Failed, cancelled or resubmitted under a new id, the poller has nothing more to do with the job
+            self.poller.untrack(record.query_id)
+        if self.journal is not None and record.query_id is not None and not (state == CANCELLED and self.closing):
+            self.journal.update(record.query_id, state, error, record.files if state == COMPLETED else None)
+        if state == FAILED and record.joined is not None:
+            # The joined job failed or its result is gone, the query is submitted after all
+            QgsMessageLog.logMessage('{} the joined job failed, submitting the query: {}'.format(record.label(), error), MESSAGE_CATEGORY, Qgis.Warning)
+            self.job_index.forget(record.cache_key, record.query_id)
+            record.joined = None
+            record.joinable = False
+            self.table.unbind(record)
+            self.table.set_state(record, PENDING, error)
+            self.pending.append(record)
+            self.fill()
+            return
+        if state == FAILED and record.retries > 0:
+            record.retries -= 1
+            QgsMessageLog.logMessage('{} failed, resubmitting ({} retries left): {}'.format(record.label(), record.retries, error), MESSAGE_CATEGORY, Qgis.Warning)
+            self.table.unbind(record)
+            self.table.set_state(record, PENDING, error)
+            self.pending.append(record)
+            self.fill()
+            return
+
+        self.table.set_state(record, state, error)
+        if state == COMPLETED and record.group is None:
+            self.downloaded.emit(record)
+        elif state == FAILED:
+            QgsMessageLog.logMessage('{} failed: {}'.format(record.label(), error), MESSAGE_CATEGORY, Qgis.Critical)
+            self.failed.emit(record)
+        followers, record.followers = record.followers, []
+        for follower in followers:
+            # The leader's retries are spent, followers share its result or error instead of resubmitting
+            follower.files = record.files
+            follower.joined = None
+            follower.retries = 0
+            self.finish(follower, state, error)
+        # While closing, chunks finish as cancelled and the group is rebuilt by resume instead
+        if record.group is not None and record.group.finished() and not self.closing:
+            self.start_mosaic(record.group)
+        self.fill()
+        if self.job_index is not None and not self.table.in_state(PENDING, *ACTIVE_STATES):
+            report = self.job_index.report()
+            QgsMessageLog.logMessage('Job index: {} lookups, {} submissions avoided by joining existing jobs'.format(
+                report['lookups'], report['avoided']), MESSAGE_CATEGORY, Qgis.Info)
+
+    def start_mosaic(self, group):
+        """Starts a task building the VRT mosaics of a split query whose chunks have all finished."""
+        if not group.complete:
+            QgsMessageLog.logMessage('{} the split query could not be rebuilt completely from the job journal, its {} reattached chunks are not mosaicked'.format(
+                group.key, len(group.records)), MESSAGE_CATEGORY, Qgis.Warning)
+            self.group_finished(group, FAILED)
+            return
+        completed = [record for record in group.records if record.state == COMPLETED]
+        if len(completed) < len(group.records):
+            QgsMessageLog.logMessage('{} {} of {} chunks failed, mosaicking the remaining chunks'.format(group.key, len(group.records) - len(completed), len(group.records)), MESSAGE_CATEGORY, Qgis.Warning)
+        if not completed:
+            self.group_finished(group, FAILED)
+            return
+        self.mosaicking.add(group.key)
+        group.task = QgsTask.fromFunction('ei geospatial apis: mosaicking {}'.format(group.key), self.mosaic_task,
+                                          on_finished=partial(self.mosaic_completed, group), group=group, records=completed)
+        QgsApplication.taskManager().addTask(group.task)
+
+    def mosaic_task(self, task, group, records):
+        """Builds the VRT mosaics of a split query, runs in a background thread."""
+        files = []
+        for record in records:
+            files.extend(record.files)
+        return mosaic_files(files, group.folder)
+
+    def mosaic_completed(self, group, exception, result=None):
+        group.task = None
+        self.mosaicking.discard(group.key)
+        if exception is not None:
+            QgsMessageLog.logMessage('{} mosaic failed: {}'.format(group.key, exception), MESSAGE_CATEGORY, Qgis.Critical)
+            self.group_finished(group, FAILED)
+            return
+        group.files = result or []
+        QgsMessageLog.logMessage('{} mosaicked into {} layers'.format(group.key, len(group.files)), MESSAGE_CATEGORY, Qgis.Info)
+        self.group_finished(group, COMPLETED)
+
+    def group_finished(self, group, state):
+        """Journals and reports a split query that was mosaicked or could not be."""
+        self.groups.pop(group.key, None)
+        if self.journal is not None:
+            self.journal.group_finished(group.key, state)
+        if state == COMPLETED:
+            self.mosaicked.emit(group)
+        else:
+            self.mosaic_failed.emit(group)
+
+    def cancel_all(self):
+        """
+        Cancels queued queries and running tasks (called when the plugin is unloaded). Submitted
+        queries stay unfinished in the journal and are reattached by resume.
+        """
+        self.closing = True
+        self.poller.stop()
+        while self.pending:
+            self.table.set_state(self.pending.popleft(), CANCELLED)
+        for record in self.table.in_state(*ACTIVE_STATES):
+            if record.task is not None:
+                record.task.cancel()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Shared status polling scheduler for submitted Geospatial
+                       APIs queries.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import random
+import time
+
+from qgis.PyQt.QtCore import QObject, QTimer, pyqtSignal
+from qgis.core import QgsApplication, QgsMessageLog, QgsTask, Qgis
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+# Query job status codes:
+#   Queued(0), Initializing(1), Running(10), Writing(11), Packaging(12), Succeeded(20)
+RUNNING_STATUS_CODES = [0, 1, 10, 11, 12]
+SUCCEEDED_STATUS_CODE = 20
+
+# Backoff per status code as (first delay, growth factor, maximum delay) in seconds.
+# Queued and initializing jobs wait for backend resources and are polled slowly,
+# writing and packaging jobs are about to finish and are polled quickly.
+BACKOFF_SCHEDULE = {
+    0:  (10.0, 2.0, 120.0),
+    1:  (10.0, 2.0, 60.0),
+    10: (5.0, 1.5, 60.0),
+    11: (2.0, 1.5, 15.0),
+    12: (2.0, 1.5, 10.0),
+}
+DEFAULT_BACKOFF = (5.0, 2.0, 60.0)
+# Fraction of each delay that is randomised so queries submitted together spread out.
+JITTER = 0.25
+# Consecutive failed status requests tolerated before a query is given up.
+MAX_STATUS_ERRORS = 5
+TICK_INTERVAL_MS = 1000
+
+
+def backoff_delay(status_code, attempt, jitter=JITTER):
+    """
+    Returns the number of seconds to wait before the next status poll.
+
+    Args:
+        status_code (int): The last status code reported for the query.
+        attempt (int): How many polls in a row returned this status code.
+        jitter (float): Fraction of the delay to randomise.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    first, factor, maximum = BACKOFF_SCHEDULE.get(status_code, DEFAULT_BACKOFF)
+    delay = min(first * (factor ** attempt), maximum)
+    return delay * (1.0 - jitter * random.random())
+
+
+class PollEntry(object):
+    """Book keeping for a single query tracked by the QueryPoller."""
+
+    def __init__(self, ibmpairs_query):
+        self.query = ibmpairs_query
+        self.status_code = None
+        self.attempt = 0
+        self.errors = 0
+        self.polls = 0
+        self.submitted_at = time.monotonic()
+        self.ready_at = None
+        self.next_poll = self.submitted_at + backoff_delay(0, 0)
+
+
+class QueryPoller(QObject):
+    """
+    Polls the status of all outstanding queries from a single timer.
+
+    Every tick the queries whose backoff delay has elapsed are collected and their status is
+    checked in one background QgsTask, so the number of worker threads does not grow with the
+    number of queries and no thread is pinned while a query waits on the backend.
+    """
+
+    ready = pyqtSignal(object)
+    failed = pyqtSignal(object, str)
+
+    def __init__(self, parent=None, tick_interval=TICK_INTERVAL_MS):
+        super(QueryPoller, self).__init__(parent)
+        self.entries = {}
+        self.batch_task = None
+        # Submission times of the queries that are ready but not downloaded yet
+        self.downloading = {}
+        # Running totals of the queries that left the poller, their entries are dropped so long sessions do not grow
+        self.totals = {'queries': 0, 'status_polls': 0, 'max_polls': 0, 'ready': 0, 'ready_seconds': 0.0,
+                       'downloaded': 0, 'download_seconds': 0.0}
+        self.timer = QTimer(self)
+        self.timer.setInterval(tick_interval)
+        self.timer.timeout.connect(self.tick)
+
+    def track(self, ibmpairs_query):
+        """
+        Starts polling a submitted query.
+
+        Args:
+            ibmpairs_query (ibmpairs.query.Query): A query that has been submitted.
+        """
+        self.entries[ibmpairs_query.id] = PollEntry(ibmpairs_query)
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def untrack(self, query_id):
+        """Forgets a query the pipeline has given up on or finished, whether it is still polled or waits for its download."""
+        entry = self.entries.pop(query_id, None)
+        if entry is not None:
+            self.fold(entry)
+        self.downloading.pop(query_id, None)
+
+    def fold(self, entry):
+        """Adds the poll count of a query that is no longer polled to the running totals."""
+        self.totals['queries'] += 1
+        self.totals['status_polls'] += entry.polls
+        self.totals['max_polls'] = max(self.totals['max_polls'], entry.polls)
+
+    def stop(self):
+        """Stops polling all queries (called when the plugin is unloaded)."""
+        self.timer.stop()
+        self.entries.clear()
+        if self.batch_task is not None:
+            self.batch_task.cancel()
+
+    def tick(self):
+        """Collects all queries that are due and checks their status in one background task."""
+        if self.batch_task is not None:
+            return
+        if not self.entries:
+            self.timer.stop()
+            return
+
+        now = time.monotonic()
+        due = [entry for entry in self.entries.values() if entry.next_poll <= now]
+        if not due:
+            return
+
+        self.batch_task = QgsTask.fromFunction('ei geospatial apis: checking status of {} queries'.format(len(due)),
+                                               self.poll_task, on_finished=self.poll_completed, entries=due)
+        QgsApplication.taskManager().addTask(self.batch_task)
+
+    def poll_task(self, task, entries):
+        """
+        Checks the status of a batch of queries, runs in a background thread.
+
+        Returns:
+            list: (entry, status code, error message) tuples.
+        """
+        results = []
+        for n, entry in enumerate(entries):
+            if task.isCanceled():
+                break
+            try:
+                entry.query.status(poll=False)
+                results.append((entry, entry.query.status_response.status_code, None))
+            except Exception as e:
+                results.append((entry, None, str(e)))
+            task.setProgress(100.0 * (n + 1) / len(entries))
+        return results
+
+    def poll_completed(self, exception, result=None):
+        """Reschedules the polled queries and emits the queries that finished."""
+        self.batch_task = None
+        now = time.monotonic()
+
+        if exception is not None:
+            QgsMessageLog.logMessage('Status check failed: {}'.format(exception), MESSAGE_CATEGORY, Qgis.Warning)
+
+        # Entries that were not reached because the batch was cancelled are still due and are polled on the next tick.
+        for entry, status_code, error in result or []:
+            query_id = entry.query.id
+            if query_id not in self.entries:
+                continue
+            entry.polls += 1
+
+            if error is not None:
+                entry.errors += 1
+                QgsMessageLog.logMessage('{} status check failed ({}/{}): {}'.format(query_id, entry.errors, MAX_STATUS_ERRORS, error), MESSAGE_CATEGORY, Qgis.Warning)
+                if entry.errors >= MAX_STATUS_ERRORS:
+                    self.fold(self.entries.pop(query_id))
+                    self.failed.emit(entry.query, error)
+                else:
+                    entry.next_poll = now + backoff_delay(entry.status_code, entry.errors)
+                continue
+
+            entry.errors = 0
+            QgsMessageLog.logMessage('{} status is {}'.format(query_id, status_code), MESSAGE_CATEGORY, Qgis.Info)
+
+            if status_code == SUCCEEDED_STATUS_CODE:
+                entry.ready_at = now
+                self.totals['ready'] += 1
+                self.totals['ready_seconds'] += now - entry.submitted_at
+                self.fold(self.entries.pop(query_id))
+                self.downloading[query_id] = entry.submitted_at
+                self.ready.emit(entry.query)
+            elif status_code in RUNNING_STATUS_CODES:
+                if status_code == entry.status_code:
+                    entry.attempt += 1
+                else:
+                    entry.attempt = 0
+                entry.status_code = status_code
+                entry.next_poll = now + backoff_delay(status_code, entry.attempt)
+            else:
+                self.fold(self.entries.pop(query_id))
+                self.failed.emit(entry.query, 'status code {}'.format(status_code))
+
+    def record_download(self, query_id):
+        """
+        Records that the result of a query has been downloaded and logs a summary once all queries are done.
+
+        Args:
+            query_id (str): The id of the downloaded query.
+        """
+        submitted_at = self.downloading.pop(query_id, None)
+        if submitted_at is not None:
+            self.totals['downloaded'] += 1
+            self.totals['download_seconds'] += time.monotonic() - submitted_at
+        if not self.entries:
+            self.log_statistics()
+
+    def statistics(self):
+        """
+        Returns counters that describe how many status requests were made.
+
+        Returns:
+            dict: The number of queries, status polls in total and per query and the mean times
+            from submission to a ready result and to a downloaded result in seconds.
+        """
+        totals = self.totals
+        polls = [entry.polls for entry in self.entries.values()]
+        queries = totals['queries'] + len(polls)
+        total = totals['status_polls'] + sum(polls)
+        return {
+            'queries': queries,
+            'status_polls': total,
+            'polls_per_query': float(total) / queries if queries else 0.0,
+            'max_polls_per_query': max([totals['max_polls']] + polls),
+            'mean_time_to_ready': totals['ready_seconds'] / totals['ready'] if totals['ready'] else None,
+            'mean_time_to_download': totals['download_seconds'] / totals['downloaded'] if totals['downloaded'] else None,
+        }
+
+    def log_statistics(self):
+        """Writes the polling counters to the QGIS message log."""
+        stats = self.statistics()
+        QgsMessageLog.logMessage('Polling statistics: {} queries, {} status polls ({:.1f} per query, max {}), mean time to ready {}, mean time to download {}'.format(
+            stats['queries'], stats['status_polls'], stats['polls_per_query'], stats['max_polls_per_query'],
+            self.format_seconds(stats['mean_time_to_ready']), self.format_seconds(stats['mean_time_to_download'])), MESSAGE_CATEGORY, Qgis.Info)
+
+    def format_seconds(self, seconds):
+        return 'n/a' if seconds is None else '{:.1f}s'.format(seconds)
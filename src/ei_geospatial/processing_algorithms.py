@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Processing algorithms that run Geospatial APIs queries
+                       through the query engine of the plugin.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import ibmpairs.client as client
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsProcessing, QgsProcessingAlgorithm, QgsProcessingContext, QgsProcessingException,
+                       QgsProcessingOutputMultipleLayers, QgsProcessingOutputNumber, QgsProcessingOutputRasterLayer,
+                       QgsProcessingParameterBoolean, QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterFolderDestination, QgsProcessingParameterNumber,
+                       QgsProcessingParameterString)
+
+from . import settings
+from .fanout import feature_boxes, fan_out, merge_boxes, parse_periods
+from .layer_import import load_layers
+from .layer_style import save_style_sidecar
+from .session import environment_client
+
+
+class QueryFeedback(object):
+    """The feedback of one of several queries run at once: shares the cancellation, keeps its own progress."""
+
+    def __init__(self, feedback):
+        self.feedback = feedback
+        self.progress = 0.0
+
+    def isCanceled(self):
+        return self.feedback.isCanceled()
+
+    def setProgress(self, progress):
+        self.progress = progress
+
+
+class QueryAlgorithm(QgsProcessingAlgorithm):
+    """
+    Base of the Geospatial APIs algorithms.
+
+    Queries run in the algorithm's thread through QueryEngine.run_query, so they use the result
+    cache, job index and journal of the plugin, and Processing can run several algorithms in
+    parallel, e.g. in batch mode or in a model. The results are styled and get a .qml sidecar,
+    so they keep their style when they are loaded on completion or used further in a model.
+    """
+
+    QUERY = 'QUERY'
+    LOAD = 'LOAD'
+    OUTPUT_FOLDER = 'OUTPUT_FOLDER'
+    OUTPUT = 'OUTPUT'
+    OUTPUT_LAYERS = 'OUTPUT_LAYERS'
+
+    def __init__(self, engine):
+        super(QueryAlgorithm, self).__init__()
+        self.engine = engine
+
+    def createInstance(self):
+        return type(self)(self.engine)
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def group(self):
+        return self.tr('Queries')
+
+    def groupId(self):
+        return 'queries'
+
+    def add_query_parameters(self):
+        self.addParameter(QgsProcessingParameterString(self.QUERY, self.tr('Query json'), multiLine=True))
+
+    def add_output_parameters(self):
+        self.addParameter(QgsProcessingParameterBoolean(self.LOAD, self.tr('Load the results into the project'), defaultValue=True))
+        self.addParameter(QgsProcessingParameterFolderDestination(self.OUTPUT_FOLDER, self.tr('Result folder')))
+        self.addOutput(QgsProcessingOutputRasterLayer(self.OUTPUT, self.tr('First result layer')))
+        self.addOutput(QgsProcessingOutputMultipleLayers(self.OUTPUT_LAYERS, self.tr('Result layers')))
+
+    def query_template(self, parameters, context):
+        """Returns the query json of the parameters, raises a QgsProcessingException if it is not valid json."""
+        text = self.parameterAsString(parameters, self.QUERY, context)
+        try:
+            raster_query = json.loads(text)
+        except ValueError as e:
+            raise QgsProcessingException(self.tr('The query is not valid json: {}').format(e))
+        if not isinstance(raster_query, dict):
+            raise QgsProcessingException(self.tr('The query must be a single json object'))
+        return raster_query
+
+    def check_login(self, feedback):
+        """Makes sure there is an authenticated client, logging in from the environment if the plugin has not."""
+        if client.GLOBAL_PAIRS_CLIENT is not None:
+            return
+        if environment_client() is None:
+            raise QgsProcessingException(self.tr('Log in with the IBM Geospatial APIs plugin or set EIS_API_KEY, EIS_TENANT_ID and EIS_ORG_ID'))
+        feedback.pushInfo(self.tr('Logged in with the credentials of the environment'))
+
+    def import_results(self, files, name, load, context, feedback):
+        """
+        Styles the result files and writes their .qml sidecars, then queues them for loading on completion.
+
+        Returns:
+            list: The result layers, VRTs if the VRT mode of the plugin is set.
+        """
+        vrt_mode = settings.value(settings.VRT_MODE_KEY, settings.DEFAULT_VRT_MODE)
+        result = load_layers(feedback, files, self.engine.layer_metadata, vrt_mode, self.engine.styler)
+        if result is None:
+            return []
+        paths = []
+        for loaded in result['layers']:
+            save_style_sidecar(loaded.layer)
+            paths.append(loaded.file)
+            if load:
+                details = QgsProcessingContext.LayerDetails(os.path.splitext(os.path.basename(loaded.file))[0], context.project(), self.OUTPUT_LAYERS)
+                if hasattr(details, 'groupName'):
+                    details.groupName = name
+                context.addLayerToLoadOnCompletion(loaded.file, details)
+        return paths
+
+
+class RunQueryAlgorithm(QueryAlgorithm):
+    """Runs one raster query and returns its result layers."""
+
+    def name(self):
+        return 'runrasterquery'
+
+    def displayName(self):
+        return self.tr('Run Geospatial API raster query')
+
+    def shortHelpString(self):
+        return self.tr('Submits a raster query, waits for it and downloads and styles its result. Identical queries '
+                       'are served from the result cache or join a running job instead of being submitted again.')
+
+    def initAlgorithm(self, config=None):
+        self.add_query_parameters()
+        self.add_output_parameters()
+
+    def processAlgorithm(self, parameters, context, feedback):
+        raster_query = self.query_template(parameters, context)
+        folder = self.parameterAsString(parameters, self.OUTPUT_FOLDER, context)
+        load = self.parameterAsBoolean(parameters, self.LOAD, context)
+        self.check_login(feedback)
+
+        try:
+            files = self.engine.run_query(raster_query, folder, feedback)
+        except Exception as e:
+            raise QgsProcessingException(self.tr('The query failed: {}').format(e))
+        if feedback.isCanceled():
+            return {}
+        layers = self.import_results(files, raster_query.get('name') or os.path.basename(folder), load, context, feedback)
+        return {self.OUTPUT_FOLDER: folder, self.OUTPUT: layers[0] if layers else None, self.OUTPUT_LAYERS: layers}
+
+
+class BatchQueryAlgorithm(QueryAlgorithm):
+    """Runs a query template over the features of a layer and/or a list of date ranges, several queries at once."""
+
+    INPUT = 'INPUT'
+    DATES = 'DATES'
+    MERGE = 'MERGE'
+    MAX_CONCURRENT = 'MAX_CONCURRENT'
+    FAILED = 'FAILED'
+
+    def name(self):
+        return 'batchrasterquery'
+
+    def displayName(self):
+        return self.tr('Batch run over features/dates')
+
+    def shortHelpString(self):
+        return self.tr('Runs a query template once per feature and date range. The bbox of each feature, reprojected '
+                       'to EPSG:4326, replaces the spatial part of the template; each date range, one per line as '
+                       'start/end or a single date, replaces its intervals. Nearby features can be merged into one '
+                       'query. The queries run concurrently and the results of each are written to a folder named '
+                       'after the feature id and date range.')
+
+    def initAlgorithm(self, config=None):
+        self.add_query_parameters()
+        self.addParameter(QgsProcessingParameterFeatureSource(self.INPUT, self.tr('Features'), [QgsProcessing.TypeVectorAnyGeometry], optional=True))
+        self.addParameter(QgsProcessingParameterBoolean(self.MERGE, self.tr('Merge nearby features into one query'), defaultValue=False))
+        self.addParameter(QgsProcessingParameterString(self.DATES, self.tr('Date ranges (start/end, one per line)'), multiLine=True, optional=True))
+        self.addParameter(QgsProcessingParameterNumber(self.MAX_CONCURRENT, self.tr('Queries running at once'), minValue=1,
+                                                       defaultValue=settings.value(settings.MAX_CONCURRENT_QUERIES_KEY, settings.DEFAULT_MAX_CONCURRENT_QUERIES)))
+        self.add_output_parameters()
+        self.addOutput(QgsProcessingOutputNumber(self.FAILED, self.tr('Failed queries')))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        template = self.query_template(parameters, context)
+        folder = self.parameterAsString(parameters, self.OUTPUT_FOLDER, context)
+        load = self.parameterAsBoolean(parameters, self.LOAD, context)
+        workers = self.parameterAsInt(parameters, self.MAX_CONCURRENT, context)
+
+        boxes = None
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        if source is not None:
+            boxes = feature_boxes(source.getFeatures(), source.sourceCrs(), context.transformContext(), feedback)
+            if not boxes:
+                raise QgsProcessingException(self.tr('The features have no geometries'))
+            if self.parameterAsBoolean(parameters, self.MERGE, context):
+                merged = merge_boxes(boxes, settings.value(settings.FANOUT_MERGE_DISTANCE_KEY, settings.DEFAULT_FANOUT_MERGE_DISTANCE),
+                                     settings.value(settings.FANOUT_MAX_MERGED_SIZE_KEY, settings.DEFAULT_FANOUT_MAX_MERGED_SIZE))
+                feedback.pushInfo(self.tr('{} features merged into {} boxes').format(len(boxes), len(merged)))
+                boxes = merged
+        try:
+            periods = parse_periods(self.parameterAsString(parameters, self.DATES, context)) or None
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+        queries = fan_out(template, boxes, periods)
+        self.check_login(feedback)
+        feedback.pushInfo(self.tr('Running {} queries, {} at once').format(len(queries), workers))
+
+        results = {}
+        failed = 0
+        with ThreadPoolExecutor(max_workers=min(workers, len(queries))) as pool:
+            futures = {pool.submit(self.engine.run_query, query, os.path.join(folder, label), QueryFeedback(feedback)): label
+                       for label, query, box in queries}
+            for n, future in enumerate(as_completed(futures)):
+                label = futures[future]
+                try:
+                    results[label] = future.result()
+                except Exception as e:
+                    failed += 1
+                    feedback.reportError(self.tr('{} failed: {}').format(label, e))
+                feedback.setProgress(100.0 * (n + 1) / len(queries))
+        if feedback.isCanceled():
+            return {}
+        if failed == len(queries):
+            raise QgsProcessingException(self.tr('All {} queries failed').format(failed))
+
+        layers = []
+        for label, query, box in queries:
+            if label in results:
+                layers.extend(self.import_results(results[label], label, load, context, feedback))
+        return {self.OUTPUT_FOLDER: folder, self.OUTPUT: layers[0] if layers else None, self.OUTPUT_LAYERS: layers,
+                self.FAILED: failed}
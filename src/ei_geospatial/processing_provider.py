@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Processing provider of the Geospatial APIs algorithms.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+
+from qgis.PyQt.QtGui import QIcon
+from qgis.core import QgsProcessingProvider
+
+from .processing_algorithms import BatchQueryAlgorithm, RunQueryAlgorithm
+
+
+class GeospatialApisProvider(QgsProcessingProvider):
+    """Makes the queries of the plugin available in the Processing toolbox, models and scripts."""
+
+    def __init__(self, engine):
+        """
+        Args:
+            engine (QueryEngine): The engine of the plugin, shared by all algorithms.
+        """
+        super(GeospatialApisProvider, self).__init__()
+        self.engine = engine
+
+    def id(self):
+        return 'eigeospatialapis'
+
+    def name(self):
+        return 'IBM Environmental Intelligence: Geospatial APIs'
+
+    def icon(self):
+        return QIcon(os.path.join(os.path.dirname(__file__), 'icons', 'ibm.png'))
+
+    def loadAlgorithms(self):
+        self.addAlgorithm(RunQueryAlgorithm(self.engine))
+        self.addAlgorithm(BatchQueryAlgorithm(self.engine))
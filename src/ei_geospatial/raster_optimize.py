@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Overviews and Cloud-Optimized GeoTIFF conversion of downloaded results.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import gdal
+from qgis.core import QgsMessageLog, Qgis
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+# What is done to the downloaded GeoTIFFs before they are imported
+NONE = 'none'
+OVERVIEWS = 'overviews'  # Internal overviews are added to the files
+COG = 'cog'  # The files are rewritten as tiled, compressed Cloud-Optimized GeoTIFFs with overviews
+OPTIMIZE_MODES = [NONE, OVERVIEWS, COG]
+
+# Number of files processed at the same time, GDAL releases the GIL while it works
+OPTIMIZE_WORKERS = 4
+OVERVIEW_RESAMPLING = 'AVERAGE'
+# Overviews are built until the smallest one fits into a tile of this size
+MIN_OVERVIEW_SIZE = 256
+
+
+def overview_levels(width, height):
+    """Returns the decimation factors of the overviews of a raster, empty if it is small enough without."""
+    levels = []
+    factor = 2
+    while max(width, height) / (factor / 2) > MIN_OVERVIEW_SIZE:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def build_overviews(path, compression):
+    """
+    Adds internal overviews to a GeoTIFF.
+
+    Args:
+        path (str): The GeoTIFF.
+        compression (str): The compression of the overviews, e.g. DEFLATE.
+
+    Returns:
+        bool: False if the file has overviews already or is too small to need them.
+    """
+    ds = gdal.Open(path, gdal.GA_Update)
+    if ds is None:
+        raise Exception('{} could not be opened'.format(path))
+    if ds.GetRasterBand(1).GetOverviewCount() > 0:
+        return False
+    levels = overview_levels(ds.RasterXSize, ds.RasterYSize)
+    if not levels:
+        return False
+    # Thread local, so parallel workers do not see each other's options
+    gdal.SetThreadLocalConfigOption('COMPRESS_OVERVIEW', compression)
+    try:
+        ds.BuildOverviews(OVERVIEW_RESAMPLING, levels)
+    finally:
+        gdal.SetThreadLocalConfigOption('COMPRESS_OVERVIEW', None)
+    ds = None
+    return True
+
+
+def convert_to_cog(path, compression, tile_size):
+    """
+    Rewrites a GeoTIFF as a Cloud-Optimized GeoTIFF in place.
+
+    Args:
+        path (str): The GeoTIFF.
+        compression (str): The compression, e.g. DEFLATE, LZW or ZSTD.
+        tile_size (int): The edge length of the tiles in pixels.
+
+    Returns:
+        bool: Always True, the file is rewritten.
+    """
+    tmp = path + '.cog.tmp'
+    options = ['COMPRESS={}'.format(compression), 'BLOCKSIZE={}'.format(tile_size), 'OVERVIEWS=AUTO',
+               'OVERVIEW_RESAMPLING={}'.format(OVERVIEW_RESAMPLING)]
+    try:
+        ds = gdal.Translate(tmp, path, format='COG', creationOptions=options)
+        if ds is None:
+            raise Exception('{} could not be converted'.format(path))
+        ds = None
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return True
+
+
+def optimize_rasters(files, mode, compression='DEFLATE', tile_size=512, task=None, workers=OPTIMIZE_WORKERS):
+    """
+    Adds overviews to downloaded GeoTIFFs or converts them to COG, in parallel across files.
+
+    Args:
+        files (list): The GeoTIFFs.
+        mode (str): One of OPTIMIZE_MODES.
+        compression (str): The GDAL compression of the overviews or COG.
+        tile_size (int): The COG tile size in pixels.
+        task (QgsTask): Stops starting new files once the task is cancelled.
+        workers (int): The number of files processed at the same time.
+
+    Returns:
+        dict: The number of files optimized, skipped (small or already optimized) and failed, the
+        seconds spent and the total size of the files before and after.
+    """
+    report = {'files': 0, 'skipped': 0, 'failed': 0, 'seconds': 0.0, 'bytes_before': 0, 'bytes_after': 0}
+    if mode not in (OVERVIEWS, COG) or not files:
+        return report
+    if mode == COG and gdal.GetDriverByName('COG') is None:
+        QgsMessageLog.logMessage('The COG driver needs GDAL 3.1 or later, building overviews instead', MESSAGE_CATEGORY, Qgis.Warning)
+        mode = OVERVIEWS
+
+    def optimize(path):
+        if task is not None and task.isCanceled():
+            return None
+        before = os.path.getsize(path)
+        try:
+            if mode == COG:
+                changed = convert_to_cog(path, compression, tile_size)
+            else:
+                changed = build_overviews(path, compression)
+        except Exception as e:
+            QgsMessageLog.logMessage('{} could not be optimized: {}'.format(path, e), MESSAGE_CATEGORY, Qgis.Warning)
+            return 'failed', before, before
+        return 'files' if changed else 'skipped', before, os.path.getsize(path)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(workers, len(files))) as pool:
+        for outcome in pool.map(optimize, files):
+            if outcome is None:
+                continue
+            status, before, after = outcome
+            report[status] += 1
+            report['bytes_before'] += before
+            report['bytes_after'] += after
+    report['seconds'] = time.perf_counter() - started
+    return report
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Raster statistics used to stretch the color ramp of imported results.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+from osgeo import gdal
+from qgis.core import QgsMessageLog, Qgis
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+# How the range of a band is computed
+APPROXIMATE = 'approximate'  # GDAL statistics from overviews or a subsample
+PERCENTILE = 'percentile'  # Percentile stretch of a sample read from the overviews
+EXACT = 'exact'  # GDAL statistics over every pixel
+STATS_MODES = [APPROXIMATE, PERCENTILE, EXACT]
+
+# Longest side in pixels of the sample the percentiles are computed from
+SAMPLE_SIZE = 1024
+# Number of ranges kept in the stats store, the oldest are dropped first
+MAX_ENTRIES = 20000
+# Approximate number of pixels read at once when streaming a raster, rounded to whole rows of blocks
+STREAM_PIXELS = 1 << 22
+# Bins of the histogram the percentiles of a series are read from
+HISTOGRAM_BINS = 4096
+
+
+def file_signature(path):
+    """Returns the size and modification time of a file, None if it cannot be read."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def valid_values(values, nodata):
+    """Returns the pixels of an array that are neither nodata nor NaN, as a flat float array."""
+    values = values.astype(np.float64).ravel()
+    valid = np.isfinite(values)
+    if nodata is not None:
+        valid &= values != nodata
+    return values[valid]
+
+
+def stream_values(path, band=1):
+    """
+    Yields the valid pixels of a raster band a few rows of blocks at a time, so rasters of any size
+    are read with bounded memory.
+
+    Args:
+        path (str): The raster file.
+        band (int): The band number.
+    """
+    ds = gdal.Open(path)
+    if ds is None:
+        return
+    src_band = ds.GetRasterBand(band)
+    nodata = src_band.GetNoDataValue()
+    block_rows = max(1, src_band.GetBlockSize()[1])
+    rows = max(1, STREAM_PIXELS // max(1, src_band.XSize) // block_rows) * block_rows
+    for y in range(0, src_band.YSize, rows):
+        values = src_band.ReadAsArray(0, y, src_band.XSize, min(rows, src_band.YSize - y))
+        if values is not None:
+            values = valid_values(values, nodata)
+            if values.size:
+                yield values
+
+
+def series_range(paths, band=1, percentiles=None):
+    """
+    Computes the common value range of several rasters, e.g. all timestamps of a data layer, by
+    streaming their pixels block by block.
+
+    The minimum and maximum take a single pass. Percentiles take a second pass that accumulates a
+    histogram over that range and are read from it, accurate to a bin width.
+
+    Args:
+        paths (list): The raster files.
+        band (int): The band number.
+        percentiles (tuple): The low and high percentile, None for the minimum and maximum.
+
+    Returns:
+        tuple: The minimum and maximum or the values at both percentiles, None if no raster has valid pixels.
+    """
+    low = high = None
+    for path in paths:
+        for values in stream_values(path, band):
+            low = values.min() if low is None else min(low, values.min())
+            high = values.max() if high is None else max(high, values.max())
+    if low is None:
+        return None
+    if percentiles is None or low == high:
+        return float(low), float(high)
+
+    histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    for path in paths:
+        for values in stream_values(path, band):
+            histogram += np.histogram(values, bins=HISTOGRAM_BINS, range=(low, high))[0]
+    cumulative = np.cumsum(histogram)
+    edges = np.linspace(low, high, HISTOGRAM_BINS + 1)
+    bounds = []
+    for percentile in percentiles:
+        # Middle of the first bin that reaches the rank of the percentile
+        i = min(int(np.searchsorted(cumulative, cumulative[-1] * percentile / 100.0)), HISTOGRAM_BINS - 1)
+        bounds.append(float((edges[i] + edges[i + 1]) / 2))
+    return bounds[0], bounds[1]
+
+
+def sample_percentiles(band, percentiles):
+    """
+    Computes percentiles of a band from a downsampled read, GDAL serves it from the overviews if there are any.
+
+    Args:
+        band (gdal.Band): The band.
+        percentiles (tuple): The low and high percentile, e.g. (2, 98).
+
+    Returns:
+        tuple: The values at both percentiles, None if the band has no valid pixels.
+    """
+    scale = max(1.0, max(band.XSize, band.YSize) / float(SAMPLE_SIZE))
+    values = band.ReadAsArray(buf_xsize=max(1, int(band.XSize / scale)), buf_ysize=max(1, int(band.YSize / scale)))
+    if values is None:
+        return None
+    values = valid_values(values, band.GetNoDataValue())
+    if values.size == 0:
+        return None
+    low, high = np.percentile(values, percentiles)
+    return float(low), float(high)
+
+
+def compute_range(path, band=1, mode=APPROXIMATE, percentiles=(2, 98)):
+    """
+    Computes the value range of a raster band.
+
+    Args:
+        path (str): The raster file.
+        band (int): The band number.
+        mode (str): One of STATS_MODES.
+        percentiles (tuple): The low and high percentile of the percentile mode.
+
+    Returns:
+        tuple: The minimum and maximum, None if the band has no valid pixels.
+    """
+    ds = gdal.Open(path)
+    if ds is None:
+        return None
+    src_band = ds.GetRasterBand(band)
+    if mode == PERCENTILE:
+        return sample_percentiles(src_band, percentiles)
+    try:
+        stats = src_band.ComputeStatistics(mode != EXACT)
+    except RuntimeError:
+        return None
+    if not stats:
+        return None
+    return float(stats[0]), float(stats[1])
+
+
+def range_key(name, band, mode, percentiles):
+    """Returns the stats store key of the range of a file or series in a mode."""
+    return '{}|{}|{}'.format(name, band, mode if mode != PERCENTILE else '{}:{}-{}'.format(mode, *percentiles))
+
+
+class RasterStatsStore(object):
+    """
+    Local store of the band ranges computed for imported rasters.
+
+    Ranges are keyed by file, band and mode and are valid while the size and modification time
+    of the file are unchanged, so importing the same result again costs no raster reads. The
+    store is kept in memory and written to a json file by save.
+    """
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        """
+        Args:
+            path (str): The json file the ranges are persisted in.
+            max_entries (int): The number of ranges kept.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = None
+        self.dirty = False
+
+    def load(self):
+        """Reads the persisted ranges once, call with the lock held."""
+        if self.entries is not None:
+            return
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        """Persists the ranges computed since the last save."""
+        with self.lock:
+            if not self.dirty:
+                return
+            while len(self.entries) > self.max_entries:
+                self.entries.pop(next(iter(self.entries)))
+            try:
+                with open(self.path + '.tmp', 'w') as f:
+                    json.dump(self.entries, f)
+                os.replace(self.path + '.tmp', self.path)
+                self.dirty = False
+            except OSError as e:
+                QgsMessageLog.logMessage('The raster statistics could not be saved: {}'.format(e), MESSAGE_CATEGORY, Qgis.Warning)
+
+    def band_range(self, path, band=1, mode=APPROXIMATE, percentiles=(2, 98)):
+        """
+        Returns the value range of a raster band, computing it only if it is not stored yet.
+
+        Args:
+            path (str): The raster file.
+            band (int): The band number.
+            mode (str): One of STATS_MODES.
+            percentiles (tuple): The low and high percentile of the percentile mode.
+
+        Returns:
+            tuple: The minimum and maximum, None if the band has no valid pixels.
+        """
+        if mode not in STATS_MODES:
+            mode = APPROXIMATE
+        key = range_key(os.path.abspath(path), band, mode, percentiles)
+        signature = file_signature(path)
+        band_range = self.lookup(key, signature)
+        if band_range is None:
+            band_range = compute_range(path, band, mode, percentiles)
+            if signature is not None:
+                self.store(key, signature, band_range)
+        return band_range
+
+    def series_range(self, paths, band=1, mode=APPROXIMATE, percentiles=(2, 98)):
+        """
+        Returns the common value range of several rasters, so they can share one color ramp.
+
+        The approximate range combines the stored ranges of the single files; exact and percentile
+        ranges stream the pixels of all files (see series_range) and are stored for the set of files.
+
+        Args:
+            paths (list): The raster files.
+            band (int): The band number.
+            mode (str): One of STATS_MODES.
+            percentiles (tuple): The low and high percentile of the percentile mode.
+
+        Returns:
+            tuple: The minimum and maximum, None if no raster has valid pixels.
+        """
+        if mode not in STATS_MODES:
+            mode = APPROXIMATE
+        if mode == APPROXIMATE:
+            ranges = [r for r in (self.band_range(path, band, mode) for path in paths) if r is not None]
+            if not ranges:
+                return None
+            return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+        paths = sorted(os.path.abspath(path) for path in paths)
+        key = range_key('series:' + hashlib.sha1('\n'.join(paths).encode('utf-8')).hexdigest(), band, mode, percentiles)
+        signatures = [file_signature(path) for path in paths]
+        signature = None if None in signatures else signatures
+        band_range = self.lookup(key, signature)
+        if band_range is None:
+            band_range = series_range(paths, band, percentiles if mode == PERCENTILE else None)
+            if signature is not None:
+                self.store(key, signature, band_range)
+        return band_range
+
+    def lookup(self, key, signature):
+        """Returns a stored range if the files it was computed from are unchanged."""
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+        if entry is not None and signature is not None and entry['source'] == signature:
+            return tuple(entry['range'])
+        return None
+
+    def store(self, key, signature, band_range):
+        if band_range is None:
+            return
+        with self.lock:
+            # Re-inserted so the most recently computed ranges are dropped last
+            self.entries.pop(key, None)
+            self.entries[key] = {'source': signature, 'range': list(band_range)}
+            self.dirty = True
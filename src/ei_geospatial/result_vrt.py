@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Wraps the files of a query result into one VRT per data layer.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import datetime
+import json
+import os
+import re
+from pathlib import Path
+
+from osgeo import gdal
+
+from .splitting import index_output_info
+
+# How the files of a result are loaded
+NONE = 'none'  # One layer per file
+MOSAIC = 'mosaic'  # One layer per data layer and timestamp, the tiles of each are mosaicked
+STACK = 'stack'  # One layer per data layer, with a band per timestamp
+VRT_MODES = [NONE, MOSAIC, STACK]
+
+# Folder within the result folder the VRTs and their output.info are written to
+VRT_FOLDER = 'vrt'
+
+
+def format_timestamp(value):
+    """Returns an output.info timestamp, milliseconds since the epoch, as an ISO 8601 string."""
+    if value is None:
+        return ''
+    try:
+        return datetime.datetime.utcfromtimestamp(int(value) / 1000.0).strftime('%Y-%m-%dT%H:%M:%SZ')
+    except (TypeError, ValueError, OverflowError, OSError):
+        return str(value)
+
+
+def vrt_name(entry, timestamp=None):
+    """Returns the file name of the VRT of a data layer, and of one of its timestamps if given."""
+    label = entry.get('datalayerName') or entry.get('datalayerAlias') or 'layer'
+    name = '{}_{}'.format(label, entry['datalayerId'])
+    if timestamp is not None:
+        name = '{}_{}'.format(name, format_timestamp(timestamp))
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name)
+
+
+def build_result_vrts(files, mode):
+    """
+    Wraps the files of a result into VRTs so that each data layer is loaded as a single layer.
+
+    In mosaic mode the files of each data layer and timestamp become one VRT. In stack mode the
+    timestamps of each data layer become the bands of one VRT, in time order, and every band
+    carries its timestamp as description and TIMESTAMP metadata. An output.info describing the
+    VRTs is written next to them, the entries of stacks list their timestamps and source files.
+    Files without a data layer in the output.info and groups of a single file are kept as they are.
+
+    Args:
+        files (list): The result files.
+        mode (str): One of VRT_MODES.
+
+    Returns:
+        list: The VRTs and the files that were kept.
+    """
+    if mode not in (MOSAIC, STACK) or len(files) < 2:
+        return files
+    entries = index_output_info(files)
+
+    kept = []
+    layers = {}
+    for file in files:
+        entry = entries.get(file)
+        if entry is None or entry.get('datalayerId') is None:
+            kept.append(file)
+            continue
+        timestamps = layers.setdefault(str(entry['datalayerId']), {})
+        timestamps.setdefault(entry.get('timestamp'), []).append(file)
+
+    folder = os.path.join(str(Path(files[0]).parent), VRT_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    info = []
+    vrts = []
+
+    def build_vrt(name, sources, entry, **options):
+        vrt = os.path.join(folder, '{}.vrt'.format(name))
+        ds = gdal.BuildVRT(vrt, sources, **options)
+        if ds is None:
+            raise Exception('{} could not be built'.format(vrt))
+        info.append(dict(entry, name=name))
+        return vrt, ds
+
+    for timestamps in layers.values():
+        # Mosaic the tiles of every timestamp first, a stack is then built from the mosaics
+        mosaics = []
+        for timestamp, members in sorted(timestamps.items(), key=lambda item: format_timestamp(item[0])):
+            entry = entries[members[0]]
+            source = members[0]
+            if len(members) > 1:
+                source, ds = build_vrt(vrt_name(entry, timestamp), sorted(members), entry)
+                ds = None
+                vrts.append(source)
+            mosaics.append((timestamp, source, entry))
+
+        if mode == MOSAIC or len(mosaics) == 1:
+            kept.extend(source for _, source, _ in mosaics if source not in vrts)
+            continue
+
+        for _, source, _ in mosaics:
+            if source in vrts:
+                vrts.remove(source)  # Only loaded as a band of the stack
+        entry = dict(mosaics[0][2], timestamps=[format_timestamp(timestamp) for timestamp, _, _ in mosaics],
+                     sources=[source for _, source, _ in mosaics])
+        vrt, ds = build_vrt(vrt_name(entry), entry['sources'], entry, separate=True)
+        for band, timestamp in enumerate(entry['timestamps'], 1):
+            ds.GetRasterBand(band).SetDescription(timestamp)
+            ds.GetRasterBand(band).SetMetadataItem('TIMESTAMP', timestamp)
+        ds = None
+        vrts.append(vrt)
+
+    with open(os.path.join(folder, 'output.info'), 'w') as f:
+        json.dump({'files': info}, f)
+
+    return vrts + kept
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : One pooled, authenticated HTTP session for all backend requests.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+import ibmpairs.client as client
+import ibmpairs.constants as constants
+from qgis.core import QgsMessageLog, Qgis
+
+from . import settings
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+# Seconds to wait for a connection and for the answer to a request
+CONNECT_TIMEOUT = 30
+REQUEST_TIMEOUT = 300
+
+
+def auth_headers(cli, headers=None):
+    """
+    Returns the request headers and basic authentication for an ibmpairs client.
+
+    Args:
+        cli (ibmpairs.client.Client): The authenticated client.
+        headers (dict): Headers of the request, copied before the authentication is added.
+
+    Returns:
+        tuple: The headers dictionary and a (user, password) tuple or None.
+    """
+    headers = dict(headers or {})
+    auth = None
+    authentication = cli.get_authentication()
+    mode = cli.authentication_mode(authentication)
+    if mode == 'OAuth2':
+        headers['Authorization'] = 'Bearer ' + authentication.jwt_token
+    elif mode == 'Basic':
+        auth = authentication.get_credentials()
+    if not cli.get_legacy() and cli.get_client_id() is not None:
+        headers['x-ibm-client-id'] = cli.get_client_id()
+    return headers, auth
+
+
+class PooledClient(client.Client):
+    """
+    An ibmpairs client that sends every request over one pooled requests session.
+
+    ibmpairs opens a new connection, with its own TLS handshake, for every request and a new
+    aiohttp session for every submit and status call. This client overrides the request methods
+    ibmpairs uses, so queries, status polls and catalog calls made through it reuse kept-alive
+    connections from a pool of a configurable size; the plugin's own downloads and catalog
+    requests use the same session through request. An expired token is refreshed here, once for
+    all requests that were rejected with it, and the rejected requests are sent again.
+
+    Like every ibmpairs client it becomes the global client when it is created.
+    """
+
+    def __init__(self, *args, pool_size=settings.DEFAULT_HTTP_POOL_SIZE, **kwargs):
+        """
+        Args:
+            pool_size (int): The number of connections kept open per host.
+
+        The other arguments are those of ibmpairs.client.Client.
+        """
+        super().__init__(*args, **kwargs)
+        self.pool_size = pool_size
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.http = requests.Session()
+        self.http.mount('https://', self.adapter)
+        self.http.mount('http://', self.adapter)
+        self.refresh_lock = threading.Lock()
+        self.requests_sent = 0
+        self.token_refreshes = 0
+
+    @classmethod
+    def from_client(cls, cli, pool_size=settings.DEFAULT_HTTP_POOL_SIZE):
+        """Returns a pooled client with the authentication of an ibmpairs client, e.g. one from client.get_client."""
+        return cls(headers=cli.get_headers(), authentication=cli.get_authentication(), body=cli.get_body(),
+                   pool_size=pool_size)
+
+    def token(self):
+        """Returns the current bearer token, None for basic authentication."""
+        if self.authentication_mode(self._authentication) == 'OAuth2':
+            return self._authentication.jwt_token
+        return None
+
+    def token_expired(self, response):
+        """Returns whether the backend rejected a request because its token expired, as ibmpairs detects it."""
+        if self.token() is None:
+            return False
+        if response.status_code == 401:
+            return True
+        if self._legacy and response.status_code == 403:
+            return constants.CLIENT_TOKEN_REFRESH_MESSAGE in response.text
+        if not self._legacy and response.status_code == 500:
+            return constants.CLIENT_TOKEN_REFRESH_MESSAGE_APIC in response.text
+        return False
+
+    def refresh_token(self, rejected):
+        """
+        Refreshes the token unless another request already did since it was rejected.
+
+        Args:
+            rejected (str): The token the request was rejected with.
+        """
+        with self.refresh_lock:
+            if self.token() != rejected:
+                return
+            self._authentication.refresh_auth_token()
+            self.token_refreshes += 1
+        QgsMessageLog.logMessage('The access token expired and was refreshed', MESSAGE_CATEGORY, Qgis.Info)
+
+    def request(self, method, url, headers=None, verify=True, **kwargs):
+        """
+        Sends an authenticated request over the pooled session, again once with a new token if the token expired.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The URL.
+            headers (dict): The request headers, the client's headers if None.
+            verify (bool): SSL verification.
+            kwargs: Passed to requests, e.g. data, json, stream or timeout.
+
+        Returns:
+            requests.Response: The response, close it if it is streamed.
+        """
+        kwargs.setdefault('timeout', (CONNECT_TIMEOUT, REQUEST_TIMEOUT))
+        verify = True if verify is None else verify
+        retried = False
+        while True:
+            token = self.token()
+            request_headers, auth = auth_headers(self, self._headers if headers is None else headers)
+            response = self.http.request(method, url, headers=request_headers, auth=auth, verify=verify, **kwargs)
+            self.requests_sent += 1
+            if retried or not self.token_expired(response):
+                return response
+            response.close()
+            self.refresh_token(token)
+            retried = True
+
+    def get(self, url, headers=None, verify=True):
+        return self.request('GET', url, headers=headers, verify=verify)
+
+    def put(self, url, body=None, headers=None, verify=True):
+        return self.request('PUT', url, headers=headers, verify=verify, data=body)
+
+    def post(self, url, body, headers=None, verify=True):
+        return self.request('POST', url, headers=headers, verify=verify, data=body)
+
+    def delete(self, url, headers=None, verify=True):
+        return self.request('DELETE', url, headers=headers, verify=verify)
+
+    async def async_get(self, url, session=None, authentication=None, headers=None, verify=None, response_type='json'):
+        # ibmpairs runs every async call in an event loop of its own with nothing else on it, so
+        # the pooled request can block the loop; the aiohttp session arguments are not used
+        response = self.request('GET', url, headers=headers, verify=verify)
+        return client.ClientResponse(status=response.status_code,
+                                     body=response.text if response_type == 'json' else response.content)
+
+    async def async_post(self, url, body, session=None, authentication=None, headers=None, verify=None):
+        response = self.request('POST', url, headers=headers, verify=verify, json=body)
+        return client.ClientResponse(status=response.status_code, body=response.text)
+
+    def statistics(self):
+        """Returns the number of requests sent, connections opened and token refreshes."""
+        pools = self.adapter.poolmanager.pools
+        connections = sum(pool.num_connections for pool in (pools.get(key) for key in pools.keys()) if pool is not None)
+        return {'requests': self.requests_sent, 'connections': connections, 'refreshes': self.token_refreshes}
+
+    def close(self):
+        """Logs the connection reuse and closes the pooled connections."""
+        stats = self.statistics()
+        if stats['requests']:
+            QgsMessageLog.logMessage('HTTP session: {} requests over {} connections, {} token refresh(es)'.format(
+                stats['requests'], stats['connections'], stats['refreshes']), MESSAGE_CATEGORY, Qgis.Info)
+        self.http.close()
+
+
+def request(cli, method, url, headers=None, **kwargs):
+    """
+    Sends an authenticated request with an ibmpairs client, over its pooled session if it is a PooledClient.
+
+    Args:
+        cli (ibmpairs.client.Client): The client, the global client if None.
+        method (str): The HTTP method.
+        url (str): The URL.
+        headers (dict): The request headers without authentication.
+        kwargs: Passed to requests.
+
+    Returns:
+        requests.Response: The response.
+    """
+    cli = cli or client.GLOBAL_PAIRS_CLIENT
+    if isinstance(cli, PooledClient):
+        return cli.request(method, url, headers=headers or {}, **kwargs)
+    headers, auth = auth_headers(cli, headers)
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, REQUEST_TIMEOUT))
+    return requests.request(method, url, headers=headers, auth=auth, **kwargs)
+
+
+def environment_client():
+    """
+    Logs in with the credentials in the EIS_API_KEY, EIS_TENANT_ID and EIS_ORG_ID environment
+    variables, for runs without the login dialog.
+
+    Returns:
+        PooledClient: The client, which becomes the global client, None if a variable is not set.
+    """
+    credentials = [os.environ.get(name) for name in ('EIS_API_KEY', 'EIS_TENANT_ID', 'EIS_ORG_ID')]
+    if not all(credentials):
+        return None
+    cli = client.get_client(api_key=credentials[0], tenant_id=credentials[1], org_id=credentials[2], legacy=False)
+    pool_size = settings.value(settings.HTTP_POOL_SIZE_KEY, settings.DEFAULT_HTTP_POOL_SIZE)
+    return PooledClient.from_client(cli, pool_size=max(1, pool_size))
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Plugin options stored in the QGIS settings.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.PyQt.QtCore import QSettings
+
+SETTINGS_NAMESPACE = "ibm_pairs"
+
+# Maximum number of queries that are submitted, running or downloading at the same time
+MAX_CONCURRENT_QUERIES_KEY = "max_concurrent_queries"
+DEFAULT_MAX_CONCURRENT_QUERIES = 8
+
+# Edge length in degrees of the grid cells a square query is split into, 0 disables spatial splitting
+SPLIT_TILE_SIZE_KEY = "split_tile_size"
+DEFAULT_SPLIT_TILE_SIZE = 0.0
+
+# Length in days of the chunks a query interval is split into, 0 disables temporal splitting
+SPLIT_INTERVAL_DAYS_KEY = "split_interval_days"
+DEFAULT_SPLIT_INTERVAL_DAYS = 0
+
+# How often a failed chunk of a split query is resubmitted on its own
+SPLIT_RETRIES_KEY = "split_retries"
+DEFAULT_SPLIT_RETRIES = 2
+
+# Local result cache; an empty folder means the 'cache' folder in the plugin directory
+CACHE_ENABLED_KEY = "cache_enabled"
+DEFAULT_CACHE_ENABLED = True
+CACHE_FOLDER_KEY = "cache_folder"
+CACHE_MAX_SIZE_MB_KEY = "cache_max_size_mb"
+DEFAULT_CACHE_MAX_SIZE_MB = 2048
+
+# Download results in resumable chunks with progress instead of through ibmpairs in one request
+STREAMING_DOWNLOAD_KEY = "streaming_download"
+DEFAULT_STREAMING_DOWNLOAD = True
+
+# Days after which the catalog files are refreshed in the background after login
+CATALOG_MAX_AGE_DAYS_KEY = "catalog_max_age_days"
+DEFAULT_CATALOG_MAX_AGE_DAYS = 15
+
+# Days a data layer's color table is reused before it is requested from the catalog again
+LAYER_METADATA_TTL_DAYS_KEY = "layer_metadata_ttl_days"
+DEFAULT_LAYER_METADATA_TTL_DAYS = 15
+
+# Import the layers of a result in a background task and add them in one step under a group per query
+BATCH_IMPORT_KEY = "batch_import"
+DEFAULT_BATCH_IMPORT = True
+
+# How the value range the color ramp is stretched over is computed: approximate, percentile or exact
+STATS_MODE_KEY = "stats_mode"
+DEFAULT_STATS_MODE = "approximate"
+# Low and high percentile of the percentile stretch
+STATS_PERCENTILE_LOW_KEY = "stats_percentile_low"
+DEFAULT_STATS_PERCENTILE_LOW = 2.0
+STATS_PERCENTILE_HIGH_KEY = "stats_percentile_high"
+DEFAULT_STATS_PERCENTILE_HIGH = 98.0
+
+# Style all timestamps of a data layer in a result with one color ramp over their common range
+SHARED_STYLING_KEY = "shared_styling"
+DEFAULT_SHARED_STYLING = True
+
+# Post-processing of downloaded GeoTIFFs before they are imported: none, overviews or cog
+OPTIMIZE_MODE_KEY = "optimize_mode"
+DEFAULT_OPTIMIZE_MODE = "overviews"
+# GDAL compression of the overviews or COG and the COG tile size in pixels
+OPTIMIZE_COMPRESSION_KEY = "optimize_compression"
+DEFAULT_OPTIMIZE_COMPRESSION = "DEFLATE"
+OPTIMIZE_TILE_SIZE_KEY = "optimize_tile_size"
+DEFAULT_OPTIMIZE_TILE_SIZE = 512
+
+# Load each data layer of a result as one VRT: none, mosaic (per timestamp) or stack (a band per timestamp)
+VRT_MODE_KEY = "vrt_mode"
+DEFAULT_VRT_MODE = "none"
+
+# Milliseconds the main thread may spend adding a result to the project before a warning is logged
+MAIN_THREAD_BUDGET_MS_KEY = "main_thread_budget_ms"
+DEFAULT_MAIN_THREAD_BUDGET_MS = 250
+
+# Connections kept open to the backend by the shared HTTP session of the submit, status, download and catalog requests
+HTTP_POOL_SIZE_KEY = "http_pool_size"
+DEFAULT_HTTP_POOL_SIZE = 16
+
+# Reattach at login to the queries that were still running or downloading when QGIS was closed
+RESUME_QUERIES_KEY = "resume_queries"
+DEFAULT_RESUME_QUERIES = True
+
+# Index of submitted jobs by query hash, identical queries join a job in it instead of being submitted again.
+# Point the folder to a network share to share jobs between users, empty for the job_index folder of the plugin.
+JOB_INDEX_ENABLED_KEY = "job_index_enabled"
+DEFAULT_JOB_INDEX_ENABLED = True
+JOB_INDEX_FOLDER_KEY = "job_index_folder"
+# Hours after which an indexed job is no longer joined
+JOB_INDEX_MAX_AGE_HOURS_KEY = "job_index_max_age_hours"
+DEFAULT_JOB_INDEX_MAX_AGE_HOURS = 168
+
+# Fan-out over features: features whose bboxes are closer than the distance (degrees) are merged into one
+# query, as long as the merged bbox stays within the maximum size (degrees)
+FANOUT_MERGE_DISTANCE_KEY = "fanout_merge_distance"
+DEFAULT_FANOUT_MERGE_DISTANCE = 0.01
+FANOUT_MAX_MERGED_SIZE_KEY = "fanout_max_merged_size"
+DEFAULT_FANOUT_MAX_MERGED_SIZE = 0.1
+
+
+def value(key, default):
+    """
+    Reads a plugin option from the QGIS settings.
+
+    Args:
+        key (str): The option name within the plugin's settings namespace.
+        default: The value returned if the option is not set, its type is used to convert the stored value.
+
+    Returns:
+        The stored value or the default.
+    """
+    return QSettings().value("{}/{}".format(SETTINGS_NAMESPACE, key), default, type=type(default))
+
+
+def set_value(key, value):
+    """
+    Stores a plugin option in the QGIS settings.
+
+    Args:
+        key (str): The option name within the plugin's settings namespace.
+        value: The value to store.
+    """
+    QSettings().setValue("{}/{}".format(SETTINGS_NAMESPACE, key), value)
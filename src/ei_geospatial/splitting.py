@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+Name                 : IBM Geospatial APIs QGIS Plugin
+Description          : Splits large queries into spatial and temporal chunks
+                       and mosaics the chunk results.
+Date                 : 9/Jan/2024
+copyright            : (C) 2024 by International Business Machines
+email                : jannis.fleckenstein@ibm.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import copy
+import datetime
+import itertools
+import json
+import math
+import os
+from pathlib import Path
+
+from osgeo import gdal
+from qgis.core import QgsMessageLog, Qgis
+
+from .cache import TIMESTAMP_FORMATS
+
+MESSAGE_CATEGORY = 'ei-geospatial-apis'
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# Decimals the bbox to tile size ratio is rounded to, so float noise does not add an empty row or column
+GRID_DECIMALS = 9
+
+
+def split_query(raster_query, tile_size=0.0, interval_days=0):
+    """
+    Splits a query into a grid of sub-bboxes and/or per-interval chunks.
+
+    Only square (bbox) queries are split spatially and only intervals with a start and an end are
+    split temporally, snapshots stay together in one chunk.
+
+    Args:
+        raster_query (dict): The query json.
+        tile_size (float): The edge length of a spatial chunk in degrees, 0 disables spatial splitting.
+        interval_days (int): The length of a temporal chunk in days, 0 disables temporal splitting.
+
+    Returns:
+        list: The chunk queries, the original query if it is not split.
+    """
+    tiles = split_bbox(raster_query, tile_size)
+    periods = split_intervals(raster_query, interval_days)
+
+    if len(tiles) < 2 and len(periods) < 2:
+        return [raster_query]
+
+    chunks = []
+    for tile, intervals in itertools.product(tiles, periods):
+        chunk = copy.deepcopy(raster_query)
+        if tile is not None:
+            chunk['spatial']['coordinates'] = tile
+        if intervals is not None:
+            chunk['temporal']['intervals'] = intervals
+        chunks.append(chunk)
+    return chunks
+
+
+def split_bbox(raster_query, tile_size):
+    """
+    Returns the [south, west, north, east] coordinates of the grid cells covering the query bbox.
+
+    Returns:
+        list: The grid cell coordinates, [None] if the query is not split spatially.
+    """
+    spatial = raster_query.get('spatial') or {}
+    if not tile_size or str(spatial.get('type', '')).lower() != 'square':
+        return [None]
+
+    south, west, north, east = [float(c) for c in spatial['coordinates']]
+    rows = max(1, int(math.ceil(round((north - south) / tile_size, GRID_DECIMALS))))
+    cols = max(1, int(math.ceil(round((east - west) / tile_size, GRID_DECIMALS))))
+    if rows * cols < 2:
+        return [None]
+
+    tiles = []
+    for row in range(rows):
+        for col in range(cols):
+            tile = [south + row * tile_size,
+                    west + col * tile_size,
+                    min(north, south + (row + 1) * tile_size),
+                    min(east, west + (col + 1) * tile_size)]
+            # Cells left empty by rounding would be submitted as queries without an area
+            if tile[0] < tile[2] and tile[1] < tile[3]:
+                tiles.append(tile)
+    if len(tiles) < 2:
+        return [None]
+    return tiles
+
+
+def split_intervals(raster_query, interval_days):
+    """
+    Returns the interval lists of the temporal chunks of the query.
+
+    Returns:
+        list: One list of intervals per chunk, [None] if the query is not split temporally.
+    """
+    temporal = raster_query.get('temporal') or {}
+    intervals = temporal.get('intervals') or []
+    if not interval_days or not intervals:
+        return [None]
+
+    step = datetime.timedelta(days=interval_days)
+    snapshots = []
+    periods = []
+    for interval in intervals:
+        if 'start' not in interval or 'end' not in interval:
+            snapshots.append(interval)
+            continue
+        start = parse_interval_timestamp(interval['start'])
+        end = parse_interval_timestamp(interval['end'])
+        if start is None or end is None:
+            # Intervals in a format not understood here are kept whole instead of failing the query
+            periods.append([interval])
+            continue
+        while start <= end:
+            chunk_end = min(end, start + step - datetime.timedelta(seconds=1))
+            part = dict(interval)
+            part['start'] = start.strftime(TIMESTAMP_FORMAT)
+            part['end'] = chunk_end.strftime(TIMESTAMP_FORMAT)
+            periods.append([part])
+            start = chunk_end + datetime.timedelta(seconds=1)
+
+    if snapshots:
+        periods.append(snapshots)
+    if len(periods) < 2:
+        return [None]
+    return periods
+
+
+def parse_interval_timestamp(value):
+    """Returns an interval timestamp as a naive UTC datetime, None if its format is not known."""
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            timestamp = datetime.datetime.strptime(str(value), fmt)
+        except ValueError:
+            continue
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return timestamp
+    return None
+
+
+def read_output_info(folder):
+    """
+    Returns the file entries of the output.info in a result folder, keyed by file name.
+
+    Args:
+        folder (str): The result folder.
+
+    Returns:
+        dict: The output.info entries, empty if the file is missing or cannot be parsed.
+    """
+    output_info = Path(folder) / 'output.info'
+    if not output_info.is_file():
+        return {}
+    try:
+        with open(output_info) as f:
+            return {tiff['name']: tiff for tiff in json.load(f)['files']}
+    except (ValueError, KeyError, TypeError):
+        return {}
+
+
+def index_output_info(files):
+    """
+    Returns the output.info entry of every result file, parsing the output.info of each folder once.
+
+    Args:
+        files (list): The result files.
+
+    Returns:
+        dict: File path -> its output.info entry (datalayerId, timestamp, ...), files without an
+        entry are left out.
+    """
+    output_infos = {}
+    index = {}
+    for file in files:
+        parent = str(Path(file).parent)
+        if parent not in output_infos:
+            output_infos[parent] = read_output_info(parent)
+        entry = output_infos[parent].get(Path(file).stem)
+        if entry is not None:
+            index[file] = entry
+    return index
+
+
+def mosaic_files(files, folder):
+    """
+    Mosaics the result files of the chunks of a split query as GDAL VRTs.
+
+    Chunks of the same datalayer and timestamp produce files with the same name, each set of files
+    sharing a name is wrapped into one VRT. An output.info describing the VRTs is written next to
+    them so the layers are styled like the original files. If GDAL cannot build a VRT, the files
+    it would have wrapped are returned instead and keep the output.info of their chunk.
+
+    Args:
+        files (list): The .tiff result files of all chunks.
+        folder (str): The folder the VRTs are written to.
+
+    Returns:
+        list: The paths of the VRTs and of the files that could not be mosaicked.
+    """
+    os.makedirs(folder, exist_ok=True)
+
+    groups = {}
+    for file in files:
+        groups.setdefault(Path(file).stem, []).append(file)
+
+    vrts = []
+    info = []
+    entries = index_output_info(files)
+    for name, members in sorted(groups.items()):
+        vrt = os.path.join(folder, '{}.vrt'.format(name))
+        ds = gdal.BuildVRT(vrt, sorted(members))
+        if ds is None:
+            QgsMessageLog.logMessage('{} could not be built, its {} files are imported instead: {}'.format(
+                vrt, len(members), gdal.GetLastErrorMsg()), MESSAGE_CATEGORY, Qgis.Warning)
+            vrts.extend(sorted(members))
+            continue
+        ds = None
+        vrts.append(vrt)
+        entry = entries.get(members[0])
+        if entry is not None:
+            info.append(entry)
+
+    with open(os.path.join(folder, 'output.info'), 'w') as f:
+        json.dump({'files': info}, f)
+
+    return vrts
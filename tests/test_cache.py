@@ -0,0 +1,41 @@
+"""
+Tests of the cache key of queries.
+
+Runs with pytest from the repository root:
+
+    python -m pytest tests
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ei_geospatial.cache import canonical_query, query_hash  # noqa: E402
+
+QUERY = '''{
+    "layers": [{"id": "49464", "type": "raster"}, {"id": 51, "type": "raster"}],
+    "spatial": {"type": "square", "coordinates": [40.1, -74.2, 40.3, -74.0]},
+    "temporal": {"intervals": [{"start": "2024-01-01T00:00:00Z", "end": "2024-01-31T23:59:59Z"}]},
+    "name": "my query"
+}'''
+SAME_QUERY = ('{"temporal":{"intervals":[{"end":"2024-01-31T23:59:59Z","start":"2024-01-01"}]},'
+              '"spatial":{"coordinates":[40.1000000001,-74.2,40.3,-74],"type":"square"},'
+              '"layers":[{"type":"raster","id":"51"},{"type":"raster","id":49464}]}')
+
+
+def test_query_hash_is_stable_across_key_order_and_whitespace():
+    assert query_hash(json.loads(QUERY)) == query_hash(json.loads(SAME_QUERY))
+    assert query_hash(json.loads(QUERY)) == query_hash(json.loads(QUERY))
+
+
+def test_query_hash_changes_with_the_result():
+    other = json.loads(QUERY)
+    other['spatial']['coordinates'][0] = 40.2
+    assert query_hash(other) != query_hash(json.loads(QUERY))
+
+
+def test_canonical_query_normalizes_layers_timestamps_and_names():
+    canonical = canonical_query(json.loads(SAME_QUERY))
+    assert [layer['id'] for layer in canonical['layers']] == ['49464', '51']
+    assert canonical['temporal']['intervals'][0]['start'] == '2024-01-01T00:00:00Z'
+    assert 'name' not in canonical_query(json.loads(QUERY))
@@ -0,0 +1,56 @@
+"""
+Tests of the prefix search of the catalog index.
+
+Runs with pytest from the repository root, needs pandas:
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('pandas')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ei_geospatial.catalog_index import CatalogIndex  # noqa: E402
+
+DATA = {
+    'Sentinel 2': [
+        ['Sentinel 2 imagery', '49464', 'NDVI', '10m', 'unknown', 'Normalized difference vegetation index'],
+        ['Sentinel 2 imagery', '49360', 'Band 4 red', '10m', 'reflectance', ''],
+    ],
+    'ERA5': [
+        ['Reanalysis of the global climate', '49423', 'Temperature', '29km', 'K', 'Air temperature at 2 m'],
+    ],
+}
+
+
+@pytest.fixture
+def index():
+    return CatalogIndex.build(DATA)
+
+
+def ids(index, docs):
+    return sorted(index.layer_ids[doc] for doc in docs)
+
+
+def test_search_matches_token_prefixes(index):
+    assert ids(index, index.search('temp')) == ['49423']
+    assert ids(index, index.search('sent')) == ['49360', '49464']
+    assert ids(index, index.search('4936')) == ['49360']
+
+
+def test_search_needs_every_term_and_ignores_case_and_punctuation(index):
+    assert ids(index, index.search('Sentinel, NDVI')) == ['49464']
+    assert ids(index, index.search('sentinel temperature')) == []
+    assert index.search('zzz') == frozenset()
+
+
+def test_search_without_terms_matches_everything(index):
+    assert index.search('') is None
+    assert index.search(' - ') is None
+
+
+def test_term_lookups_are_cached(index):
+    assert index.term('veg') is index.term('veg')
+    assert ids(index, index.term('veg')) == ['49464']
@@ -0,0 +1,77 @@
+"""
+Tests of the catalog snapshot and when it is rebuilt.
+
+Runs with pytest from the repository root, needs pandas:
+
+    python -m pytest tests
+"""
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('pandas')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ei_geospatial import catalog_snapshot  # noqa: E402
+from ei_geospatial.catalog_snapshot import SNAPSHOT_FILE, load_catalog  # noqa: E402
+
+
+def write_catalog(folder, layer_names):
+    with open(os.path.join(folder, 'data_sets.json'), 'w') as f:
+        json.dump({'data_sets': [{'id': '1', 'name': 'Dataset', 'data_source_name': 'Source', 'description_long': 'Long', 'level': 20}]}, f)
+    with open(os.path.join(folder, 'data_layers.json'), 'w') as f:
+        json.dump({'data_layers': [{'id': str(100 + n), 'dataset_id': '1', 'name': name, 'data_source_name': None,
+                                    'description_long': None, 'level': 20, 'units': 'K'}
+                                   for n, name in enumerate(layer_names)]}, f)
+    return os.path.join(folder, 'data_sets.json'), os.path.join(folder, 'data_layers.json')
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    return write_catalog(str(tmp_path), ['Temperature', 'Humidity'])
+
+
+def layer_names(data):
+    return [record[2] for records in data.values() for record in records]
+
+
+def without_rebuild(monkeypatch):
+    def merge_catalog(*args):
+        raise AssertionError('the catalog was rebuilt')
+    monkeypatch.setattr(catalog_snapshot, 'merge_catalog', merge_catalog)
+
+
+def test_snapshot_is_used_while_the_catalog_files_are_unchanged(catalog, tmp_path, monkeypatch):
+    data, index = load_catalog(*catalog)
+    assert (tmp_path / SNAPSHOT_FILE).exists()
+
+    without_rebuild(monkeypatch)
+    cached, cached_index = load_catalog(*catalog)
+    assert cached == data
+    assert list(cached_index.docs) == list(index.docs)
+    assert sorted(cached_index.layer_ids[doc] for doc in cached_index.search('hum')) == ['101']
+
+
+def test_changed_catalog_file_invalidates_the_snapshot(catalog, tmp_path):
+    load_catalog(*catalog)
+    write_catalog(str(tmp_path), ['Temperature', 'Humidity', 'Precipitation'])
+    # The rewrite may land in the same mtime tick, the size changes anyway
+    data, index = load_catalog(*catalog)
+    assert layer_names(data) == ['Temperature', 'Humidity', 'Precipitation']
+    assert len(index.layer_ids) == 3
+
+
+def test_outdated_or_truncated_snapshot_is_rebuilt(catalog, tmp_path, monkeypatch):
+    data, _ = load_catalog(*catalog)
+    snapshot = tmp_path / SNAPSHOT_FILE
+    signature = catalog_snapshot.source_signature(list(catalog))
+    assert catalog_snapshot.load_snapshot(str(snapshot), signature) is not None
+
+    monkeypatch.setattr(catalog_snapshot, 'SNAPSHOT_VERSION', catalog_snapshot.SNAPSHOT_VERSION + 1)
+    assert catalog_snapshot.load_snapshot(str(snapshot), signature) is None
+    monkeypatch.undo()
+
+    snapshot.write_bytes(snapshot.read_bytes()[:-2])
+    assert catalog_snapshot.load_snapshot(str(snapshot), signature) is None
+    assert load_catalog(*catalog)[0] == data
@@ -0,0 +1,80 @@
+"""
+Tests of fanning a query template out over features and date ranges.
+
+Needs the QGIS Python environment with the GDAL bindings:
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('osgeo')
+pytest.importorskip('qgis.core')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ei_geospatial.fanout import FeatureBox, fan_out, merge_boxes, parse_periods  # noqa: E402
+
+TEMPLATE = {
+    'name': 'ndvi',
+    'layers': [{'id': '49464', 'type': 'raster'}],
+    'spatial': {'type': 'poly', 'aoi': '24'},
+    'temporal': {'intervals': [{'snapshot': '2024-01-01T00:00:00Z'}]},
+}
+
+
+def box(feature_id, south, west, size=0.01):
+    return FeatureBox([feature_id], [south, west, south + size, west + size])
+
+
+def test_merge_boxes_merges_nearby_boxes_only():
+    merged = merge_boxes([box(1, 0, 0), box(2, 0, 0.015), box(3, 5, 5)], 0.01, 1.0)
+    assert sorted(sorted(m.feature_ids) for m in merged) == [[1, 2], [3]]
+    assert [m.bbox for m in merged if m.feature_ids == [3]] == [[5, 5, 5.01, 5.01]]
+    assert [m.bbox for m in merged if 1 in m.feature_ids] == [[0, 0, 0.01, 0.025]]
+
+
+def test_merge_boxes_keeps_merged_boxes_within_the_maximum_size():
+    chain = [box(n, 0, n * 0.02) for n in range(10)]
+    merged = merge_boxes(chain, 0.015, 0.05)
+    assert sorted(feature_id for m in merged for feature_id in m.feature_ids) == list(range(10))
+    assert all(m.bbox[3] - m.bbox[1] <= 0.05 for m in merged)
+    assert len(merged) > 1
+
+
+def test_merge_boxes_repeats_until_merged_boxes_stop_coming_close():
+    # 3 joins the box of 1 in the first sweep, which only then comes within reach of 2
+    boxes = [box(1, 0, 0), box(2, 0.03, 0.001), box(3, 0.015, 0.002)]
+    merged = merge_boxes(boxes, 0.006, 1.0)
+    assert [sorted(m.feature_ids) for m in merged] == [[1, 2, 3]]
+
+
+def test_parse_periods_accepts_ranges_and_single_days():
+    periods = parse_periods('2024-01-01/2024-01-31\n\n2024-02-01; 2024-03-01T06:00:00/2024-03-01T18:00:00Z')
+    assert periods == [
+        ('2024-01-01T00:00:00Z', '2024-01-31T23:59:59Z'),
+        ('2024-02-01T00:00:00Z', '2024-02-01T23:59:59Z'),
+        ('2024-03-01T06:00:00Z', '2024-03-01T18:00:00Z'),
+    ]
+    with pytest.raises(ValueError):
+        parse_periods('last week')
+
+
+def test_fan_out_creates_a_query_per_box_and_period():
+    periods = parse_periods('2024-01-01\n2024-01-02')
+    queries = fan_out(TEMPLATE, [box(7, 0, 0), FeatureBox([3, 4], [1, 1, 2, 2])], periods)
+
+    assert [label for label, _, _ in queries] == ['7_20240101-20240101', '7_20240102-20240102',
+                                                  '3+1_20240101-20240101', '3+1_20240102-20240102']
+    label, query, feature_box = queries[2]
+    assert query['spatial'] == {'type': 'square', 'coordinates': [1, 1, 2, 2]}
+    assert query['temporal'] == {'intervals': [{'start': '2024-01-01T00:00:00Z', 'end': '2024-01-01T23:59:59Z'}]}
+    assert query['name'] == 'ndvi_3+1_20240101-20240101'
+    assert feature_box.feature_ids == [3, 4]
+    assert TEMPLATE['spatial'] == {'type': 'poly', 'aoi': '24'}
+
+
+def test_fan_out_gives_every_query_its_own_label():
+    queries = fan_out(TEMPLATE, [box('a', 0, 0), box('a', 1, 1), box('a_2', 2, 2), box('a', 3, 3)])
+    assert [label for label, _, _ in queries] == ['a', 'a_2', 'a_2_2', 'a_3']
+    assert fan_out(TEMPLATE)[0][0] == 'query'
@@ -0,0 +1,61 @@
+"""
+Tests of the shared index of running jobs.
+
+Needs the QGIS Python environment:
+
+    python -m pytest tests
+"""
+import json
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip('qgis.core')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ei_geospatial.job_index import JobIndex  # noqa: E402
+
+KEY = 'ab' + '0' * 62
+
+
+def test_published_job_is_found_by_another_session(tmp_path):
+    JobIndex(str(tmp_path), 3600).publish(KEY, 1234)
+
+    index = JobIndex(str(tmp_path), 3600)
+    entry = index.lookup(KEY)
+    assert entry['query_id'] == '1234'
+    assert entry['user'] and entry['host']
+    assert index.lookup('cd' + '0' * 62) is None
+    assert os.listdir(str(tmp_path / 'ab')) == [KEY + '.json']
+
+
+def test_old_jobs_are_not_joined(tmp_path):
+    index = JobIndex(str(tmp_path), 3600)
+    index.publish(KEY, 1234)
+    path = index.entry_path(KEY)
+    with open(path) as f:
+        entry = json.load(f)
+    with open(path, 'w') as f:
+        json.dump(dict(entry, submitted_at=time.time() - 7200), f)
+    assert index.lookup(KEY) is None
+
+
+def test_forget_keeps_a_job_that_replaced_the_forgotten_one(tmp_path):
+    index = JobIndex(str(tmp_path), 3600)
+    index.publish(KEY, 1234)
+    index.publish(KEY, 5678)
+    index.forget(KEY, 1234)
+    assert index.lookup(KEY)['query_id'] == '5678'
+
+    index.forget(KEY, 5678)
+    assert index.lookup(KEY) is None
+
+
+def test_lookups_and_joins_are_counted(tmp_path):
+    index = JobIndex(str(tmp_path), 3600)
+    index.lookup(KEY)
+    index.publish(KEY, 1234)
+    index.lookup(KEY)
+    index.joined()
+    assert index.report() == {'lookups': 2, 'avoided': 1}
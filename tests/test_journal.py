@@ -0,0 +1,86 @@
+"""
+Tests of the job journal read back after a restart.
+
+Needs the QGIS Python environment:
+
+    python -m pytest tests
+"""
+import os
+import sqlite3
+import sys
+import types
+
+import pytest
+
+pytest.importorskip('qgis.core')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ei_geospatial.journal import COMPLETED, DOWNLOADING, FAILED, RUNNING, JobJournal  # noqa: E402
+
+QUERY = {'layers': [{'id': '49464', 'type': 'raster'}], 'temporal': {'intervals': [{'snapshot': '2024-01-01T00:00:00Z'}]}}
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'jobs.sqlite')
+
+
+def test_unfinished_queries_are_read_back_after_a_restart(path):
+    journal = JobJournal(path)
+    journal.submitted('A', QUERY, '/results', cache_key='abc', retries=2)
+    journal.submitted('B', QUERY, '/results')
+    journal.update('B', DOWNLOADING)
+    journal.submitted('C', QUERY, '/results')
+    journal.update('C', COMPLETED, files=['/results/C/layer.tiff'])
+    journal.close()
+
+    entries = JobJournal(path).unfinished()
+    assert [(entry.query_id, entry.state) for entry in entries] == [('A', RUNNING), ('B', DOWNLOADING)]
+    assert entries[0].query_json == QUERY
+    assert (entries[0].download_folder, entries[0].cache_key, entries[0].retries) == ('/results', 'abc', 2)
+    assert entries[0].group_key is None and entries[0].files == []
+
+
+def test_split_query_is_read_back_with_all_chunks(path):
+    journal = JobJournal(path)
+    group = types.SimpleNamespace(key='split_1', folder='/results/split_1')
+    chunks = [dict(QUERY, spatial={'type': 'square', 'coordinates': [n, 0, n + 1, 1]}) for n in range(3)]
+    journal.split(group, chunks, '/results', retries=1)
+    journal.submitted('A', chunks[0], '/results', group=group, chunk=0)
+    journal.update('A', COMPLETED, files=['/results/A/layer.tiff'])
+    journal.submitted('B', chunks[1], '/results', group=group, chunk=1)
+    journal.update('B', FAILED, 'status code 21')
+    # The resubmission of chunk 1 replaces the failed job
+    journal.submitted('B2', chunks[1], '/results', group=group, chunk=1)
+    journal.close()
+
+    journal = JobJournal(path)
+    restored, = journal.unfinished_groups()
+    assert (restored.key, restored.folder, restored.download_folder) == ('split_1', '/results/split_1', '/results')
+    assert restored.chunks == chunks and restored.retries == 1
+    assert {chunk: (job.query_id, job.state) for chunk, job in restored.jobs.items()} == {0: ('A', COMPLETED), 1: ('B2', RUNNING)}
+    assert restored.jobs[0].files == ['/results/A/layer.tiff']
+
+    journal.group_finished('split_1', COMPLETED)
+    assert journal.unfinished_groups() == []
+
+
+def test_unreadable_entries_are_marked_failed(path):
+    journal = JobJournal(path)
+    journal.execute("INSERT INTO jobs (query_id, query_json, download_folder, state, submitted_at, updated_at) "
+                    "VALUES ('X', '{not json', '/results', ?, 0, 0)", (RUNNING,))
+    assert journal.unfinished() == []
+    assert journal.execute("SELECT state FROM jobs WHERE query_id = 'X'")[0]['state'] == FAILED
+
+
+def test_journal_of_an_older_version_gets_the_new_columns(path):
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE jobs (query_id TEXT PRIMARY KEY, query_json TEXT NOT NULL, download_folder TEXT NOT NULL, '
+                       'state TEXT NOT NULL, cache_key TEXT, group_key TEXT, group_folder TEXT, retries INTEGER NOT NULL DEFAULT 0, '
+                       'error TEXT, submitted_at REAL NOT NULL, updated_at REAL NOT NULL)')
+    connection.commit()
+    connection.close()
+
+    journal = JobJournal(path)
+    journal.submitted('A', QUERY, '/results', chunk=0)
+    entry, = journal.unfinished()
+    assert (entry.query_id, entry.chunk) == ('A', 0)
@@ -0,0 +1,106 @@
+"""
+Tests of the query pipeline's bookkeeping, driven through its task callbacks without a backend.
+
+Needs the QGIS Python environment and the ibmpairs SDK:
+
+    python -m pytest tests
+"""
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip('qgis.core')
+pytest.importorskip('ibmpairs.query')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ei_geospatial.journal import JobJournal  # noqa: E402
+from ei_geospatial.pipeline import COMPLETED, FAILED, PENDING, RUNNING, SUBMITTING, QueryPipeline  # noqa: E402
+
+
+def chunk(n):
+    return {'layers': [{'id': '49464', 'type': 'raster'}],
+            'spatial': {'type': 'square', 'coordinates': [n, 0, n + 1, 1]},
+            'temporal': {'intervals': [{'snapshot': '2024-01-01T00:00:00Z'}]}}
+
+
+def submitted(pipeline, query_json, query_id, record=None):
+    """Queues a query and completes its submission task with a job id, as submit_task would."""
+    if record is None:
+        record = pipeline.table.add(query_json, '/tmp/results')
+    pipeline.table.set_state(record, SUBMITTING)
+    pipeline.submit_completed(record, None, types.SimpleNamespace(id=query_id))
+    return record
+
+
+def test_identical_queries_of_a_session_finish_together():
+    pipeline = QueryPipeline(max_concurrent=4)
+    downloaded = []
+    pipeline.downloaded.connect(downloaded.append)
+
+    first = submitted(pipeline, {'layers': [{'id': '49464'}]}, 'X')
+    # The second query joined job X through the job index while it was still running
+    second = submitted(pipeline, {'layers': [{'id': '49464'}]}, 'X')
+    assert pipeline.table.find('X') is first
+    assert pipeline.poller.entries.keys() == {'X'}
+
+    first.files = ['/tmp/results/X/layer.tiff']
+    pipeline.download_completed(first, None, first.query)
+
+    assert first.state == second.state == COMPLETED
+    assert second.files == first.files
+    assert downloaded == [first, second]
+    assert not pipeline.busy()
+
+
+def test_followers_fail_with_the_job():
+    pipeline = QueryPipeline(max_concurrent=4)
+    first = submitted(pipeline, {'layers': [{'id': '49464'}]}, 'X')
+    second = submitted(pipeline, {'layers': [{'id': '49464'}]}, 'X')
+
+    pipeline.query_failed(first.query, 'status code 21')
+
+    assert first.state == second.state == FAILED
+    assert second.error == 'status code 21'
+    assert not pipeline.busy()
+
+
+def test_resume_rebuilds_a_split_query_with_all_chunks(tmp_path):
+    journal = JobJournal(str(tmp_path / 'jobs.sqlite'))
+    # No concurrency, queued chunks stay queued and nothing is submitted to a backend
+    pipeline = QueryPipeline(max_concurrent=0, journal=journal)
+    group = pipeline.enqueue_split([chunk(0), chunk(1), chunk(2)], str(tmp_path))
+    done, running, queued = group.records
+    submitted(pipeline, None, 'A', done)
+    result = tmp_path / 'A.tiff'
+    result.write_bytes(b'')
+    done.files = [str(result)]
+    pipeline.download_completed(done, None, done.query)
+    submitted(pipeline, None, 'B', running)
+    pipeline.cancel_all()
+
+    resumed = QueryPipeline(max_concurrent=0, journal=journal)
+    reattached = resumed.resume()
+
+    rebuilt = resumed.groups[group.key]
+    assert [record.state for record in rebuilt.records] == [COMPLETED, RUNNING, PENDING]
+    assert rebuilt.records[0].files == [str(result)]
+    assert [record.query_id for record in reattached] == ['B']
+    assert list(resumed.pending) == [rebuilt.records[2]]
+    assert rebuilt.records[2].query_json == queued.query_json
+
+
+def test_resume_does_not_mosaic_a_group_without_its_chunk_list(tmp_path):
+    journal = JobJournal(str(tmp_path / 'jobs.sqlite'))
+    legacy = types.SimpleNamespace(key='split_1', folder=str(tmp_path / 'split_1'))
+    journal.submitted('C', chunk(0), str(tmp_path), group=legacy)
+    pipeline = QueryPipeline(max_concurrent=0, journal=journal)
+    failed = []
+    pipeline.mosaic_failed.connect(failed.append)
+
+    record, = pipeline.resume()
+    assert record.group.complete is False
+    pipeline.download_completed(record, None, record.query)
+
+    assert [group.key for group in failed] == ['split_1']
+    assert not pipeline.busy()
@@ -0,0 +1,108 @@
+"""
+Tests of the status polling backoff, driven with a fake clock and a fake status sequence.
+
+Needs the QGIS Python environment:
+
+    python -m pytest tests
+"""
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip('qgis.core')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ei_geospatial import polling  # noqa: E402
+from ei_geospatial.polling import BACKOFF_SCHEDULE, QueryPoller, backoff_delay  # noqa: E402
+
+# Seconds between the status requests of the old download loop, ibmpairs' QUERY_STATUS_CHECK_INTERVAL
+FIXED_INTERVAL = 30.0
+# Status codes of a job and the second each of them ends at, the job succeeds after the last one
+LONG_JOB = [(0, 600), (1, 630), (10, 1800), (11, 1830), (12, 1845)]
+SHORT_JOB = [(10, 40), (11, 45), (12, 50)]
+
+
+def status_at(phases, now):
+    for status_code, end in phases:
+        if now < end:
+            return status_code
+    return polling.SUCCEEDED_STATUS_CODE
+
+
+class FakeQuery(object):
+    """Reports the status of its phases at the time of the fake clock and counts the status requests."""
+
+    def __init__(self, phases, clock):
+        self.id = 'Q'
+        self.phases = phases
+        self.clock = clock
+        self.calls = 0
+        self.status_response = types.SimpleNamespace(status_code=None)
+
+    def status(self, poll=True):
+        self.calls += 1
+        self.status_response.status_code = status_at(self.phases, self.clock.now)
+
+
+def fixed_interval_run(phases, interval):
+    """Returns the status requests and the second the job is seen as done when it is checked every interval seconds."""
+    now, calls = interval, 1
+    while status_at(phases, now) != polling.SUCCEEDED_STATUS_CODE:
+        now += interval
+        calls += 1
+    return calls, now
+
+
+def backoff_run(phases, monkeypatch):
+    """Polls a job through the QueryPoller without jitter, returns its status requests and the second it was ready."""
+    clock = types.SimpleNamespace(now=0.0)
+    monkeypatch.setattr(polling, 'time', types.SimpleNamespace(monotonic=lambda: clock.now))
+    monkeypatch.setattr(polling, 'random', types.SimpleNamespace(random=lambda: 0.0))
+    task = types.SimpleNamespace(isCanceled=lambda: False, setProgress=lambda progress: None)
+    query = FakeQuery(phases, clock)
+    ready = []
+
+    poller = QueryPoller()
+    poller.ready.connect(ready.append)
+    poller.track(query)
+    while poller.entries:
+        entry = poller.entries[query.id]
+        clock.now = entry.next_poll
+        poller.poll_completed(None, poller.poll_task(task, [entry]))
+    poller.stop()
+
+    assert ready == [query]
+    assert poller.totals['status_polls'] == query.calls
+    return query.calls, clock.now
+
+
+def test_backoff_delay_grows_per_status_code_up_to_its_maximum():
+    for status_code, (first, factor, maximum) in BACKOFF_SCHEDULE.items():
+        assert backoff_delay(status_code, 0, jitter=0) == first
+        assert backoff_delay(status_code, 1, jitter=0) == min(first * factor, maximum)
+        assert backoff_delay(status_code, 50, jitter=0) == maximum
+    # Jobs about to finish are polled sooner than queued ones
+    assert backoff_delay(12, 0, jitter=0) < backoff_delay(10, 0, jitter=0) < backoff_delay(0, 0, jitter=0)
+
+
+def test_backoff_delay_jitter_only_shortens_the_delay():
+    delays = [backoff_delay(10, 3) for _ in range(100)]
+    assert all(backoff_delay(10, 3, jitter=0) * (1 - polling.JITTER) <= delay <= backoff_delay(10, 3, jitter=0) for delay in delays)
+
+
+def test_long_job_needs_fewer_status_requests_than_fixed_interval_polling(monkeypatch):
+    calls, ready_at = backoff_run(LONG_JOB, monkeypatch)
+    fixed_calls, fixed_ready_at = fixed_interval_run(LONG_JOB, FIXED_INTERVAL)
+
+    assert (calls, fixed_calls) == (40, 62)
+    # Writing and packaging are polled closely, so the result is not noticed later either
+    assert ready_at <= fixed_ready_at
+
+
+def test_short_job_is_noticed_sooner_than_with_fixed_interval_polling(monkeypatch):
+    calls, ready_at = backoff_run(SHORT_JOB, monkeypatch)
+    fixed_calls, fixed_ready_at = fixed_interval_run(SHORT_JOB, FIXED_INTERVAL)
+
+    assert (calls, fixed_calls) == (5, 2)
+    assert ready_at - 50 < 1 < fixed_ready_at - 50
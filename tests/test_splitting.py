@@ -0,0 +1,93 @@
+"""
+Tests of the spatial and temporal splitting of large queries.
+
+Runs with pytest from the repository root and needs the QGIS Python environment with the GDAL
+bindings:
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('osgeo')
+pytest.importorskip('qgis.core')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ei_geospatial import splitting  # noqa: E402
+from ei_geospatial.splitting import mosaic_files, split_bbox, split_intervals, split_query  # noqa: E402
+
+
+def square(coordinates):
+    return {'spatial': {'type': 'square', 'coordinates': coordinates}}
+
+
+def period(*intervals):
+    return {'temporal': {'intervals': list(intervals)}}
+
+
+def test_split_bbox_has_no_empty_cell_from_float_noise():
+    # (0.4 - 0.1) / 0.1 is slightly above 3
+    tiles = split_bbox(square([0.1, 0, 0.4, 0.1]), 0.1)
+    assert len(tiles) == 3
+    assert all(south < north and west < east for south, west, north, east in tiles)
+    assert tiles[-1][2] == 0.4
+
+
+def test_split_bbox_covers_the_bbox_with_a_partial_last_cell():
+    tiles = split_bbox(square([0, 0, 0.25, 0.1]), 0.1)
+    assert len(tiles) == 3
+    assert tiles[0][:2] == [0, 0]
+    assert tiles[-1][2:] == [0.25, 0.1]
+
+
+def test_split_bbox_does_not_split_small_or_non_square_queries():
+    assert split_bbox(square([0, 0, 0.1, 0.1]), 0.1) == [None]
+    assert split_bbox(square([0, 0, 1, 1]), 0) == [None]
+    assert split_bbox({'spatial': {'type': 'poly', 'aoi': '24'}}, 0.1) == [None]
+
+
+def test_split_intervals_into_days():
+    periods = split_intervals(period({'start': '2024-01-01T00:00:00Z', 'end': '2024-01-03T23:59:59Z'}), 1)
+    assert [p[0]['start'] for p in periods] == ['2024-01-01T00:00:00Z', '2024-01-02T00:00:00Z', '2024-01-03T00:00:00Z']
+    assert periods[-1][0]['end'] == '2024-01-03T23:59:59Z'
+
+
+@pytest.mark.parametrize('start, end', [
+    ('2024-01-01', '2024-01-03'),
+    ('2024-01-01T00:00:00', '2024-01-03T00:00:00'),
+    ('2024-01-01T00:00:00.000Z', '2024-01-03T00:00:00.000Z'),
+    ('2024-01-01T01:00:00+01:00', '2024-01-03T01:00:00+01:00'),
+])
+def test_split_intervals_accepts_other_timestamp_formats(start, end):
+    periods = split_intervals(period({'start': start, 'end': end}), 1)
+    assert len(periods) == 3
+    assert periods[0][0]['start'] == '2024-01-01T00:00:00Z'
+
+
+def test_split_intervals_keeps_unknown_formats_whole():
+    interval = {'start': 'last week', 'end': 'today'}
+    snapshot = {'snapshot': '2024-01-01T00:00:00Z'}
+    periods = split_intervals(period(interval, snapshot), 1)
+    assert periods == [[interval], [snapshot]]
+    assert split_intervals(period(interval), 1) == [None]
+
+
+def test_split_query_combines_tiles_and_periods():
+    query = dict(square([0, 0, 0.2, 0.1]), **period({'start': '2024-01-01', 'end': '2024-01-02'}))
+    chunks = split_query(query, 0.1, 1)
+    assert len(chunks) == 4
+    assert query['spatial']['coordinates'] == [0, 0, 0.2, 0.1]
+
+
+def test_mosaic_files_imports_the_chunk_files_if_a_vrt_cannot_be_built(tmp_path, monkeypatch):
+    monkeypatch.setattr(splitting.gdal, 'BuildVRT', lambda vrt, members: None, raising=False)
+    monkeypatch.setattr(splitting.gdal, 'GetLastErrorMsg', lambda: 'no driver', raising=False)
+    files = []
+    for name in ('chunk_1', 'chunk_0'):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'layer.tiff').write_bytes(b'')
+        files.append(str(tmp_path / name / 'layer.tiff'))
+
+    assert mosaic_files(files, str(tmp_path / 'mosaic')) == sorted(files)
+    assert not (tmp_path / 'mosaic' / 'layer.vrt').exists()